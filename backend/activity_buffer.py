@@ -0,0 +1,102 @@
+# activity_buffer.py
+# Буфер «пользователь был активен» для bt_3_messages.
+# Раньше каждое текстовое сообщение в группе давало отдельный INSERT ... ON CONFLICT (user_id).
+# Теперь log_message только обновляет запись в памяти (по одной на user_id), а flush_activity
+# раз в ACTIVITY_FLUSH_INTERVAL секунд пишет всё одним многострочным upsert. При остановке бота
+# остаток сбрасывается синхронно (flush_activity_sync), чтобы не потерять последние сообщения.
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+
+import psycopg2.extras
+
+try:
+    from backend import metrics
+    from backend.async_db import db_transaction
+    from backend.db_pool import get_pool
+except ImportError:
+    import metrics
+    from async_db import db_transaction
+    from db_pool import get_pool
+
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv("ACTIVITY_FLUSH_INTERVAL", "30"))
+
+_lock = threading.Lock()
+_buffer = {}  # user_id -> (username, время последнего сообщения)
+
+_UPSERT_SQL = """
+    INSERT INTO bt_3_messages (user_id, username, message, timestamp)
+    VALUES %s
+    ON CONFLICT (user_id)
+    DO UPDATE SET timestamp = GREATEST(bt_3_messages.timestamp, EXCLUDED.timestamp);
+"""
+
+
+def record_activity(user_id, username) -> None:
+    """Запоминает активность пользователя. Повторные сообщения до сброса схлопываются в одну строку."""
+    with _lock:
+        _buffer[user_id] = (username, datetime.now())
+        depth = len(_buffer)
+    metrics.set_gauge("activity_buffer_depth", depth)
+
+
+def _take_batch():
+    global _buffer
+    with _lock:
+        batch, _buffer = _buffer, {}
+    metrics.set_gauge("activity_buffer_depth", 0)
+    return batch
+
+
+def _restore_batch(batch):
+    """Возвращает несохранённые записи в буфер, не затирая более свежие."""
+    with _lock:
+        for user_id, entry in batch.items():
+            current = _buffer.get(user_id)
+            if current is None or current[1] < entry[1]:
+                _buffer[user_id] = entry
+        depth = len(_buffer)
+    metrics.set_gauge("activity_buffer_depth", depth)
+
+
+def _write_batch(cursor, batch):
+    rows = [(user_id, username, "user_message", seen_at) for user_id, (username, seen_at) in batch.items()]
+    psycopg2.extras.execute_values(cursor, _UPSERT_SQL, rows)
+    return len(rows)
+
+
+async def flush_activity(context=None) -> int:
+    """Пишет накопленную активность в bt_3_messages. Возвращает число строк. Метрика activity_flush_seconds."""
+    batch = _take_batch()
+    if not batch:
+        return 0
+    started = time.perf_counter()
+    try:
+        written = await db_transaction("activity_flush", _write_batch, batch)
+    except Exception as e:
+        logging.error(f"❌ Не удалось сохранить активность пользователей ({len(batch)} шт.): {e}")
+        _restore_batch(batch)
+        return 0
+    metrics.observe("activity_flush_seconds", time.perf_counter() - started)
+    metrics.inc("activity_flush_rows_total", written)
+    return written
+
+
+def flush_activity_sync() -> int:
+    """Синхронный сброс для остановки бота, когда event loop уже закрыт."""
+    batch = _take_batch()
+    if not batch:
+        return 0
+    started = time.perf_counter()
+    try:
+        with get_pool().transaction() as conn:
+            with conn.cursor() as cursor:
+                written = _write_batch(cursor, batch)
+    except Exception as e:
+        logging.error(f"❌ Не удалось сохранить активность пользователей при остановке: {e}")
+        return 0
+    metrics.observe("activity_flush_seconds", time.perf_counter() - started)
+    logging.info(f"✅ Активность {written} пользователей сохранена при остановке.")
+    return written
@@ -7,6 +7,9 @@ import asyncio
 from typing import Optional, List, Dict
 from database import get_db_connection_context  
 from openai_manager import client as openai_client, system_message
+from openai_guard import guarded_call, estimate_tokens
+from singleflight import single_flight
+from hot_queries import TOP_MISTAKES_SQL
 from config_mistakes_data import (
     VALID_CATEGORIES, 
     VALID_SUBCATEGORIES, 
@@ -224,14 +227,7 @@ class GermanTeacherTools:
                     # 1. Знаходимо 2 найчастіші теми помилок (категорія + підкатегорія)
                     # Ми беремо помилки за останні 120 днів (можна змінити)
                     # COUNT(*) — це функція, яка при роботі з GROUP BY підраховує, скільки оригінальних рядків було "схлопнуто" в кожну групу.
-                    cursor.execute("""
-                        SELECT main_category, sub_category, COUNT(*) as error_count
-                        FROM bt_3_detailed_mistakes
-                        WHERE user_id = %s AND last_seen >= NOW() - INTERVAL '120 days'
-                        GROUP BY main_category, sub_category
-                        ORDER BY error_count DESC
-                        LIMIT 2;
-                    """, (user_id,))
+                    cursor.execute(TOP_MISTAKES_SQL, (user_id,))
                     
                     top_mistakes = cursor.fetchall()
                     
@@ -433,15 +429,17 @@ class GermanTeacherTools:
         user_prompt = f"Explain this topic using a lifehack or mnemonic: {topic}"
 
         try:
-            response = await openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7, # Трохи більше креативності для метафор
-                max_tokens=200
-            )
+            # Бюджет, повторы с джиттером и circuit breaker — в openai_guard; одинаковые одновременные темы — один запрос
+            response = await single_flight("explain_grammar", (system_prompt, user_prompt), lambda: guarded_call(
+                "gpt-4o-mini", lambda: openai_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    temperature=0.7, # Трохи більше креативності для метафор
+                    max_tokens=200
+                ), estimated_tokens=estimate_tokens(system_prompt, user_prompt, completion_tokens=200)))
             
             explanation = response.choices[0].message.content
             return explanation
@@ -501,15 +499,17 @@ class GermanTeacherTools:
         question_id = int(uuid4().hex[:12], 16)  # Генеруємо унікальний ідентифікатор питання
 
         try:
-            response = await openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                response_format={"type": "json_object"}, 
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.5
-            )
+            # Бюджет, повторы с джиттером и circuit breaker — в openai_guard; одинаковые одновременные темы — один запрос
+            response = await single_flight("generate_quiz_question", (system_prompt, user_prompt), lambda: guarded_call(
+                "gpt-4o-mini", lambda: openai_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    response_format={"type": "json_object"}, 
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    temperature=0.5
+                ), estimated_tokens=estimate_tokens(system_prompt, user_prompt)))
             quiz_data = json.loads(response.choices[0].message.content)
             quiz_data["question_id"] = question_id
             return quiz_data
@@ -533,7 +533,8 @@ class GermanTeacherTools:
         user_prompt = f"Q: {question_text}, Correct: {correct_answer}, User: {user_answer}"
 
         try:
-            response = await openai_client.chat.completions.create(
+            # Бюджет, повторы с джиттером и circuit breaker — в openai_guard
+            response = await guarded_call("gpt-4o-mini", lambda: openai_client.chat.completions.create(
                 model="gpt-4o-mini",
                 response_format={"type": "json_object"},
                 messages=[
@@ -541,7 +542,7 @@ class GermanTeacherTools:
                     {"role": "user", "content": user_prompt}
                 ],
                 temperature=0.0 
-            )
+            ), estimated_tokens=estimate_tokens(system_prompt, user_prompt))
             # Ми робимо json.loads, щоб:
             # (json.loads): Вы превращаете эту строку в словарь Python
             # Отримати Python-об'єкт, з яким зручно працювати всередині коду (логіка, бази даних).
@@ -0,0 +1,132 @@
+# async_db.py
+# Неблокирующий доступ к БД для обработчиков Telegram.
+# psycopg2 синхронный, поэтому каждый запрос выполняется в отдельном ограниченном пуле потоков,
+# а event loop python-telegram-bot только ждёт результат. Медленный запрос одного пользователя
+# больше не останавливает обработку обновлений остальных.
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2.extensions
+
+try:
+    from backend import metrics
+    from backend.db_pool import get_pool, DB_POOL_MAX_SIZE
+except ImportError:
+    import metrics
+    from db_pool import get_pool, DB_POOL_MAX_SIZE
+
+# Потоков не больше, чем соединений в пуле: лишние потоки всё равно ждали бы соединение
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX_SIZE)))
+# Таймаут на один вызов (секунды) — общий срок всей транзакции: ожидание соединения, запросы и COMMIT
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "15"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+
+class DatabaseTimeoutError(TimeoutError):
+    """Запрос к БД не уложился в отведённый таймаут."""
+
+
+class _DeadlineCursor(psycopg2.extensions.cursor):
+    """Курсор, который не начинает новый запрос после истечения срока транзакции или отмены вызывающим."""
+
+    check_deadline = None  # задаётся в _run_in_transaction
+
+    def execute(self, query, vars=None):
+        self.check_deadline()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        self.check_deadline()
+        return super().executemany(query, vars_list)
+
+
+def _run_in_transaction(query_name, fn, args, deadline, cancelled):
+    """
+    Выполняет fn в транзакции с общим сроком deadline (time.monotonic()): ожидание соединения,
+    все запросы fn и COMMIT укладываются в один бюджет. Если срок вышел или вызывающий уже получил
+    DatabaseTimeoutError (cancelled), транзакция откатывается, а не фиксируется.
+    """
+    def check_deadline():
+        if cancelled.is_set() or time.monotonic() >= deadline:
+            raise DatabaseTimeoutError(f"Query '{query_name}' exceeded its transaction deadline")
+
+    check_deadline()  # вызов мог простоять в очереди пула потоков дольше таймаута
+    started = time.perf_counter()
+    with get_pool().transaction(timeout=deadline - time.monotonic()) as conn:
+        metrics.observe("db_acquire_seconds", time.perf_counter() - started, query=query_name)
+        with conn.cursor(cursor_factory=_DeadlineCursor) as cursor:
+            cursor.check_deadline = check_deadline
+            # SET LOCAL действует только до конца транзакции и не «протекает» в пул.
+            # Сервер ограничивает запросы оставшимся бюджетом, а не полным таймаутом
+            remaining_ms = max(1, int((deadline - time.monotonic()) * 1000))
+            cursor.execute("SELECT set_config('statement_timeout', %s, true);", (str(remaining_ms),))
+            result = fn(cursor, *args)
+        # Исключение внутри transaction() — это ROLLBACK вместо COMMIT
+        check_deadline()
+        return result
+
+
+async def db_transaction(query_name, fn, *args, timeout=None):
+    """
+    Выполняет fn(cursor, *args) в одной транзакции в пуле потоков БД.
+    :param query_name: Имя запроса для гистограммы задержек (db_query_seconds{query=...}).
+    :param fn: Синхронная функция, получающая курсор psycopg2 первым аргументом.
+    :return: То, что вернула fn.
+    """
+    timeout = DB_QUERY_TIMEOUT if timeout is None else timeout
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    status = "ok"
+    # Срок на всю транзакцию (очередь, соединение, запросы, COMMIT) — отсчитывается от вызова
+    deadline = time.monotonic() + timeout
+    cancelled = threading.Event()
+    try:
+        future = loop.run_in_executor(_executor, _run_in_transaction, query_name, fn, args, deadline, cancelled)
+        # Небольшой запас сверх срока, чтобы поток успел сам откатить транзакцию
+        return await asyncio.wait_for(future, timeout + 1)
+    except (asyncio.TimeoutError, DatabaseTimeoutError):
+        # Поток мог ещё не дойти до COMMIT — после этого флага он откатит транзакцию
+        cancelled.set()
+        status = "timeout"
+        logging.error(f"❌ Запрос '{query_name}' не уложился в {timeout} сек.")
+        raise DatabaseTimeoutError(f"Query '{query_name}' timed out after {timeout}s")
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("db_query_seconds", elapsed, query=query_name)
+        metrics.inc("db_queries_total", query=query_name, status=status)
+        if elapsed > 1.0:
+            logging.warning(f"🐢 Медленный запрос '{query_name}': {elapsed:.2f} сек")
+
+
+async def db_fetchall(query_name, sql, params=None, timeout=None):
+    def fn(cursor):
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    return await db_transaction(query_name, fn, timeout=timeout)
+
+
+async def db_fetchone(query_name, sql, params=None, timeout=None):
+    def fn(cursor):
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+    return await db_transaction(query_name, fn, timeout=timeout)
+
+
+async def db_execute(query_name, sql, params=None, timeout=None):
+    """Выполняет запрос без результата и возвращает rowcount."""
+    def fn(cursor):
+        cursor.execute(sql, params)
+        return cursor.rowcount
+    return await db_transaction(query_name, fn, timeout=timeout)
+
+
+def shutdown_db_executor():
+    _executor.shutdown(wait=True)
@@ -18,4 +18,9 @@ VALID_SUBCATEGORIES = {
 }
 
 VALID_CATEGORIES_lower = [cat.lower() for cat in VALID_CATEGORIES]
-VALID_SUBCATEGORIES_lower = {k.lower(): [v.lower() for v in values] for k, values in VALID_SUBCATEGORIES.items()}
\ No newline at end of file
+VALID_SUBCATEGORIES_lower = {k.lower(): [v.lower() for v in values] for k, values in VALID_SUBCATEGORIES.items()}
+
+# (категория.lower(), подкатегория.lower()) -> каноническое написание пары: проверка и восстановление одним поиском в словаре
+MISTAKE_PAIR_BY_LOWER = {
+    (cat.lower(), sub.lower()): (cat, sub) for cat, subs in VALID_SUBCATEGORIES.items() for sub in subs
+}
@@ -1,6 +1,4 @@
-import psycopg2
 import os
-from contextlib import contextmanager
 import json
 from pathlib import Path
 from dotenv import load_dotenv
@@ -17,84 +15,20 @@ else:
     # Для безопасности печатаем только хост, скрывая пароль
     print(f"✅ database.py успешно загрузил URL (хост: {DATABASE_URL.split('@')[-1].split(':')[0]})")
 
-@contextmanager
-def get_db_connection_context(): #
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require') #
-    try:
-        yield conn #
-        conn.commit() #
-    finally:
-        conn.close() #
+# Соединения берём из общего пула (backend/db_pool.py) вместо нового TLS-подключения на каждый запрос.
+# Модуль импортируется и как backend.database (bot_3.py), и как database (agent.py из папки backend).
+try:
+    from backend.db_pool import get_db_connection_context
+except ImportError:
+    from db_pool import get_db_connection_context
 
 def init_db(): #
-    with get_db_connection_context() as conn: #
-        with conn.cursor() as cursor: 
-            # 1. Таблица для клиентов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS clients (
-                    id SERIAL PRIMARY KEY,
-                    first_name TEXT NOT NULL,
-                    last_name TEXT,
-                    system_id TEXT UNIQUE, -- Уникальный ID клиента в системе (если есть)
-                    phone_number TEXT UNIQUE, -- Телефон клиента
-                    email TEXT UNIQUE,
-                    location TEXT, -- Город или регион клиента
-                    manager_contact TEXT, -- Контакты ответственного менеджера
-                    is_existing_client BOOLEAN DEFAULT FALSE, -- Признак, работает ли клиент с нами
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            print("✅ Таблица 'clients' проверена/создана.")
-
-            # 2. Таблица для продуктов/услуг
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS products (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL UNIQUE,
-                    description TEXT,
-                    price DECIMAL(10, 2) NOT NULL, -- Цена продукта, 10 цифр всего, 2 после запятой
-                    is_new BOOLEAN DEFAULT FALSE, -- Признак новинки
-                    available_quantity INT DEFAULT 0, -- Доступное количество на складе
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            print("✅ Таблица 'products' проверена/создана.")
-
-            # 3. Таблица для заказов
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS orders (
-                    id SERIAL PRIMARY KEY,
-                    client_id INT REFERENCES clients(id), -- Внешний ключ на клиента
-                    order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    status TEXT DEFAULT 'pending', -- Статус заказа (pending, completed, cancelled)
-                    total_amount DECIMAL(10, 2), -- Общая сумма заказа
-                    order_details JSONB, -- Подробности заказа в JSON-формате (например, {"product_id": 1, "quantity": 2})
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            print("✅ Таблица 'orders' проверена/создана.")
-
-            # Пример: Добавление базовых продуктов (для тестирования)
-            # Внимание: для реального использования, эти данные должны управляться через CRM/API
-            products_to_insert = [
-                ("LapTop ZenBook Pro", "The powerful Laptop for professionals, 16GB RAM, 1TB SSD", 1500.00, True, 100),
-                ("Smartphone UltraVision 2000", "Top smartphone with AI-camera and super detailed night mode", 999.99, False, 250),
-                ("Monitor ErgoView", "Energy saving 27 inch monitor with full HD", 450.50, False, 50),
-                ("Whireless earphones AirPods", "Earpods with noice cancellation and 30 hours autonomous working time", 120.00, True, 300)
-            ]
-            for name, description, price, is_new, quantity in products_to_insert:
-                cursor.execute("""
-                    INSERT INTO products (name, description, price, is_new, available_quantity)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON CONFLICT (name) DO UPDATE SET
-                        description = EXCLUDED.description, -- специальное ключевое слово в PostgreSQL. Оно ссылается на значение, которое было бы вставлено, если бы конфликта не произошло. То есть, это значение description, которое вы пытались вставить в этой конкретной INSERT операции.
-                        price = EXCLUDED.price,
-                        is_new = EXCLUDED.is_new,
-                        available_quantity = EXCLUDED.available_quantity;
-                """, (name, description, price, is_new, quantity))
-            print("✅ Базовые продукты вставлены/обновлены.")
-
-    print("✅ Инициализация базы данных завершена.")
+    """Таблицы теперь создаются миграциями (backend/migrations.py); функция оставлена для старых вызовов."""
+    try:
+        from backend.migrations import ensure_schema
+    except ImportError:
+        from migrations import ensure_schema
+    return ensure_schema()
 
 # --- Новые функции для ассистента по продажам ---
 
@@ -0,0 +1,280 @@
+# db_pool.py
+# Общий пул соединений с PostgreSQL для bot_3.py, backend/database.py и backend/openai_manager.py.
+# Раньше каждый обработчик открывал новое TLS-соединение (psycopg2.connect(..., sslmode='require'))
+# и закрывал его после запроса. Рукопожатие TLS занимало большую часть времени ответа,
+# а в часы пик мы упирались в лимит соединений Railway.
+import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool as pg_pool
+from dotenv import load_dotenv
+from pathlib import Path
+
+load_dotenv(dotenv_path=Path(__file__).parent / ".env")
+
+DATABASE_URL = os.getenv("DATABASE_URL_RAILWAY")
+
+# Настройки пула (можно переопределить через переменные окружения Railway)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10"))
+# Если соединение простаивало дольше этого времени — перед выдачей проверяем его через SELECT 1
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))
+
+
+class PoolTimeoutError(RuntimeError):
+    """Не удалось получить соединение из пула за acquire_timeout секунд."""
+
+
+class PooledConnection:
+    """
+    Обёртка над соединением psycopg2, которая возвращает соединение в пул вместо закрытия.
+    Позволяет оставить старый код (conn.close(), `with get_db_connection() as conn:`) без изменений.
+    """
+
+    __slots__ = ("_pool", "_conn", "_released")
+
+    def __init__(self, db_pool, conn):
+        self._pool = db_pool
+        self._conn = conn
+        self._released = False
+
+    @property
+    def raw(self):
+        return self._conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        """Возвращает соединение в пул (повторный вызов безопасен)."""
+        if not self._released:
+            self._released = True
+            self._pool.putconn(self._conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Как и в psycopg2: commit при успехе, rollback при ошибке.
+        # В отличие от psycopg2, после блока `with` соединение сразу возвращается в пул —
+        # старый код никогда не закрывал такие соединения явно.
+        try:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __del__(self):
+        # Страховка от утечек: забытое соединение всё равно вернётся в пул
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class DatabasePool:
+    """Потокобезопасный пул соединений с лимитом размера, таймаутом ожидания и проверкой здоровья."""
+
+    def __init__(self, dsn, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT, healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE):
+        if not dsn:
+            raise RuntimeError("DATABASE_URL не установлен.")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_idle = healthcheck_idle
+
+        self._pool = pg_pool.ThreadedConnectionPool(min_size, max_size, dsn, sslmode='require')
+        # ThreadedConnectionPool не умеет ждать освобождения — ограничиваем выдачу семафором
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._last_used = {}  # id(conn) -> time.monotonic() последнего возврата в пул
+
+        self._stats = {
+            "acquired": 0,
+            "released": 0,
+            "timeouts": 0,
+            "healthcheck_failures": 0,
+            "discarded": 0,
+            "in_use": 0,
+            "max_in_use": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+    # --- Выдача и возврат соединений ---
+
+    def getconn(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeoutError(f"❌ Нет свободных соединений в пуле за {timeout} сек (max={self.max_size})")
+
+        try:
+            conn = self._checkout_healthy()
+        except Exception:
+            self._slots.release()
+            raise
+
+        waited = time.monotonic() - started
+        with self._lock:
+            self._stats["acquired"] += 1
+            self._stats["in_use"] += 1
+            self._stats["max_in_use"] = max(self._stats["max_in_use"], self._stats["in_use"])
+            self._stats["wait_time_total"] += waited
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+        return conn
+
+    def _checkout_healthy(self):
+        # Несколько попыток: «мёртвое» соединение выбрасываем и берём следующее
+        for _ in range(self.max_size + 1):
+            conn = self._pool.getconn()
+            if self._is_healthy(conn):
+                return conn
+            with self._lock:
+                self._stats["healthcheck_failures"] += 1
+                self._stats["discarded"] += 1
+                self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("❌ Не удалось получить рабочее соединение из пула")
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logging.warning(f"⚠️ Соединение из пула не прошло проверку: {e}")
+            return False
+
+    def putconn(self, conn, close=False):
+        discard = close or conn.closed
+        if not discard:
+            try:
+                # Возвращаем соединение в чистом состоянии: без открытой транзакции и с autocommit по умолчанию
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось сбросить соединение перед возвратом в пул: {e}")
+                discard = True
+
+        with self._lock:
+            self._stats["released"] += 1
+            self._stats["in_use"] -= 1
+            if discard:
+                self._stats["discarded"] += 1
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=discard)
+        finally:
+            self._slots.release()
+
+    # --- Удобные обёртки ---
+
+    def connection(self, timeout=None):
+        """Соединение-обёртка: close() возвращает его в пул."""
+        return PooledConnection(self, self.getconn(timeout))
+
+    @contextmanager
+    def transaction(self, timeout=None):
+        """Контекстный менеджер: commit при успехе, rollback при ошибке, затем возврат в пул."""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.putconn(conn)
+
+    @asynccontextmanager
+    async def transaction_async(self, timeout=None):
+        """
+        Асинхронный вариант transaction(): ожидание свободного соединения и проверка здоровья
+        выполняются в отдельном потоке и не блокируют event loop.
+        """
+        conn = await asyncio.to_thread(self.getconn, timeout)
+        try:
+            yield conn
+            await asyncio.to_thread(conn.commit)
+        except BaseException:
+            await asyncio.to_thread(conn.rollback)
+            raise
+        finally:
+            await asyncio.to_thread(self.putconn, conn)
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["min_size"] = self.min_size
+        snapshot["max_size"] = self.max_size
+        snapshot["idle"] = len(self._pool._pool)
+        snapshot["avg_wait_time"] = (
+            snapshot["wait_time_total"] / snapshot["acquired"] if snapshot["acquired"] else 0.0
+        )
+        return snapshot
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+# --- Глобальный пул (создаётся лениво при первом обращении) ---
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_pool() -> DatabasePool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DatabasePool(DATABASE_URL)
+                logging.info(f"✅ Пул соединений создан (min={_db_pool.min_size}, max={_db_pool.max_size})")
+    return _db_pool
+
+
+def get_pooled_connection(timeout=None) -> PooledConnection:
+    """Замена psycopg2.connect(DATABASE_URL, sslmode='require'): conn.close() возвращает соединение в пул."""
+    return get_pool().connection(timeout)
+
+
+@contextmanager
+def get_db_connection_context():
+    """Контекстный менеджер для соединения с базой данных PostgreSQL (через общий пул)."""
+    with get_pool().transaction() as conn:
+        yield conn
+
+
+def get_pool_stats() -> dict:
+    return get_pool().stats() if _db_pool is not None else {}
+
+
+def close_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+            logging.info("🔌 Пул соединений закрыт.")
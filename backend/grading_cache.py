@@ -0,0 +1,124 @@
+# grading_cache.py
+# Кэш результатов проверки переводов и объяснений.
+# Предложения часто повторяются (повтор ошибок из bt_3_detailed_mistakes, общая bt_3_sentences),
+# и пользователи нередко присылают одинаковые переводы. Вместо нового запроса к модели
+# берём готовый результат: сначала из LRU в памяти процесса, затем из таблицы bt_3_grading_cache.
+# Ключ включает версию промпта и модели — после правки инструкции старые записи просто перестают находиться.
+import os
+import re
+import json
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+
+try:
+    from backend import metrics
+    from backend.async_db import db_fetchone, db_execute
+    from backend.openai_manager import system_message
+    from backend.llm_gateway import LLM_MODEL
+except ImportError:
+    import metrics
+    from async_db import db_fetchone, db_execute
+    from openai_manager import system_message
+    from llm_gateway import LLM_MODEL
+
+GRADING_CACHE_ENABLED = os.getenv("GRADING_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+GRADING_CACHE_LRU_SIZE = int(os.getenv("GRADING_CACHE_LRU_SIZE", "2048"))
+# Регистр по умолчанию НЕ игнорируем: в немецком заглавная буква существительного — часть оценки
+GRADING_CACHE_CASEFOLD = os.getenv("GRADING_CACHE_CASEFOLD", "false").lower() in ("1", "true", "yes")
+
+_lru = OrderedDict()
+
+
+def normalize_text(text: str) -> str:
+    """NFC, одинарные пробелы, без пробелов по краям (и casefold, если включён GRADING_CACHE_CASEFOLD)."""
+    text = unicodedata.normalize("NFC", text or "")
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.casefold() if GRADING_CACHE_CASEFOLD else text
+
+
+def prompt_version(instruction_key: str) -> str:
+    """Короткий хэш текста инструкции и модели."""
+    instructions = system_message.get(instruction_key, "")
+    return hashlib.sha256(f"{LLM_MODEL}\n{instructions}".encode("utf-8")).hexdigest()[:16]
+
+
+def make_cache_key(kind: str, instruction_key: str, original_text: str, user_translation: str) -> tuple[str, str]:
+    """Возвращает (cache_key, prompt_version)."""
+    version = prompt_version(instruction_key)
+    raw = "\x1f".join((kind, version, normalize_text(original_text), normalize_text(user_translation)))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest(), version
+
+
+def _lru_get(key):
+    value = _lru.get(key)
+    if value is not None:
+        _lru.move_to_end(key)
+    return value
+
+
+def _lru_put(key, value):
+    _lru[key] = value
+    _lru.move_to_end(key)
+    while len(_lru) > GRADING_CACHE_LRU_SIZE:
+        _lru.popitem(last=False)
+
+
+async def get_cached(kind: str, instruction_key: str, original_text: str, user_translation: str):
+    """
+    Ищет готовый результат. Возвращает payload (dict/str, как его сохранили) или None.
+    Ошибки БД не мешают проверке — просто считаем это промахом.
+    """
+    if not GRADING_CACHE_ENABLED:
+        return None
+    key, _ = make_cache_key(kind, instruction_key, original_text, user_translation)
+
+    payload = _lru_get(key)
+    if payload is not None:
+        metrics.inc("grading_cache_total", kind=kind, result="lru_hit")
+        return payload
+
+    try:
+        row = await db_fetchone("grading_cache_get", """
+            UPDATE bt_3_grading_cache
+            SET hits = hits + 1, last_hit_at = NOW()
+            WHERE cache_key = %s
+            RETURNING payload;
+        """, (key,))
+    except Exception as e:
+        logging.warning(f"⚠️ Кэш проверки недоступен: {e}")
+        row = None
+
+    if row is None:
+        metrics.inc("grading_cache_total", kind=kind, result="miss")
+        return None
+
+    payload = row[0]
+    _lru_put(key, payload)
+    metrics.inc("grading_cache_total", kind=kind, result="db_hit")
+    return payload
+
+
+async def put_cached(kind: str, instruction_key: str, original_text: str, user_translation: str, payload) -> None:
+    """Сохраняет результат в LRU и в bt_3_grading_cache."""
+    if not GRADING_CACHE_ENABLED:
+        return
+    key, version = make_cache_key(kind, instruction_key, original_text, user_translation)
+    _lru_put(key, payload)
+    try:
+        await db_execute("grading_cache_put", """
+            INSERT INTO bt_3_grading_cache (cache_key, kind, prompt_version, payload)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO UPDATE SET payload = EXCLUDED.payload;
+        """, (key, kind, version, json.dumps(payload, ensure_ascii=False)))
+    except Exception as e:
+        logging.warning(f"⚠️ Не удалось сохранить результат в кэш: {e}")
+
+
+def hit_rate(kind: str) -> float | None:
+    """Доля попаданий (LRU + БД) для вида записи или None, если обращений ещё не было."""
+    hits = metrics.get_counter("grading_cache_total", kind=kind, result="lru_hit") \
+        + metrics.get_counter("grading_cache_total", kind=kind, result="db_hit")
+    total = hits + metrics.get_counter("grading_cache_total", kind=kind, result="miss")
+    return hits / total if total else None
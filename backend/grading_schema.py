@@ -0,0 +1,198 @@
+# grading_schema.py
+# Типизированный результат проверки перевода и его разбор.
+# Модель просим отвечать строгим JSON по схеме GRADING_JSON_SCHEMA. Если ответ всё же «поплыл»
+# (обёрнут в ```json, обрезан, пришёл в старом текстовом формате Score:/Mistake Categories:/...),
+# parse_grading_response чинит его локально, а не запрашивает всю проверку заново.
+import re
+import json
+import logging
+from dataclasses import dataclass, field
+
+try:
+    from backend import metrics
+    from backend.config_mistakes_data import VALID_CATEGORIES, VALID_SUBCATEGORIES
+except ImportError:
+    import metrics
+    from config_mistakes_data import VALID_CATEGORIES, VALID_SUBCATEGORIES
+
+# Словари для регистронезависимой проверки: lower -> каноническое написание
+_CATEGORY_BY_LOWER = {cat.lower(): cat for cat in VALID_CATEGORIES}
+_SUBCATEGORY_BY_LOWER = {
+    cat: {sub.lower(): sub for sub in subs} for cat, subs in VALID_SUBCATEGORIES.items()
+}
+# Подкатегория -> категории, к которым она относится (нужно, когда модель прислала подкатегорию без пары)
+_CATEGORIES_BY_SUBCATEGORY = {}
+for _cat, _subs in VALID_SUBCATEGORIES.items():
+    for _sub in _subs:
+        _CATEGORIES_BY_SUBCATEGORY.setdefault(_sub.lower(), []).append(_cat)
+
+_ALL_SUBCATEGORIES = sorted({sub for subs in VALID_SUBCATEGORIES.values() for sub in subs})
+
+# Схема для response_format={"type": "json_schema", "strict": True}.
+# В строгом режиме нельзя задать minimum/maximum — диапазон score проверяем сами.
+GRADING_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "integer"},
+        "mistakes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "category": {"type": "string", "enum": list(VALID_CATEGORIES)},
+                    "subcategory": {"type": "string", "enum": _ALL_SUBCATEGORIES},
+                },
+                "required": ["category", "subcategory"],
+                "additionalProperties": False,
+            },
+        },
+        "correct_translation": {"type": "string"},
+    },
+    "required": ["score", "mistakes", "correct_translation"],
+    "additionalProperties": False,
+}
+
+
+@dataclass
+class GradingResult:
+    """Результат проверки одного перевода."""
+    score: int
+    correct_translation: str
+    mistakes: list = field(default_factory=list)  # [(category, subcategory), ...] — только валидные пары
+    repaired: bool = False  # ответ пришлось чинить локально
+
+    @property
+    def categories(self) -> list[str]:
+        return list(dict.fromkeys(cat for cat, _ in self.mistakes))
+
+    @property
+    def subcategories(self) -> list[str]:
+        return list(dict.fromkeys(sub for _, sub in self.mistakes))
+
+
+def normalize_mistake(category, subcategory):
+    """Возвращает каноническую пару (category, subcategory) или None, если пара не из config_mistakes_data."""
+    sub_lower = str(subcategory or "").strip().lower()
+    category = _CATEGORY_BY_LOWER.get(str(category or "").strip().lower())
+    if category and sub_lower in _SUBCATEGORY_BY_LOWER[category]:
+        return category, _SUBCATEGORY_BY_LOWER[category][sub_lower]
+    # Категория перепутана, но подкатегория однозначна — восстанавливаем категорию
+    owners = _CATEGORIES_BY_SUBCATEGORY.get(sub_lower, [])
+    if len(owners) == 1:
+        return owners[0], _SUBCATEGORY_BY_LOWER[owners[0]][sub_lower]
+    return None
+
+
+def _parse_score(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        score = int(value)
+    else:
+        match = re.search(r"-?\d+", str(value or ""))
+        if not match:
+            return None
+        score = int(match.group(0))
+    return max(0, min(100, score))
+
+
+def _load_json_object(text):
+    """Пытается достать JSON-объект из текста. Возвращает (dict | None, был_ли_ремонт)."""
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data, False
+    except (TypeError, ValueError):
+        pass
+
+    # ```json ... ``` и текст вокруг объекта
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1:
+        return None, True
+    candidate = text[start:end + 1] if end > start else text[start:] + "}"
+    # Висячие запятые перед } и ]
+    candidate = re.sub(r",\s*([}\]])", r"\1", candidate)
+    for attempt in (candidate, candidate + "]}", candidate + "}"):
+        try:
+            data = json.loads(attempt)
+            if isinstance(data, dict):
+                return data, True
+        except ValueError:
+            continue
+    return None, True
+
+
+def _from_json(data):
+    score = _parse_score(data.get("score"))
+    correct_translation = str(data.get("correct_translation") or "").strip()
+    raw_mistakes = data.get("mistakes") or []
+    mistakes = []
+    dropped = False
+    for item in raw_mistakes if isinstance(raw_mistakes, list) else []:
+        if isinstance(item, dict):
+            pair = normalize_mistake(item.get("category"), item.get("subcategory"))
+        elif isinstance(item, (list, tuple)) and len(item) == 2:
+            pair = normalize_mistake(*item)
+        else:
+            pair = None
+        if pair is None:
+            dropped = True
+        elif pair not in mistakes:
+            mistakes.append(pair)
+    return score, correct_translation, mistakes, dropped
+
+
+def _from_legacy_text(text):
+    """Старый формат: Score: X/100, Mistake Categories: ..., Subcategories: ..., Correct Translation: ..."""
+    score_match = re.search(r"Score:\s*\**\s*(\d+)", text, flags=re.IGNORECASE)
+    score = _parse_score(score_match.group(1)) if score_match else None
+    translation_match = re.search(r"Correct Translation:\s*\**\s*(.+?)(?:\n|\Z)", text, flags=re.IGNORECASE)
+    correct_translation = translation_match.group(1).strip().strip("*").strip() if translation_match else ""
+
+    def comma_list(label):
+        match = re.search(label + r":\s*(.+?)(?:\n|\Z)", text, flags=re.IGNORECASE)
+        if not match:
+            return []
+        return [re.sub(r"[^0-9a-zA-Z\s+\-–]", "", part).strip() for part in match.group(1).split(",") if part.strip()]
+
+    categories = comma_list("Mistake Categories")
+    subcategories = comma_list("Subcategories")
+    mistakes = []
+    # Пары в тексте не указаны — берём те сочетания, которые допустимы по config_mistakes_data
+    for sub in subcategories:
+        pair = None
+        for cat in categories:
+            pair = normalize_mistake(cat, sub)
+            if pair and pair[0].lower() == cat.lower():
+                break
+            pair = None
+        pair = pair or normalize_mistake(None, sub)
+        if pair and pair not in mistakes:
+            mistakes.append(pair)
+    return score, correct_translation, mistakes
+
+
+def parse_grading_response(text, expect_json=True) -> GradingResult | None:
+    """
+    Разбирает ответ модели. Возвращает GradingResult или None, если в ответе нет оценки
+    или правильного перевода (тогда ответ нужно запросить заново).
+    Пишет счётчик grading_parse_total{outcome=clean|repaired|failed}.
+    :param expect_json: False, если модель просили отвечать в старом текстовом формате —
+        тогда разбор текста не считается ремонтом.
+    """
+    text = (text or "").strip()
+    data, repaired = _load_json_object(text) if expect_json or text.startswith("{") else (None, False)
+    if data is not None:
+        score, correct_translation, mistakes, dropped = _from_json(data)
+        repaired = repaired or dropped
+    else:
+        score, correct_translation, mistakes = _from_legacy_text(text)
+        repaired = expect_json
+
+    if score is None or not correct_translation:
+        metrics.inc("grading_parse_total", outcome="failed")
+        logging.warning(f"⚠️ Не удалось разобрать ответ проверки: {text[:200]!r}")
+        return None
+
+    metrics.inc("grading_parse_total", outcome="repaired" if repaired else "clean")
+    return GradingResult(score=score, correct_translation=correct_translation, mistakes=mistakes, repaired=repaired)
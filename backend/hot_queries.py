@@ -0,0 +1,143 @@
+# hot_queries.py
+# Горячие запросы бота одним списком констант: их выполняют обработчики (bot_3.py, load_data_from_db.py, api.py),
+# и по этим же строкам backend/indexes.py проверяет планы — проверяется ровно тот SQL, который уходит в БД.
+# Все условия по времени — полуинтервалы (x >= начало AND x < конец), чтобы работали индексы по столбцу.
+try:
+    from backend.rollups import REPORT_COLUMNS_SQL
+except ImportError:
+    from rollups import REPORT_COLUMNS_SQL
+
+# --- Сессии (letsgo, done, force_finalize_sessions) ---
+
+# Условие «сессия начата сегодня» — для rollups.close_sessions и проверки открытой сессии
+TODAY_SESSIONS_WHERE = "start_time >= CURRENT_DATE AND start_time < CURRENT_DATE + 1"
+
+OPEN_SESSION_TODAY_SQL = f"""
+    SELECT user_id FROM bt_3_user_progress
+    WHERE user_id = %s AND completed = FALSE AND {TODAY_SESSIONS_WHERE};
+"""
+
+ACTIVE_SESSION_SQL = """
+    SELECT session_id
+    FROM bt_3_user_progress
+    WHERE user_id = %s AND completed = FALSE
+    ORDER BY start_time DESC
+    LIMIT 1;
+"""
+
+# --- Проверка переводов ---
+
+SENTENCES_TODAY_SQL = """
+    SELECT unique_id, session_id FROM bt_3_daily_sentences WHERE date = CURRENT_DATE AND user_id = %s;
+"""
+
+TRANSLATION_SAVED_TODAY_SQL = """
+    SELECT id FROM bt_3_translations
+    WHERE user_id = %s AND sentence_id = %s AND timestamp >= CURRENT_DATE AND timestamp < CURRENT_DATE + 1;
+"""
+
+# --- Отчёты (rate_mistakes, user_stats, api.py) ---
+
+WEEK_TRANSLATIONS_COUNT_SQL = """
+    SELECT COUNT(sentence_id)
+    FROM bt_3_translations
+    WHERE user_id = %s AND timestamp >= NOW() - INTERVAL '6 days';
+"""
+
+# Параметры: (user_id, user_id, user_id, user_id)
+WEEK_MISTAKES_KPI_SQL = """
+    WITH user_mistakes AS (
+        SELECT COUNT(*) AS mistakes_week
+        FROM bt_3_detailed_mistakes
+        WHERE user_id = %s
+        AND added_data >= NOW() - INTERVAL '6 days'
+    ),
+    top_category AS (
+        SELECT main_category
+        FROM bt_3_detailed_mistakes
+        WHERE user_id = %s
+        AND added_data >= NOW() - INTERVAL '6 days'
+        GROUP BY main_category
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    ),
+    number_of_topcategory_mist AS (
+        SELECT main_category, COUNT(*) AS number_of_top_category_mistakes
+        FROM bt_3_detailed_mistakes
+        WHERE user_id = %s
+        AND added_data >= NOW() - INTERVAL '6 days'
+        AND main_category = (SELECT main_category FROM top_category)
+        GROUP BY main_category
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    ),
+    top_two_subcategories AS (
+        SELECT sub_category, 
+            COUNT(*) AS count,
+            ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) AS subcategory_rank
+        FROM bt_3_detailed_mistakes 
+        WHERE user_id = %s
+        AND added_data >= NOW() - INTERVAL '6 days'
+        AND main_category = (SELECT main_category FROM top_category)
+        GROUP BY sub_category
+        ORDER BY COUNT(*) DESC
+        LIMIT 2
+    )
+    -- ✅ FINAL QUERY WITH LEFT JOIN TO AVOID EMPTY RESULTS
+    SELECT 
+        COALESCE((SELECT mistakes_week FROM user_mistakes), 0) AS mistakes_week,
+        COALESCE(ntc.main_category, 'неизвестно') AS top_mistake_category,
+        COALESCE(ntc.number_of_top_category_mistakes, 0) AS number_of_top_category_mistakes,
+        COALESCE(MAX(CASE WHEN tts.subcategory_rank = 1 THEN tts.sub_category END), 'неизвестно') AS top_subcategory_1,
+        COALESCE(MAX(CASE WHEN tts.subcategory_rank = 2 THEN tts.sub_category END), 'неизвестно') AS top_subcategory_2
+    FROM number_of_topcategory_mist ntc
+    LEFT JOIN top_two_subcategories tts ON TRUE
+    GROUP BY ntc.main_category, ntc.number_of_top_category_mistakes;
+"""
+
+USER_STATS_TODAY_SQL = f"""
+    SELECT translated, {REPORT_COLUMNS_SQL}
+    FROM bt_3_daily_rollups
+    WHERE user_id = %s AND day = CURRENT_DATE AND translated > 0;
+"""
+
+TOP_MISTAKES_SQL = """
+    SELECT main_category, sub_category, COUNT(*) as error_count
+    FROM bt_3_detailed_mistakes
+    WHERE user_id = %s AND last_seen >= NOW() - INTERVAL '120 days'
+    GROUP BY main_category, sub_category
+    ORDER BY error_count DESC
+    LIMIT 2;
+"""
+
+# --- Аналитика за период (load_data_for_analytics), параметры: (user_id, start_date, end_date) ---
+
+ANALYTICS_ATTEMPTS_SQL = """
+    SELECT user_id, id_for_mistake_table, attempt FROM bt_3_attempts
+    WHERE user_id = %s AND timestamp >= %s::date AND timestamp < %s::date + 1;
+"""
+
+ANALYTICS_PROGRESS_SQL = """
+    SELECT session_id, username, start_time, end_time FROM bt_3_user_progress
+    WHERE user_id = %s AND end_time >= %s::date AND end_time < %s::date + 1;
+"""
+
+ANALYTICS_TRANSLATIONS_SQL = """
+    SELECT session_id, username, sentence_id, score, timestamp FROM bt_3_translations
+    WHERE user_id = %s AND timestamp >= %s::date AND timestamp < %s::date + 1;
+"""
+
+ANALYTICS_SUCCESS_SQL = """
+    SELECT sentence_id, score, attempt, date FROM bt_3_successful_translations
+    WHERE user_id = %s AND date >= %s::date AND date < %s::date + 1;
+"""
+
+ANALYTICS_MISTAKES_SQL = """
+    SELECT sentence_id, score FROM bt_3_detailed_mistakes
+    WHERE user_id = %s AND added_data >= %s::date AND added_data < %s::date + 1;
+"""
+
+ANALYTICS_SENTENCES_SQL = """
+    SELECT date, id, session_id, user_id, id_for_mistake_table FROM bt_3_daily_sentences
+    WHERE user_id = %s AND date BETWEEN %s AND %s;
+"""
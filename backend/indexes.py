@@ -0,0 +1,102 @@
+# indexes.py
+# Проверка планов «горячих» запросов.
+# Условия вида timestamp::date = CURRENT_DATE не могут использовать обычный индекс по столбцу, поэтому
+# запросы переписаны на полуинтервалы (timestamp >= CURRENT_DATE AND timestamp < CURRENT_DATE + 1),
+# а составные и частичные индексы под них создаёт миграция 0011_hot_query_indexes (backend/migrations.py).
+# Проверяются те же SQL-константы, что выполняют обработчики (backend/hot_queries.py).
+# Проверка планов (регрессионный тест — код выхода 1, если горячий запрос ушёл в Seq Scan):
+#   python -m backend.indexes
+# Отдельный шаг деплоя после миграций (или python -m backend.migrations --check-plans); при старте бота не выполняется.
+import sys
+import json
+import logging
+from datetime import date, timedelta
+
+try:
+    from backend import hot_queries as hot_queries_sql
+    from backend.db_pool import get_pool
+except ImportError:
+    import hot_queries as hot_queries_sql
+    from db_pool import get_pool
+
+
+def hot_queries(today: date = None) -> dict:
+    """
+    {имя: (sql, параметры)} — те же константы, что выполняют обработчики (backend/hot_queries.py),
+    с типичными параметрами. Даты считаются в момент проверки, а не при импорте.
+    """
+    today = today or date.today()
+    week = (1, today - timedelta(days=7), today)
+    return {
+        "letsgo_open_session_today": (hot_queries_sql.OPEN_SESSION_TODAY_SQL, (1,)),
+        "done_active_session": (hot_queries_sql.ACTIVE_SESSION_SQL, (1,)),
+        "force_finalize_open_sessions": (
+            f"SELECT session_id FROM bt_3_user_progress "
+            f"WHERE completed = FALSE AND ({hot_queries_sql.TODAY_SESSIONS_WHERE});", ()
+        ),
+        "translation_already_saved": (hot_queries_sql.TRANSLATION_SAVED_TODAY_SQL, (1, 1)),
+        "sentences_today": (hot_queries_sql.SENTENCES_TODAY_SQL, (1,)),
+        "rate_mistakes_translations": (hot_queries_sql.WEEK_TRANSLATIONS_COUNT_SQL, (1,)),
+        "rate_mistakes_week": (hot_queries_sql.WEEK_MISTAKES_KPI_SQL, (1, 1, 1, 1)),
+        "top_mistakes_last_seen": (hot_queries_sql.TOP_MISTAKES_SQL, (1,)),
+        "analytics_attempts": (hot_queries_sql.ANALYTICS_ATTEMPTS_SQL, week),
+        "analytics_progress": (hot_queries_sql.ANALYTICS_PROGRESS_SQL, week),
+        "analytics_translations": (hot_queries_sql.ANALYTICS_TRANSLATIONS_SQL, week),
+        "analytics_successful": (hot_queries_sql.ANALYTICS_SUCCESS_SQL, week),
+        "analytics_mistakes": (hot_queries_sql.ANALYTICS_MISTAKES_SQL, week),
+        "analytics_sentences": (hot_queries_sql.ANALYTICS_SENTENCES_SQL, week),
+        "user_stats_today": (hot_queries_sql.USER_STATS_TODAY_SQL, (1,)),
+    }
+
+
+def _seq_scans(plan):
+    """Таблицы, которые план читает последовательным сканированием (обход дерева EXPLAIN FORMAT JSON)."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+def find_seq_scans(cursor, queries=None) -> dict:
+    """
+    Возвращает {имя запроса: [таблицы с Seq Scan]} для горячих запросов.
+    enable_seqscan = off: на маленькой тестовой таблице планировщик и так выбрал бы Seq Scan,
+    а с выключенным — выберет его, только если подходящего индекса нет.
+    """
+    cursor.execute("SET LOCAL enable_seqscan = off;")
+    failures = {}
+    for name, (sql, params) in (queries or hot_queries()).items():
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        tables = _seq_scans(plan[0]["Plan"])
+        if tables:
+            failures[name] = tables
+    return failures
+
+
+def check_query_plans() -> dict:
+    """Проверяет планы горячих запросов и пишет в лог каждый Seq Scan. Возвращает failures."""
+    queries = hot_queries()
+    with get_pool().transaction() as conn:
+        with conn.cursor() as cursor:
+            failures = find_seq_scans(cursor, queries)
+
+    for name, tables in failures.items():
+        logging.error(f"❌ {name}: Seq Scan по {', '.join(tables)}")
+    if not failures:
+        logging.info(f"✅ Все {len(queries)} горячих запросов используют индексы")
+    return failures
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if check_query_plans():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# leaderboards.py
+# Таблицы лидеров за неделю и за месяц — материализованные представления поверх bt_3_daily_rollups.
+# send_weekly_summary и недельный блок user_stats раньше на каждый вызов делали GROUP BY по bt_3_translations
+# с двумя коррелированными COUNT(*) по bt_3_daily_sentences на строку и JOIN к агрегату bt_3_user_progress.
+# Теперь планировщик раз в LEADERBOARD_REFRESH_MINUTES обновляет представления (CONCURRENTLY — чтение
+# не блокируется), а обработчики читают готовые строки. Итоговый балл считает bt_3_final_score (rollups.py).
+import os
+import logging
+
+try:
+    from backend import metrics
+    from backend.async_db import db_transaction
+except ImportError:
+    import metrics
+    from async_db import db_transaction
+
+LEADERBOARD_REFRESH_MINUTES = int(os.getenv("LEADERBOARD_REFRESH_MINUTES", "10"))
+
+# Период -> (представление, условие на day)
+LEADERBOARD_PERIODS = {
+    "week": ("bt_3_leaderboard_week", "day >= CURRENT_DATE - 6"),
+    "month": ("bt_3_leaderboard_month", "day >= date_trunc('month', CURRENT_DATE)::date"),
+}
+
+_VIEW_SQL = """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS {view} AS
+    SELECT
+        user_id,
+        username,
+        translated,
+        avg_score,
+        avg_minutes,
+        total_minutes,
+        missed,
+        bt_3_final_score(avg_score, avg_minutes, missed) AS final_score,
+        RANK() OVER (ORDER BY bt_3_final_score(avg_score, avg_minutes, missed) DESC) AS place
+    FROM (
+        SELECT
+            user_id,
+            (ARRAY_AGG(username ORDER BY day DESC) FILTER (WHERE username IS NOT NULL))[1] AS username,
+            SUM(translated) AS translated,
+            COALESCE(SUM(score_sum)::float / NULLIF(SUM(translated), 0), 0) AS avg_score,
+            COALESCE(SUM(session_minutes_sum) / NULLIF(SUM(sessions_completed), 0), 0) AS avg_minutes,
+            SUM(session_minutes_sum) AS total_minutes,
+            GREATEST(0, SUM(sentences_total) - SUM(translated)) AS missed
+        FROM bt_3_daily_rollups
+        WHERE {period_filter}
+        GROUP BY user_id
+        HAVING SUM(translated) > 0
+    ) t;
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_{view}_user ON {view} (user_id);
+"""
+
+CREATE_LEADERBOARDS_SQL = "".join(
+    _VIEW_SQL.format(view=view, period_filter=period_filter)
+    for view, period_filter in LEADERBOARD_PERIODS.values()
+)
+
+
+def _view(period):
+    if period not in LEADERBOARD_PERIODS:
+        raise ValueError(f"Неизвестный период таблицы лидеров: {period}")
+    return LEADERBOARD_PERIODS[period][0]
+
+
+def refresh_leaderboards_sync(cursor, periods=None) -> None:
+    """Обновляет представления без блокировки чтения (нужен уникальный индекс uq_<view>_user)."""
+    for period in periods or LEADERBOARD_PERIODS:
+        view = _view(period)
+        with metrics.timer("leaderboard_refresh_seconds", period=period):
+            cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view};")
+
+
+async def refresh_leaderboards(context=None, periods=None) -> None:
+    """Плановая задача: обновить таблицы лидеров."""
+    try:
+        await db_transaction("leaderboard_refresh", refresh_leaderboards_sync, periods)
+    except Exception as e:
+        logging.error(f"❌ Не удалось обновить таблицы лидеров: {e}", exc_info=True)
+
+
+def load_leaderboard(cursor, period: str, user_id=None):
+    """
+    Строки таблицы лидеров (лучшие первыми):
+    (user_id, username, переведено, средняя оценка, среднее время, общее время, пропущено, итоговый балл, место).
+    Если передан user_id — только строка этого пользователя.
+    """
+    view = _view(period)
+    where_sql, params = ("WHERE user_id = %s", (user_id,)) if user_id is not None else ("", ())
+    cursor.execute(f"""
+        SELECT user_id, username, translated, avg_score, avg_minutes, total_minutes, missed, final_score, place
+        FROM {view}
+        {where_sql}
+        ORDER BY place, user_id;
+    """, params)
+    return cursor.fetchall()
@@ -0,0 +1,142 @@
+# llm_gateway.py
+# Единая точка вызова LLM для бота: один потоковый запрос chat.completions вместо цепочки
+# Assistants API (threads.create → messages.create → runs.create → опрос runs.retrieve → messages.list → threads.delete).
+# Системные инструкции берутся из того же словаря system_message в openai_manager.py,
+# поэтому промпты остаются в одном месте.
+import os
+import json
+import time
+import logging
+
+try:
+    from backend import metrics
+    from backend.openai_manager import client, system_message
+    from backend.openai_guard import guarded_call, estimate_tokens, record_token_usage
+    from backend.singleflight import single_flight
+except ImportError:
+    import metrics
+    from openai_manager import client, system_message
+    from openai_guard import guarded_call, estimate_tokens, record_token_usage
+    from singleflight import single_flight
+
+# Модель по умолчанию — та же, что использовали ассистенты
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4.1-2025-04-14")
+# Потоковый режим можно отключить переменной окружения (например, при отладке прокси)
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() in ("1", "true", "yes")
+
+
+def build_messages(instruction_key: str, user_message: str) -> list[dict]:
+    """Собирает messages для chat.completions из ключа system_message и текста пользователя."""
+    instructions = system_message.get(instruction_key)
+    if not instructions:
+        raise ValueError(f"❌ Системная инструкция для ключа '{instruction_key}' не найдена в system_message.")
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": user_message},
+    ]
+
+
+async def complete(instruction_key: str, user_message: str, task_name: str = None, model: str = None,
+                   response_format: dict = None, temperature: float = None, max_tokens: int = None,
+                   coalesce: bool = False) -> str:
+    """
+    Один запрос к модели. Возвращает полный текст ответа.
+    Пишет метрики llm_ttft_seconds (время до первого токена), llm_latency_seconds и llm_requests_total.
+    Запрос идёт через openai_guard: бюджет модели, повторы с джиттером, circuit breaker.
+    Если breaker открыт — CircuitOpenError; прочие исключения openai пробрасываются после повторов.
+    :param instruction_key: Ключ словаря system_message.
+    :param task_name: Имя задачи для метрик (по умолчанию равно instruction_key).
+    :param response_format: Например {"type": "json_schema", ...} для структурированного ответа.
+    :param coalesce: Одинаковые одновременные запросы объединяются в один (backend/singleflight.py).
+    """
+    task_name = task_name or instruction_key
+    if coalesce:
+        key_parts = (instruction_key, model or LLM_MODEL, user_message, json.dumps(response_format, sort_keys=True),
+                     temperature, max_tokens)
+        return await single_flight(task_name, key_parts, lambda: complete(
+            instruction_key, user_message, task_name=task_name, model=model, response_format=response_format,
+            temperature=temperature, max_tokens=max_tokens,
+        ))
+    messages = build_messages(instruction_key, user_message)
+    model = model or LLM_MODEL
+    params = {
+        "model": model,
+        "messages": messages,
+    }
+    if response_format is not None:
+        params["response_format"] = response_format
+    if temperature is not None:
+        params["temperature"] = temperature
+    if max_tokens is not None:
+        params["max_tokens"] = max_tokens
+    estimated = estimate_tokens(*(m["content"] for m in messages), completion_tokens=max_tokens or 500)
+
+    async def request():
+        # Каждая попытка — заново с первого чанка
+        if not LLM_STREAMING:
+            response = await client.chat.completions.create(**params)
+            text = response.choices[0].message.content or ""
+            metrics.observe("llm_ttft_seconds", time.perf_counter() - started, task=task_name)
+            _record_usage(task_name, model, estimated, getattr(response, "usage", None))
+            return text
+
+        stream = await client.chat.completions.create(
+            **params, stream=True, stream_options={"include_usage": True}
+        )
+        parts = []
+        first_token_at = None
+        async for chunk in stream:
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        metrics.observe("llm_ttft_seconds", first_token_at - started, task=task_name)
+                    parts.append(delta)
+            # Последний чанк приходит без choices, но с usage (stream_options.include_usage)
+            _record_usage(task_name, model, estimated, getattr(chunk, "usage", None))
+        return "".join(parts)
+
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        return await guarded_call(model, request, estimated_tokens=estimated)
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("llm_latency_seconds", elapsed, task=task_name)
+        metrics.inc("llm_requests_total", task=task_name, status=status)
+        logging.info(f"⏱ LLM '{task_name}': {elapsed:.2f} сек ({status})")
+
+
+def _record_usage(task_name, model, estimated, usage):
+    if usage is None:
+        return
+    metrics.inc("llm_tokens_total", usage.prompt_tokens or 0, task=task_name, kind="prompt")
+    metrics.inc("llm_tokens_total", usage.completion_tokens or 0, task=task_name, kind="completion")
+    record_token_usage(model, estimated, (usage.prompt_tokens or 0) + (usage.completion_tokens or 0))
+
+
+async def complete_json(instruction_key: str, user_message: str, schema_name: str, schema: dict,
+                        task_name: str = None, **kwargs) -> dict:
+    """
+    Запрос со строгой JSON-схемой (structured outputs). Возвращает разобранный dict.
+    :raises json.JSONDecodeError: если модель всё же вернула невалидный JSON.
+    """
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {"name": schema_name, "schema": schema, "strict": True},
+    }
+    text = await complete(instruction_key, user_message, task_name=task_name, response_format=response_format, **kwargs)
+    return json.loads(text)
+
+
+async def run_assistant_task(instruction_key: str, user_message: str, task_name: str = None, coalesce: bool = False) -> str:
+    """
+    Замена связки get_or_create_openai_resources + thread/run/poll для старых мест вызова:
+    принимает тот же ключ инструкции и то же сообщение пользователя и возвращает текст ответа,
+    который раньше брали из messages.data[0].content[0].text.value.
+    """
+    return await complete(instruction_key, user_message, task_name=task_name, coalesce=coalesce)
@@ -0,0 +1,135 @@
+# metrics.py
+# Простейшие метрики внутри процесса: счётчики, gauge-значения и гистограммы задержек.
+# Снимок метрик периодически пишется в лог (см. log_performance_metrics в bot_3.py).
+import time
+import threading
+from contextlib import contextmanager
+
+# Границы корзин гистограммы в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: count, sum, max и оценка перцентилей."""
+
+    __slots__ = ("buckets", "bucket_counts", "count", "total", "max")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # последняя корзина — всё, что больше max(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        else:
+            self.bucket_counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Верхняя граница корзины, в которую попадает q-й перцентиль (q от 0 до 1)."""
+        if not self.count:
+            return 0.0
+        threshold = q * self.count
+        running = 0
+        for i, n in enumerate(self.bucket_counts):
+            running += n
+            if running >= threshold:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+        }
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Замеряет время выполнения блока и кладёт его в гистограмму `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def get_counter(name, **labels):
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def get_histogram(name, **labels):
+    with _lock:
+        histogram = _histograms.get(_key(name, labels))
+        return histogram.as_dict() if histogram else None
+
+
+def snapshot():
+    """Копия всех метрик: {"counters": {...}, "gauges": {...}, "histograms": {...}}."""
+    def label_str(name, labels):
+        return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+
+    with _lock:
+        return {
+            "counters": {label_str(n, l): v for (n, l), v in _counters.items()},
+            "gauges": {label_str(n, l): v for (n, l), v in _gauges.items()},
+            "histograms": {label_str(n, l): h.as_dict() for (n, l), h in _histograms.items()},
+        }
+
+
+def format_report(top=15):
+    """Короткий текстовый отчёт для логов: самые медленные гистограммы (по p95) и все счётчики."""
+    data = snapshot()
+    lines = []
+    slowest = sorted(data["histograms"].items(), key=lambda item: item[1]["p95"], reverse=True)[:top]
+    for name, h in slowest:
+        lines.append(
+            f"⏱ {name}: n={h['count']} avg={h['avg']*1000:.1f}ms p95≤{h['p95']*1000:.0f}ms max={h['max']*1000:.1f}ms"
+        )
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f"🔢 {name} = {value}")
+    for name, value in sorted(data["gauges"].items()):
+        lines.append(f"📏 {name} = {value}")
+    return "\n".join(lines)
@@ -0,0 +1,743 @@
+# migrations.py
+# Версионированные миграции схемы БД.
+# Раньше bot_3.py при каждом импорте заново выполнял десятки CREATE TABLE IF NOT EXISTS (initialise_database),
+# main() вызывал init_db() из database.py, а импорт модулей открывал отдельные соединения ради SELECT version().
+# Теперь изменения схемы — пронумерованные функции в MIGRATIONS, а применённые версии записаны в schema_version.
+# При старте бот только сверяет номер версии (один SELECT); недостающие миграции применяются
+# под advisory lock (DB_AUTO_MIGRATE=true, по умолчанию) или отдельной командой перед деплоем:
+#   python -m backend.migrations           — применить недостающие миграции и выйти
+#   python -m backend.migrations --check-plans — то же, затем проверить планы горячих запросов (код выхода 2)
+#   python -m backend.migrations --status  — показать текущую и ожидаемую версию
+# Новая миграция: функция _mNNNN_<имя>(curr) и строка в MIGRATIONS; старые миграции не редактируются.
+# DDL в миграциях записан как есть, а не через константы модулей (rollups, leaderboards, indexes):
+# правка константы не должна менять уже применённую миграцию — для этого пишется следующая.
+import os
+import sys
+import time
+import logging
+import argparse
+
+try:
+    from backend import metrics
+    from backend.db_pool import get_pool
+    from backend.indexes import check_query_plans
+except ImportError:
+    import metrics
+    from db_pool import get_pool
+    from indexes import check_query_plans
+
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() in ("1", "true", "yes")
+
+# Ключ pg_advisory_xact_lock: два экземпляра бота не применяют миграции одновременно
+_MIGRATION_LOCK_KEY = 8_330_240_001
+
+
+class SchemaVersionError(RuntimeError):
+    """Версия схемы БД не совпадает с ожидаемой кодом."""
+
+
+def _m0001_baseline(curr):
+    """Исходная схема бота — таблицы, которые создавал initialise_database() (все операции идемпотентны)."""
+
+    # Table with user translations with 80 or more points
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_successful_translations (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        sentence_id BIGINT,
+        score INT NOT NULL,
+        attempt INT NOT NULL,
+        date TIMESTAMP
+        );
+    """)  
+
+    # ✅ Таблица с оригинальными предложениями
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_sentences (
+                id SERIAL PRIMARY KEY,
+                sentence TEXT NOT NULL
+
+        );
+    """)
+
+    # ✅ Таблица для переводов пользователей
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_translations (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                id_for_mistake_table INT,
+                session_id BIGINT,
+                username TEXT,
+                sentence_id INT NOT NULL,
+                user_translation TEXT,
+                score INT,
+                feedback TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # ✅ Новая таблица для всех сообщений пользователей (чтобы учитывать ленивых)
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_messages (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL UNIQUE,
+                username TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # ✅ Таблица для ошибок пользователя при разговоре с агентом (Расширенная версия)
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_conversation_errors (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                session_id TEXT,          -- Важливо: ID сесії для звіту після дзвінка
+
+                -- Основні дані про помилку
+                sentence_with_error TEXT NOT NULL,
+                corrected_sentence TEXT NOT NULL,
+
+                -- Деталізація (як у bt_3_detailed_mistakes)
+                error_type TEXT,          -- Головна категорія (напр. Grammar)
+                error_subtype TEXT,       -- Підкатегорія (напр. Present Simple)
+                explanation_ru TEXT,      -- Пояснення російською
+                explanation_en TEXT,      -- Пояснення англійською (опціонально)
+
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    curr.execute("""
+        CREATE INDEX IF NOT EXISTS idx_voice_errors_user
+        ON bt_3_conversation_errors (user_id);
+    """)
+
+    curr.execute("""
+        CREATE INDEX IF NOT EXISTS idx_voice_errors_session
+        ON bt_3_conversation_errors (session_id);
+    """)
+
+    # ✅ Таблица для закладок пользователей (когда пользователь говорит агенту в процессе голосового звонка в комнате что он хочет сохранить эту фразу или слово)
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_bookmarks (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        session_id TEXT,
+        phrase TEXT NOT NULL,
+        context_note TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # ✅ Таблица daily_sentences
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_daily_sentences (
+                id SERIAL PRIMARY KEY,
+                date DATE NOT NULL DEFAULT CURRENT_DATE,
+                sentence TEXT NOT NULL,
+                unique_id INT NOT NULL,
+                user_id BIGINT,
+                session_id BIGINT,
+                id_for_mistake_table INT
+        );
+    """)
+
+    # ✅ Таблица user_progress
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_user_progress (
+            session_id BIGINT PRIMARY KEY,
+            user_id BIGINT,
+            username TEXT,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            completed BOOLEAN DEFAULT FALSE,
+            CONSTRAINT unique_user_session_bt_3 UNIQUE (user_id, start_time)
+        );
+    """)
+
+    # ✅ Таблица для хранения ошибок перевода
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_translation_errors (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                category TEXT NOT NULL CHECK (category IN ('Грамматика', 'Лексика', 'Падежи', 'Орфография', 'Синтаксис')),  
+                error_description TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # ✅ Таблица для хранения запасных предложений в случае отсутствия связи Или ошибки на стороне Open AI API
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_spare_sentences (
+            id SERIAL PRIMARY KEY,
+            sentence TEXT NOT NULL
+        );
+
+    """)
+
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_attempts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            id_for_mistake_table INT NOT NULL,
+            attempt INT DEFAULT 1,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+            CONSTRAINT unique_attempt UNIQUE (user_id, id_for_mistake_table)
+
+        );
+    """)
+
+    # таблица для хранения id assistant API Open AI
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS assistants(
+            task_name TEXT PRIMARY KEY,
+            assistant_id TEXT NOT NULL
+            );
+    """)
+
+
+    # ✅ Таблица для хранения ошибок
+    curr.execute("""
+            CREATE TABLE IF NOT EXISTS bt_3_detailed_mistakes (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                sentence TEXT NOT NULL,
+                added_data TIMESTAMP,
+                main_category TEXT CHECK (main_category IN (
+                    -- 🔹 Nouns
+                    'Nouns', 'Cases', 'Verbs', 'Tenses', 'Adjectives', 'Adverbs', 
+                    'Conjunctions', 'Prepositions', 'Moods', 'Word Order', 'Other mistake'
+                )),  
+                sub_category TEXT CHECK (sub_category IN (
+                    -- 🔹 Nouns
+                    'Gendered Articles', 'Pluralization', 'Compound Nouns', 'Declension Errors',
+
+                    -- 🔹 Cases
+                    'Nominative', 'Accusative', 'Dative', 'Genitive',
+                    'Akkusativ + Preposition', 'Dative + Preposition', 'Genitive + Preposition',
+
+                    -- 🔹 Verbs
+                    'Placement', 'Conjugation', 'Weak Verbs', 'Strong Verbs', 'Mixed Verbs', 
+                    'Separable Verbs', 'Reflexive Verbs', 'Auxiliary Verbs', 'Modal Verbs',
+                    'Verb Placement in Subordinate Clause',
+
+                    -- 🔹 Tenses
+                    'Present', 'Past', 'Simple Past', 'Present Perfect', 
+                    'Past Perfect', 'Future', 'Future 1', 'Future 2',
+                    'Plusquamperfekt Passive', 'Futur 1 Passive', 'Futur 2 Passive',
+
+                    -- 🔹 Adjectives
+                    'Endings', 'Weak Declension', 'Strong Declension', 'Mixed Declension', 
+                    'Placement', 'Comparative', 'Superlative', 'Incorrect Adjective Case Agreement',
+
+                    -- 🔹 Adverbs
+                    'Placement', 'Multiple Adverbs', 'Incorrect Adverb Usage',
+
+                    -- 🔹 Conjunctions
+                    'Coordinating', 'Subordinating', 'Incorrect Use of Conjunctions',
+
+                    -- 🔹 Prepositions
+                    'Accusative', 'Dative', 'Genitive', 'Two-way',
+                    'Incorrect Preposition Usage',
+
+                    -- 🔹 Moods
+                    'Indicative', 'Declarative', 'Interrogative', 'Imperative',
+                    'Subjunctive 1', 'Subjunctive 2',
+
+                    -- 🔹 Word Order
+                    'Standard', 'Inverted', 'Verb-Second Rule', 'Position of Negation',
+                    'Incorrect Order in Subordinate Clause', 'Incorrect Order with Modal Verb',
+
+                    -- 🔹 Other
+                    'Unclassified mistake' -- Для ошибок, которые не попали в категории
+                )),
+
+                mistake_count INT DEFAULT 1, -- Количество раз, когда ошибка была зафиксирована
+                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- Время первой фиксации ошибки
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- Время последнего появления ошибки
+                error_count_week INT DEFAULT 0, -- Количество ошибок за последнюю неделю
+                sentence_id INT,
+                correct_translation TEXT NOT NULL,
+                score INT,
+                attempt INT DEFAULT 1, 
+
+                -- ✅ Уникальный ключ для предотвращения дубликатов
+                CONSTRAINT for_mistakes_table_bt_3 UNIQUE (user_id, sentence, main_category, sub_category)
+            );
+
+    """)
+
+
+def _m0002_sales_assistant(cursor):
+    """Таблицы ассистента по продажам (раньше init_db() в database.py)."""
+    # 1. Таблица для клиентов
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS clients (
+            id SERIAL PRIMARY KEY,
+            first_name TEXT NOT NULL,
+            last_name TEXT,
+            system_id TEXT UNIQUE, -- Уникальный ID клиента в системе (если есть)
+            phone_number TEXT UNIQUE, -- Телефон клиента
+            email TEXT UNIQUE,
+            location TEXT, -- Город или регион клиента
+            manager_contact TEXT, -- Контакты ответственного менеджера
+            is_existing_client BOOLEAN DEFAULT FALSE, -- Признак, работает ли клиент с нами
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    logging.info("✅ Таблица 'clients' проверена/создана.")
+
+    # 2. Таблица для продуктов/услуг
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            description TEXT,
+            price DECIMAL(10, 2) NOT NULL, -- Цена продукта, 10 цифр всего, 2 после запятой
+            is_new BOOLEAN DEFAULT FALSE, -- Признак новинки
+            available_quantity INT DEFAULT 0, -- Доступное количество на складе
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    logging.info("✅ Таблица 'products' проверена/создана.")
+
+    # 3. Таблица для заказов
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id SERIAL PRIMARY KEY,
+            client_id INT REFERENCES clients(id), -- Внешний ключ на клиента
+            order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'pending', -- Статус заказа (pending, completed, cancelled)
+            total_amount DECIMAL(10, 2), -- Общая сумма заказа
+            order_details JSONB, -- Подробности заказа в JSON-формате (например, {"product_id": 1, "quantity": 2})
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    logging.info("✅ Таблица 'orders' проверена/создана.")
+
+    # Пример: Добавление базовых продуктов (для тестирования)
+    # Внимание: для реального использования, эти данные должны управляться через CRM/API
+    products_to_insert = [
+        ("LapTop ZenBook Pro", "The powerful Laptop for professionals, 16GB RAM, 1TB SSD", 1500.00, True, 100),
+        ("Smartphone UltraVision 2000", "Top smartphone with AI-camera and super detailed night mode", 999.99, False, 250),
+        ("Monitor ErgoView", "Energy saving 27 inch monitor with full HD", 450.50, False, 50),
+        ("Whireless earphones AirPods", "Earpods with noice cancellation and 30 hours autonomous working time", 120.00, True, 300)
+    ]
+    for name, description, price, is_new, quantity in products_to_insert:
+        cursor.execute("""
+            INSERT INTO products (name, description, price, is_new, available_quantity)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (name) DO UPDATE SET
+                description = EXCLUDED.description, -- специальное ключевое слово в PostgreSQL. Оно ссылается на значение, которое было бы вставлено, если бы конфликта не произошло. То есть, это значение description, которое вы пытались вставить в этой конкретной INSERT операции.
+                price = EXCLUDED.price,
+                is_new = EXCLUDED.is_new,
+                available_quantity = EXCLUDED.available_quantity;
+        """, (name, description, price, is_new, quantity))
+    logging.info("✅ Базовые продукты вставлены/обновлены.")
+
+
+def _m0003_grading_cache(curr):
+    """Кэш результатов проверки и объяснений (backend/grading_cache.py)."""
+    # cache_key — sha256 от (вид записи, версия промпта+модели, нормализованный оригинал, нормализованный перевод)
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_grading_cache (
+            cache_key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            prompt_version TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            hits INT DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_hit_at TIMESTAMP
+        );
+    """)
+
+
+def _m0004_sentence_inventory(curr):
+    """Запас заранее сгенерированных предложений по темам."""
+    # Фоновая задача пополняет запас по темам (TOPICS) пачками, а letsgo только «забирает» готовые строки
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_sentence_inventory (
+            id SERIAL PRIMARY KEY,
+            topic TEXT NOT NULL,
+            sentence TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            claimed_by BIGINT,
+            claimed_at TIMESTAMP
+        );
+    """)
+    curr.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bt_3_sentence_inventory_available
+        ON bt_3_sentence_inventory (topic, id) WHERE claimed_at IS NULL;
+    """)
+
+
+def _m0005_sentence_dictionary(curr):
+    """Словарь предложений: один id_for_mistake_table на один текст предложения."""
+    # Уникальный хэш + последовательность вместо SELECT ... WHERE sentence = ... и MAX(id)+1,
+    # которые сканировали bt_3_daily_sentences и могли выдать один id двум параллельным сессиям
+    curr.execute("CREATE SEQUENCE IF NOT EXISTS bt_3_sentence_id_seq;")
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_sentence_dictionary (
+            id INT PRIMARY KEY DEFAULT nextval('bt_3_sentence_id_seq'),
+            sentence_hash TEXT NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # Первичное заполнение из уже выданных предложений (только если словарь пуст)
+    curr.execute("""
+        INSERT INTO bt_3_sentence_dictionary (id, sentence_hash)
+        SELECT DISTINCT ON (md5(sentence)) id_for_mistake_table, md5(sentence)
+        FROM bt_3_daily_sentences
+        WHERE id_for_mistake_table IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM bt_3_sentence_dictionary)
+        ORDER BY md5(sentence), id_for_mistake_table
+        ON CONFLICT DO NOTHING;
+    """)
+    curr.execute("""
+        SELECT setval('bt_3_sentence_id_seq', GREATEST(
+            (SELECT COALESCE(MAX(id), 0) FROM bt_3_sentence_dictionary),
+            (SELECT COALESCE(MAX(id_for_mistake_table), 0) FROM bt_3_daily_sentences),
+            1
+        ));
+    """)
+
+
+def _m0006_dictionary_sentence_text(curr):
+    """Текст предложения в словаре и внешние ключи на словарь."""
+    # Текст предложения в словаре: поиск по id вместо сравнения TEXT в больших таблицах
+    curr.execute("ALTER TABLE bt_3_sentence_dictionary ADD COLUMN IF NOT EXISTS sentence TEXT;")
+    curr.execute("""
+        UPDATE bt_3_sentence_dictionary d
+        SET sentence = ds.sentence
+        FROM (
+            SELECT DISTINCT ON (md5(sentence)) md5(sentence) AS sentence_hash, sentence
+            FROM bt_3_daily_sentences
+            ORDER BY md5(sentence), id
+        ) ds
+        WHERE d.sentence IS NULL AND d.sentence_hash = ds.sentence_hash;
+    """)
+
+    # ✅ id_for_mistake_table / sentence_id ссылаются на словарь.
+    # NOT VALID: старые строки не перепроверяются (в истории могут быть «сироты»), новые — проверяются
+    curr.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'fk_daily_sentences_dictionary') THEN
+                ALTER TABLE bt_3_daily_sentences
+                    ADD CONSTRAINT fk_daily_sentences_dictionary
+                    FOREIGN KEY (id_for_mistake_table) REFERENCES bt_3_sentence_dictionary (id) NOT VALID;
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'fk_detailed_mistakes_dictionary') THEN
+                ALTER TABLE bt_3_detailed_mistakes
+                    ADD CONSTRAINT fk_detailed_mistakes_dictionary
+                    FOREIGN KEY (sentence_id) REFERENCES bt_3_sentence_dictionary (id) NOT VALID;
+            END IF;
+        END $$;
+    """)
+    curr.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bt_3_daily_sentences_mistake_id
+        ON bt_3_daily_sentences (id_for_mistake_table);
+    """)
+    curr.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bt_3_detailed_mistakes_user_sentence
+        ON bt_3_detailed_mistakes (user_id, sentence_id);
+    """)
+
+
+def _m0007_user_state(curr):
+    """Состояние пользователя с TTL (backend/state_store.py) — переживает перезапуск бота."""
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_user_state (
+            namespace TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            state_key TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (namespace, user_id, state_key)
+        );
+    """)
+    curr.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bt_3_user_state_expires_at
+        ON bt_3_user_state (expires_at);
+    """)
+
+
+def _m0008_session_unique_indexes(curr):
+    """Не больше одной незавершённой сессии на пользователя и одного перевода на предложение."""
+    # Сначала закрываем старые «висящие» сессии, иначе уникальный индекс не создастся
+    curr.execute("""
+        UPDATE bt_3_user_progress p
+        SET completed = TRUE, end_time = COALESCE(p.end_time, NOW())
+        WHERE p.completed = FALSE AND EXISTS (
+            SELECT 1 FROM bt_3_user_progress q
+            WHERE q.user_id = p.user_id AND q.completed = FALSE AND q.start_time > p.start_time
+        );
+    """)
+    curr.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_bt_3_user_progress_open_session
+        ON bt_3_user_progress (user_id) WHERE completed = FALSE;
+    """)
+    # В истории могут быть дубли переводов — тогда индекс не создаётся, но старт не прерывается
+    curr.execute("""
+        DO $$
+        BEGIN
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_bt_3_translations_user_sentence
+            ON bt_3_translations (user_id, sentence_id);
+        EXCEPTION WHEN unique_violation THEN
+            RAISE NOTICE 'uq_bt_3_translations_user_sentence: есть дубли переводов, индекс не создан';
+        END $$;
+    """)
+
+
+def _m0009_daily_rollups(curr):
+    """Дневные агрегаты для отчётов (backend/rollups.py), заполненные из истории."""
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS bt_3_daily_rollups (
+            user_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            username TEXT,
+            sentences_total INT NOT NULL DEFAULT 0,
+            translated INT NOT NULL DEFAULT 0,
+            score_sum BIGINT NOT NULL DEFAULT 0,
+            sessions_completed INT NOT NULL DEFAULT 0,
+            session_minutes_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (user_id, day)
+        );
+        CREATE INDEX IF NOT EXISTS idx_bt_3_daily_rollups_day ON bt_3_daily_rollups (day);
+
+        CREATE OR REPLACE FUNCTION bt_3_final_score(avg_score DOUBLE PRECISION, avg_minutes DOUBLE PRECISION, missed BIGINT)
+        RETURNS DOUBLE PRECISION LANGUAGE sql IMMUTABLE AS $$
+            SELECT avg_score - avg_minutes * 1 - missed * 20
+        $$;
+    """)
+
+    # Заполнение из истории (то же, что rollups.rebuild_rollups на момент этой миграции)
+    curr.execute("DELETE FROM bt_3_daily_rollups;")
+    curr.execute("""
+        INSERT INTO bt_3_daily_rollups (user_id, day, sentences_total)
+        SELECT user_id, date, COUNT(*)
+        FROM bt_3_daily_sentences
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id, date;
+    """)
+    curr.execute("""
+        INSERT INTO bt_3_daily_rollups (user_id, day, username, translated, score_sum)
+        SELECT user_id, timestamp::date, MAX(username), COUNT(*), COALESCE(SUM(score), 0)
+        FROM bt_3_translations
+        WHERE timestamp IS NOT NULL
+        GROUP BY user_id, timestamp::date
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            username = EXCLUDED.username,
+            translated = EXCLUDED.translated,
+            score_sum = EXCLUDED.score_sum;
+    """)
+    curr.execute("""
+        INSERT INTO bt_3_daily_rollups (user_id, day, username, sessions_completed, session_minutes_sum)
+        SELECT user_id, start_time::date, MAX(username), COUNT(*),
+               COALESCE(SUM(EXTRACT(EPOCH FROM (end_time - start_time)) / 60), 0)
+        FROM bt_3_user_progress
+        WHERE completed = TRUE AND end_time IS NOT NULL AND start_time IS NOT NULL
+        GROUP BY user_id, start_time::date
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            username = COALESCE(bt_3_daily_rollups.username, EXCLUDED.username),
+            sessions_completed = EXCLUDED.sessions_completed,
+            session_minutes_sum = EXCLUDED.session_minutes_sum;
+    """)
+    curr.execute("SELECT COUNT(*) FROM bt_3_daily_rollups;")
+    logging.info(f"✅ bt_3_daily_rollups заполнена из истории: {curr.fetchone()[0]} строк")
+
+
+def _m0010_leaderboards(curr):
+    """Таблицы лидеров за неделю и месяц (backend/leaderboards.py)."""
+    curr.execute("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS bt_3_leaderboard_week AS
+        SELECT
+            user_id,
+            username,
+            translated,
+            avg_score,
+            avg_minutes,
+            total_minutes,
+            missed,
+            bt_3_final_score(avg_score, avg_minutes, missed) AS final_score,
+            RANK() OVER (ORDER BY bt_3_final_score(avg_score, avg_minutes, missed) DESC) AS place
+        FROM (
+            SELECT
+                user_id,
+                (ARRAY_AGG(username ORDER BY day DESC) FILTER (WHERE username IS NOT NULL))[1] AS username,
+                SUM(translated) AS translated,
+                COALESCE(SUM(score_sum)::float / NULLIF(SUM(translated), 0), 0) AS avg_score,
+                COALESCE(SUM(session_minutes_sum) / NULLIF(SUM(sessions_completed), 0), 0) AS avg_minutes,
+                SUM(session_minutes_sum) AS total_minutes,
+                GREATEST(0, SUM(sentences_total) - SUM(translated)) AS missed
+            FROM bt_3_daily_rollups
+            WHERE day >= CURRENT_DATE - 6
+            GROUP BY user_id
+            HAVING SUM(translated) > 0
+        ) t;
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_bt_3_leaderboard_week_user ON bt_3_leaderboard_week (user_id);
+    """)
+    curr.execute("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS bt_3_leaderboard_month AS
+        SELECT
+            user_id,
+            username,
+            translated,
+            avg_score,
+            avg_minutes,
+            total_minutes,
+            missed,
+            bt_3_final_score(avg_score, avg_minutes, missed) AS final_score,
+            RANK() OVER (ORDER BY bt_3_final_score(avg_score, avg_minutes, missed) DESC) AS place
+        FROM (
+            SELECT
+                user_id,
+                (ARRAY_AGG(username ORDER BY day DESC) FILTER (WHERE username IS NOT NULL))[1] AS username,
+                SUM(translated) AS translated,
+                COALESCE(SUM(score_sum)::float / NULLIF(SUM(translated), 0), 0) AS avg_score,
+                COALESCE(SUM(session_minutes_sum) / NULLIF(SUM(sessions_completed), 0), 0) AS avg_minutes,
+                SUM(session_minutes_sum) AS total_minutes,
+                GREATEST(0, SUM(sentences_total) - SUM(translated)) AS missed
+            FROM bt_3_daily_rollups
+            WHERE day >= date_trunc('month', CURRENT_DATE)::date
+            GROUP BY user_id
+            HAVING SUM(translated) > 0
+        ) t;
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_bt_3_leaderboard_month_user ON bt_3_leaderboard_month (user_id);
+    """)
+
+
+def _m0011_hot_query_indexes(curr):
+    """Индексы под горячие запросы (backend/indexes.py)."""
+    curr.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bt_3_translations_user_timestamp
+            ON bt_3_translations (user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_bt_3_daily_sentences_user_date
+            ON bt_3_daily_sentences (user_id, date);
+        CREATE INDEX IF NOT EXISTS idx_bt_3_user_progress_user_completed_start
+            ON bt_3_user_progress (user_id, completed, start_time);
+        CREATE INDEX IF NOT EXISTS idx_bt_3_user_progress_open_start
+            ON bt_3_user_progress (start_time) WHERE completed = FALSE;
+        CREATE INDEX IF NOT EXISTS idx_bt_3_detailed_mistakes_user_last_seen
+            ON bt_3_detailed_mistakes (user_id, last_seen);
+        CREATE INDEX IF NOT EXISTS idx_bt_3_detailed_mistakes_user_added
+            ON bt_3_detailed_mistakes (user_id, added_data);
+        CREATE INDEX IF NOT EXISTS idx_bt_3_successful_translations_user_date
+            ON bt_3_successful_translations (user_id, date);
+        CREATE INDEX IF NOT EXISTS idx_bt_3_attempts_user_timestamp
+            ON bt_3_attempts (user_id, timestamp);
+    """)
+
+
+# (версия, имя, функция) — строго по возрастанию версии
+MIGRATIONS = [
+    (1, "baseline", _m0001_baseline),
+    (2, "sales_assistant", _m0002_sales_assistant),
+    (3, "grading_cache", _m0003_grading_cache),
+    (4, "sentence_inventory", _m0004_sentence_inventory),
+    (5, "sentence_dictionary", _m0005_sentence_dictionary),
+    (6, "dictionary_sentence_text", _m0006_dictionary_sentence_text),
+    (7, "user_state", _m0007_user_state),
+    (8, "session_unique_indexes", _m0008_session_unique_indexes),
+    (9, "daily_rollups", _m0009_daily_rollups),
+    (10, "leaderboards", _m0010_leaderboards),
+    (11, "hot_query_indexes", _m0011_hot_query_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cursor) -> int:
+    """Последняя применённая версия (0 — схема ещё не под управлением миграций)."""
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+    return cursor.fetchone()[0]
+
+
+def migrate() -> int:
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает итоговую версию."""
+    pool = get_pool()
+    with pool.transaction() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    duration_ms INT
+                );
+            """)
+
+    version = 0
+    for number, name, migration in MIGRATIONS:
+        with pool.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s);", (_MIGRATION_LOCK_KEY,))
+                # Версию перечитываем под замком: другой экземпляр мог уже применить эту миграцию
+                version = current_version(cursor)
+                if number <= version:
+                    continue
+                started = time.perf_counter()
+                logging.info(f"⏳ Миграция {number:04d}_{name}...")
+                migration(cursor)
+                duration_ms = int((time.perf_counter() - started) * 1000)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, name, duration_ms) VALUES (%s, %s, %s);",
+                    (number, name, duration_ms),
+                )
+                metrics.inc("schema_migrations_applied_total", name=name)
+                logging.info(f"✅ Миграция {number:04d}_{name} применена за {duration_ms} ms")
+                version = number
+    return version
+
+
+def ensure_schema() -> int:
+    """
+    Быстрая проверка при старте: один SELECT номера версии.
+    Если БД отстаёт — применяет миграции (DB_AUTO_MIGRATE) или падает с понятной ошибкой.
+    """
+    with get_pool().transaction() as conn:
+        with conn.cursor() as cursor:
+            version = current_version(cursor)
+
+    if version == SCHEMA_VERSION:
+        logging.info(f"✅ Схема БД актуальна (версия {version})")
+        return version
+    if version > SCHEMA_VERSION:
+        # Схему уже обновил более новый деплой — старый код продолжает работать с совместимыми таблицами
+        logging.warning(f"⚠️ Версия схемы БД {version} новее ожидаемой {SCHEMA_VERSION}")
+        return version
+    if not DB_AUTO_MIGRATE:
+        raise SchemaVersionError(
+            f"Схема БД версии {version}, код ожидает {SCHEMA_VERSION}: выполните python -m backend.migrations"
+        )
+    return migrate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    parser.add_argument("--status", action="store_true", help="Только показать версию схемы")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="После миграций проверить планы горячих запросов (как python -m backend.indexes)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.status:
+        with get_pool().transaction() as conn:
+            with conn.cursor() as cursor:
+                version = current_version(cursor)
+        logging.info(f"📊 Версия схемы БД: {version}, ожидается: {SCHEMA_VERSION}")
+        sys.exit(0 if version >= SCHEMA_VERSION else 1)
+
+    version = migrate()
+    logging.info(f"✅ Схема БД: версия {version}")
+    # Миграции уже зафиксированы — отдельный код выхода, чтобы не выдавать регрессию планов за сбой миграции
+    if args.check_plans and check_query_plans():
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# openai_guard.py
+# Общая защита всех запросов к OpenAI: бюджет запросов и токенов на модель (token bucket),
+# повторы с экспоненциальной задержкой и джиттером и circuit breaker.
+# Раньше каждый вызов сам повторял запрос 3–5 раз с линейной паузой, и шквал 429 только умножал нагрузку.
+# Теперь при 429 притормаживают все запросы к модели, а если ошибки идут подряд, breaker «открывается»
+# и вызовы сразу получают CircuitOpenError — вызывающий код переходит на локальный запасной вариант
+# (запасные предложения, кэш оценок) вместо ожидания.
+import os
+import time
+import random
+import asyncio
+import logging
+
+import openai
+
+try:
+    from backend import metrics
+    from backend.rate_limit import TokenBucket
+except ImportError:
+    import metrics
+    from rate_limit import TokenBucket
+
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "300"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "150000"))
+# Отдельные бюджеты для моделей: "gpt-4o-mini=500:200000,gpt-4.1-2025-04-14=300:150000" (запросов:токенов в минуту)
+LLM_BUDGETS = os.getenv("LLM_BUDGETS", "")
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# Ошибки, после которых запрос имеет смысл повторить (и которые говорят о проблеме на стороне API)
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+_STATE_GAUGE = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class CircuitOpenError(Exception):
+    """Breaker модели открыт: запрос не отправлялся, нужно использовать запасной вариант."""
+
+
+class CircuitBreaker:
+    """closed → (LLM_BREAKER_FAILURES ошибок подряд) → open → (cooldown) → half_open → один пробный запрос."""
+
+    def __init__(self, model: str, failure_threshold: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        logging.warning(f"🔌 Circuit breaker OpenAI ({self.model}): {self.state} → {state}")
+        metrics.inc("llm_circuit_transitions_total", model=self.model, from_state=self.state, to_state=state)
+        metrics.set_gauge("llm_circuit_state", _STATE_GAUGE[state], model=self.model)
+        self.state = state
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._set_state("half_open")
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.probe_in_flight = False
+        self.failures = 0
+        self._set_state("closed")
+
+    def record_failure(self):
+        self.probe_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state("open")
+
+    def release(self):
+        """Запрос завершился ошибкой, не связанной с доступностью API (например, 400) — состояние не меняем."""
+        self.probe_in_flight = False
+
+
+def _parse_budgets(raw):
+    budgets = {}
+    for item in filter(None, (part.strip() for part in raw.split(","))):
+        try:
+            model, limits = item.split("=", 1)
+            rpm, tpm = limits.split(":", 1)
+            budgets[model.strip()] = (float(rpm), float(tpm))
+        except ValueError:
+            logging.warning(f"⚠️ Не удалось разобрать LLM_BUDGETS: {item!r}")
+    return budgets
+
+
+_budgets = _parse_budgets(LLM_BUDGETS)
+_request_buckets = {}
+_token_buckets = {}
+_breakers = {}
+
+
+def _limits(model):
+    if model not in _request_buckets:
+        rpm, tpm = _budgets.get(model, (LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE))
+        # Запас на всплеск — 10 секунд бюджета
+        _request_buckets[model] = TokenBucket(rpm / 60, capacity=max(1.0, rpm / 6))
+        _token_buckets[model] = TokenBucket(tpm / 60, capacity=max(1.0, tpm / 6))
+        _breakers[model] = CircuitBreaker(model)
+    return _request_buckets[model], _token_buckets[model], _breakers[model]
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    return _limits(model)[2]
+
+
+def estimate_tokens(*texts, completion_tokens: int = 500) -> int:
+    """Грубая оценка расхода: ~4 символа на токен плюс ожидаемый ответ."""
+    return sum(len(text or "") for text in texts) // 4 + completion_tokens
+
+
+def record_token_usage(model: str, estimated: int, actual: int) -> None:
+    """Досписывает из бюджета токенов разницу между реальным расходом и оценкой."""
+    if actual > estimated:
+        _limits(model)[1].debit(actual - estimated)
+
+
+def _backoff_delay(attempt, error):
+    # Если API прислал retry-after — слушаемся его, иначе экспонента с полным джиттером
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(LLM_BACKOFF_MAX, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+async def guarded_call(model: str, request_fn, estimated_tokens: int = 1000):
+    """
+    Выполняет await request_fn() с учётом бюджета модели, повторами и circuit breaker.
+    :param request_fn: Функция без аргументов, возвращающая корутину запроса (вызывается на каждую попытку).
+    :raises CircuitOpenError: breaker открыт — запрос не отправлялся.
+    Остальные ошибки пробрасываются после исчерпания повторов.
+    """
+    request_bucket, token_bucket, breaker = _limits(model)
+    estimated_tokens = min(estimated_tokens, token_bucket.capacity)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        if not breaker.allow():
+            metrics.inc("llm_circuit_rejected_total", model=model)
+            raise CircuitOpenError(f"OpenAI circuit for {model} is {breaker.state}")
+
+        # Исход попытки записан в breaker (успех/ошибка); иначе — отмена (CancelledError) или ошибка
+        # вне запроса: в finally освобождаем пробный слот half_open, чтобы breaker не «залип»
+        outcome_recorded = False
+        try:
+            waited = await request_bucket.acquire() + await token_bucket.acquire(estimated_tokens)
+            if waited > 0:
+                metrics.inc("llm_throttled_total", model=model)
+                metrics.observe("llm_throttle_wait_seconds", waited, model=model)
+
+            try:
+                result = await request_fn()
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                outcome_recorded = True
+                if attempt >= LLM_MAX_RETRIES or breaker.state == "open":
+                    raise
+                delay = _backoff_delay(attempt, e)
+                if isinstance(e, openai.RateLimitError):
+                    # 429 — общий сигнал: притормаживаем все запросы к этой модели, а не только текущий
+                    request_bucket.pause(delay)
+                metrics.inc("llm_retries_total", model=model, error=type(e).__name__)
+                logging.warning(f"⚠️ OpenAI {type(e).__name__} ({model}), повтор {attempt + 1} через {delay:.1f} сек")
+            else:
+                breaker.record_success()
+                outcome_recorded = True
+                return result
+        finally:
+            if not outcome_recorded:
+                breaker.release()
+        await asyncio.sleep(delay)
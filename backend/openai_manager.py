@@ -3,8 +3,6 @@ import os
 import logging
 #from openai import OpenAI
 from openai import AsyncOpenAI
-import psycopg2
-from contextlib import contextmanager
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -447,6 +445,16 @@ The user can trigger these modes at any time by asking:
 """
 }
 
+# Вариант инструкции check_translation для строгого JSON-ответа (см. backend/grading_schema.py):
+# правила оценки те же, меняется только формат ответа.
+system_message["check_translation_json"] = system_message["check_translation"].split("**FORMAT YOUR RESPONSE STRICTLY")[0] + """
+    **FORMAT YOUR RESPONSE STRICTLY as a JSON object (without extra words):**
+    - "score": integer from 0 to 100
+    - "mistakes": list of objects {"category": ..., "subcategory": ...}; every subcategory must belong to its category from the lists above. Empty list if there are no mistakes.
+    - "correct_translation": the correct German translation
+
+"""
+
 
 # Логирование
 logging.basicConfig(
@@ -457,25 +465,18 @@ logging.basicConfig(
 # Загружаем переменные окружения из .env-файла
 load_dotenv(dotenv_path=Path(__file__).parent/".env")
 
-# --- Базовая функция для получения соединения с БД ---
-# Дублируем, так как openai_manager.py может быть импортирован раньше database.py,
-# или для обеспечения самодостаточности модуля.
-# В идеале, эту функцию get_db_connection_context стоит разместить в самом database.py
-# и импортировать оттуда. Для данного примера, пока оставим так.
+# --- Соединение с БД ---
+# Раньше здесь была своя копия get_db_connection_context. Теперь используем общий пул из db_pool.py,
+# чтобы bot_3.py, database.py и openai_manager.py делили одни и те же соединения.
 DATABASE_URL = os.getenv("DATABASE_URL_RAILWAY")
 if not DATABASE_URL:
     logging.error("❌ Ошибка: DATABASE_URL не задан в .env-файле или переменных окружения!")
     raise RuntimeError("DATABASE_URL не установлен.")
 
-@contextmanager
-def get_db_connection_context():
-    """Контекстный менеджер для соединения с базой данных PostgreSQL."""
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-    try:
-        yield conn
-        conn.commit()
-    finally:
-        conn.close()
+try:
+    from backend.db_pool import get_db_connection_context
+except ImportError:
+    from db_pool import get_db_connection_context
 
 # --- Инициализация глобального клиента OpenAI ---
 # Клиент OpenAI, который будет использоваться ВСЕМИ частями приложения.
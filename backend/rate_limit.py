@@ -0,0 +1,58 @@
+# rate_limit.py
+# Token bucket для ограничения частоты вызовов внешних API внутри одного event loop.
+# Ведро пополняется со скоростью rate токенов в секунду до capacity; вызов забирает токен
+# или ждёт, пока он появится. pause() временно «замораживает» ведро — так соблюдаем RetryAfter.
+import time
+import asyncio
+
+
+class TokenBucket:
+    """Асинхронный token bucket. Не потокобезопасен: используется только из event loop."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: Токенов в секунду.
+        :param capacity: Максимальный запас (допустимый всплеск). По умолчанию — max(1, rate).
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Забирает токены, если они есть, и возвращает 0. Иначе возвращает, сколько секунд ждать."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1) -> float:
+        """Ждёт и забирает токены. Возвращает суммарное время ожидания в секундах."""
+        waited = 0.0
+        while True:
+            delay = self.try_acquire(tokens)
+            if delay <= 0:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены ближайшие seconds секунд (например, после RetryAfter) и обнулить запас."""
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated_at = max(self.updated_at, self.paused_until)
+
+    def debit(self, tokens: float) -> None:
+        """Списывает токены задним числом (например, когда реальный расход оказался больше оценки)."""
+        self._refill(max(time.monotonic(), self.updated_at))
+        self.tokens = max(-self.capacity, self.tokens - tokens)
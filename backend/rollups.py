@@ -0,0 +1,165 @@
+# rollups.py
+# Дневные агрегаты по пользователям (bt_3_daily_rollups) для отчётов.
+# send_daily_summary, send_progress_report и user_stats раньше каждый раз заново считали одно и то же:
+# COUNT(DISTINCT ...) по bt_3_daily_sentences и bt_3_translations плюс подзапросы по bt_3_user_progress
+# с условиями вида start_time::date = CURRENT_DATE, которые не используют индексы.
+# Теперь строка (user_id, day) обновляется в той же транзакции, где выдаются предложения, сохраняется
+# перевод и закрывается сессия, а отчёты читают её по первичному ключу.
+# Пересчитать агрегаты из истории (после миграции или ручной правки данных):
+#   python -m backend.rollups --since 2025-01-01
+import logging
+import argparse
+from datetime import date
+
+try:
+    from backend import metrics
+    from backend.db_pool import get_pool
+except ImportError:
+    import metrics
+    from db_pool import get_pool
+
+CREATE_ROLLUPS_SQL = """
+    CREATE TABLE IF NOT EXISTS bt_3_daily_rollups (
+        user_id BIGINT NOT NULL,
+        day DATE NOT NULL,
+        username TEXT,
+        sentences_total INT NOT NULL DEFAULT 0,
+        translated INT NOT NULL DEFAULT 0,
+        score_sum BIGINT NOT NULL DEFAULT 0,
+        sessions_completed INT NOT NULL DEFAULT 0,
+        session_minutes_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (user_id, day)
+    );
+    CREATE INDEX IF NOT EXISTS idx_bt_3_daily_rollups_day ON bt_3_daily_rollups (day);
+
+    -- Итоговый балл — единственное место формулы (отчёты, user_stats, таблицы лидеров)
+    CREATE OR REPLACE FUNCTION bt_3_final_score(avg_score DOUBLE PRECISION, avg_minutes DOUBLE PRECISION, missed BIGINT)
+    RETURNS DOUBLE PRECISION LANGUAGE sql IMMUTABLE AS $$
+        SELECT avg_score - avg_minutes * 1 - missed * 20
+    $$;
+"""
+
+# Метрики отчётов из строки агрегата (то же, что раньше считали запросы):
+# средняя оценка, среднее время сессии, пропущено и итоговый балл (bt_3_final_score)
+REPORT_COLUMNS_SQL = """
+    COALESCE(score_sum::float / NULLIF(translated, 0), 0) AS avg_score,
+    COALESCE(session_minutes_sum / NULLIF(sessions_completed, 0), 0) AS avg_minutes,
+    session_minutes_sum AS total_minutes,
+    GREATEST(0, sentences_total - translated) AS missed,
+    bt_3_final_score(
+        COALESCE(score_sum::float / NULLIF(translated, 0), 0),
+        COALESCE(session_minutes_sum / NULLIF(sessions_completed, 0), 0),
+        GREATEST(0, sentences_total - translated)
+    ) AS final_score
+"""
+
+
+def add_sentences(cursor, user_id, username, count: int) -> None:
+    """Пользователю выданы count предложений на сегодня."""
+    cursor.execute("""
+        INSERT INTO bt_3_daily_rollups (user_id, day, username, sentences_total)
+        VALUES (%s, CURRENT_DATE, %s, %s)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            sentences_total = bt_3_daily_rollups.sentences_total + EXCLUDED.sentences_total,
+            username = COALESCE(EXCLUDED.username, bt_3_daily_rollups.username),
+            updated_at = NOW();
+    """, (user_id, username, count))
+
+
+def add_translation(cursor, user_id, username, score: int) -> None:
+    """Сохранён перевод с оценкой score."""
+    cursor.execute("""
+        INSERT INTO bt_3_daily_rollups (user_id, day, username, translated, score_sum)
+        VALUES (%s, CURRENT_DATE, %s, 1, %s)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            translated = bt_3_daily_rollups.translated + 1,
+            score_sum = bt_3_daily_rollups.score_sum + EXCLUDED.score_sum,
+            username = COALESCE(EXCLUDED.username, bt_3_daily_rollups.username),
+            updated_at = NOW();
+    """, (user_id, username, score))
+
+
+def close_sessions(cursor, where_sql: str, params=()) -> int:
+    """
+    Закрывает открытые сессии bt_3_user_progress, подходящие под where_sql, и добавляет их длительность
+    в агрегаты дня начала сессии. Возвращает число закрытых сессий.
+    """
+    cursor.execute(f"""
+        WITH closed AS (
+            UPDATE bt_3_user_progress
+            SET end_time = NOW(), completed = TRUE
+            WHERE completed = FALSE AND ({where_sql})
+            RETURNING user_id, username, start_time, end_time
+        ),
+        per_day AS (
+            INSERT INTO bt_3_daily_rollups (user_id, day, username, sessions_completed, session_minutes_sum)
+            SELECT user_id, start_time::date, MAX(username), COUNT(*),
+                   SUM(EXTRACT(EPOCH FROM (end_time - start_time)) / 60)
+            FROM closed
+            GROUP BY user_id, start_time::date
+            ON CONFLICT (user_id, day) DO UPDATE SET
+                sessions_completed = bt_3_daily_rollups.sessions_completed + EXCLUDED.sessions_completed,
+                session_minutes_sum = bt_3_daily_rollups.session_minutes_sum + EXCLUDED.session_minutes_sum,
+                updated_at = NOW()
+        )
+        SELECT COUNT(*) FROM closed;
+    """, params)
+    return cursor.fetchone()[0]
+
+
+def rebuild_rollups(cursor, since: date = None) -> int:
+    """Пересчитывает агрегаты с даты since (по умолчанию — за всю историю). Возвращает число строк."""
+    since = since or date(1970, 1, 1)
+    cursor.execute("DELETE FROM bt_3_daily_rollups WHERE day >= %s;", (since,))
+    cursor.execute("""
+        INSERT INTO bt_3_daily_rollups (user_id, day, sentences_total)
+        SELECT user_id, date, COUNT(*)
+        FROM bt_3_daily_sentences
+        WHERE user_id IS NOT NULL AND date >= %s
+        GROUP BY user_id, date;
+    """, (since,))
+    cursor.execute("""
+        INSERT INTO bt_3_daily_rollups (user_id, day, username, translated, score_sum)
+        SELECT user_id, timestamp::date, MAX(username), COUNT(*), COALESCE(SUM(score), 0)
+        FROM bt_3_translations
+        WHERE timestamp >= %s
+        GROUP BY user_id, timestamp::date
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            username = EXCLUDED.username,
+            translated = EXCLUDED.translated,
+            score_sum = EXCLUDED.score_sum;
+    """, (since,))
+    cursor.execute("""
+        INSERT INTO bt_3_daily_rollups (user_id, day, username, sessions_completed, session_minutes_sum)
+        SELECT user_id, start_time::date, MAX(username), COUNT(*),
+               COALESCE(SUM(EXTRACT(EPOCH FROM (end_time - start_time)) / 60), 0)
+        FROM bt_3_user_progress
+        WHERE completed = TRUE AND end_time IS NOT NULL AND start_time >= %s
+        GROUP BY user_id, start_time::date
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            username = COALESCE(bt_3_daily_rollups.username, EXCLUDED.username),
+            sessions_completed = EXCLUDED.sessions_completed,
+            session_minutes_sum = EXCLUDED.session_minutes_sum;
+    """, (since,))
+    cursor.execute("SELECT COUNT(*) FROM bt_3_daily_rollups WHERE day >= %s;", (since,))
+    return cursor.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчёт bt_3_daily_rollups из истории")
+    parser.add_argument("--since", type=date.fromisoformat, default=None,
+                        help="Начальная дата YYYY-MM-DD (по умолчанию — вся история)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with metrics.timer("rollups_rebuild_seconds"):
+        with get_pool().transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(CREATE_ROLLUPS_SQL)
+                rows = rebuild_rollups(cursor, args.since)
+    logging.info(f"✅ bt_3_daily_rollups пересчитана с {args.since or 'начала истории'}: {rows} строк")
+
+
+if __name__ == "__main__":
+    main()
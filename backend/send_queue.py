@@ -0,0 +1,144 @@
+# send_queue.py
+# Общая очередь исходящих сообщений Telegram для рассылок по расписанию.
+# Вместо «отправить → asyncio.sleep(5) → отправить» задачи кладут сообщения в очередь и сразу идут дальше,
+# а очередь сама соблюдает лимиты Telegram: общий (≈30 сообщений/сек на бота) и на чат
+# (≈20 сообщений/мин в группе, ≈1/сек в личном чате) через token bucket, и выдерживает паузу из RetryAfter.
+# У каждого чата свой воркер, поэтому порядок сообщений внутри чата сохраняется.
+import os
+import time
+import asyncio
+import logging
+
+from telegram.error import RetryAfter, TimedOut, NetworkError
+
+try:
+    from backend import metrics
+    from backend.rate_limit import TokenBucket
+except ImportError:
+    import metrics
+    from rate_limit import TokenBucket
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))            # сообщений в секунду на бота
+TELEGRAM_GROUP_RATE_PER_MIN = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MIN", "20"))  # в одну группу
+TELEGRAM_PRIVATE_RATE = float(os.getenv("TELEGRAM_PRIVATE_RATE", "1"))          # в один личный чат, в секунду
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+
+_global_bucket = None
+_chat_buckets = {}
+_chat_queues = {}
+_chat_workers = {}
+
+
+def _chat_kind(chat_id):
+    # У групп и каналов отрицательный chat_id
+    return "group" if int(chat_id) < 0 else "private"
+
+
+def _get_global_bucket():
+    global _global_bucket
+    if _global_bucket is None:
+        _global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE)
+    return _global_bucket
+
+
+def _get_chat_bucket(chat_id):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        if _chat_kind(chat_id) == "group":
+            # Небольшой запас на всплеск, дальше — не чаще лимита группы
+            bucket = TokenBucket(TELEGRAM_GROUP_RATE_PER_MIN / 60, capacity=3)
+        else:
+            bucket = TokenBucket(TELEGRAM_PRIVATE_RATE)
+        _chat_buckets[chat_id] = bucket
+    return bucket
+
+
+def _retry_after_seconds(error):
+    # В разных версиях python-telegram-bot retry_after — int или timedelta
+    value = error.retry_after
+    return float(value.total_seconds()) if hasattr(value, "total_seconds") else float(value)
+
+
+def queue_depth() -> int:
+    """Сколько сообщений ждут отправки во всех чатах."""
+    return sum(queue.qsize() for queue in _chat_queues.values())
+
+
+async def _send_one(bot, chat_id, method, kwargs):
+    kind = _chat_kind(chat_id)
+    chat_bucket = _get_chat_bucket(chat_id)
+    for attempt in range(TELEGRAM_SEND_RETRIES + 1):
+        waited = await chat_bucket.acquire() + await _get_global_bucket().acquire()
+        if waited > 0:
+            metrics.inc("telegram_throttle_total", reason="bucket", chat=kind)
+            metrics.observe("telegram_throttle_wait_seconds", waited, chat=kind)
+
+        started = time.perf_counter()
+        try:
+            result = await getattr(bot, method)(chat_id=chat_id, **kwargs)
+            metrics.observe("telegram_send_seconds", time.perf_counter() - started, method=method)
+            metrics.inc("telegram_send_total", method=method, status="ok")
+            return result
+        except RetryAfter as e:
+            delay = _retry_after_seconds(e)
+            metrics.inc("telegram_throttle_total", reason="retry_after", chat=kind)
+            logging.warning(f"⏳ Telegram просит подождать {delay:.0f} сек (чат {chat_id}, {method})")
+            chat_bucket.pause(delay)
+            if kind == "group":
+                # Флуд-контроль группы часто означает общий лимит бота — притормаживаем всех
+                _get_global_bucket().pause(delay)
+        except (TimedOut, NetworkError) as e:
+            if attempt >= TELEGRAM_SEND_RETRIES:
+                raise
+            logging.warning(f"⚠️ Сетевая ошибка при {method} в чат {chat_id} (попытка {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    metrics.inc("telegram_send_total", method=method, status="gave_up")
+    raise RuntimeError(f"Не удалось выполнить {method} в чат {chat_id} после {TELEGRAM_SEND_RETRIES + 1} попыток")
+
+
+async def _chat_worker(chat_id):
+    queue = _chat_queues[chat_id]
+    while True:
+        bot, method, kwargs, future = await queue.get()
+        try:
+            result = await _send_one(bot, chat_id, method, kwargs)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            metrics.inc("telegram_send_total", method=method, status="error")
+            logging.error(f"❌ Не удалось выполнить {method} в чат {chat_id}: {e}")
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            queue.task_done()
+            metrics.set_gauge("telegram_send_queue_depth", queue_depth())
+
+
+def enqueue_send(bot, chat_id, method: str = "send_message", **kwargs) -> asyncio.Future:
+    """
+    Ставит вызов bot.<method>(chat_id=chat_id, **kwargs) в очередь чата и сразу возвращается.
+    Возвращает future с результатом отправки (ждать его не обязательно; ошибки уже залогированы).
+    Файлы передавайте байтами, а не открытым файлом: отправка может случиться позже.
+    """
+    queue = _chat_queues.get(chat_id)
+    if queue is None:
+        queue = _chat_queues[chat_id] = asyncio.Queue()
+    worker = _chat_workers.get(chat_id)
+    if worker is None or worker.done():
+        _chat_workers[chat_id] = asyncio.create_task(_chat_worker(chat_id))
+
+    future = asyncio.get_running_loop().create_future()
+    # Никто может не ждать результат — не даём asyncio ругаться на «необработанное исключение»
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    queue.put_nowait((bot, method, kwargs, future))
+    metrics.set_gauge("telegram_send_queue_depth", queue_depth())
+    return future
+
+
+async def drain(timeout: float = None) -> bool:
+    """Ждёт, пока все очереди опустеют. Возвращает False, если вышли по таймауту."""
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in list(_chat_queues.values()))), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
@@ -0,0 +1,71 @@
+# session_tracker.py
+# Учёт незавершённых проверок переводов по session_id внутри процесса.
+# check_user_translation регистрирует каждую запущенную проверку и отмечает её завершение,
+# а done() ждёт, пока проверок в работе не останется, — без периодических SELECT COUNT(*)
+# и без удержания соединения с БД во время ожидания.
+# Работает в одном event loop (так и запускается бот); в другом процессе проверки этого не видно.
+import asyncio
+import time
+
+try:
+    from backend import metrics
+except ImportError:
+    import metrics
+
+_pending = {}      # session_id -> число проверок в работе
+_conditions = {}   # session_id -> asyncio.Condition
+
+
+def _condition(session_id):
+    condition = _conditions.get(session_id)
+    if condition is None:
+        condition = _conditions[session_id] = asyncio.Condition()
+    return condition
+
+
+def begin(session_id, count: int = 1) -> None:
+    """Отмечает, что для сессии запущено count проверок."""
+    if session_id is None or count <= 0:
+        return
+    _pending[session_id] = _pending.get(session_id, 0) + count
+    _condition(session_id)
+
+
+async def finish(session_id) -> None:
+    """Отмечает завершение одной проверки (успешное или нет) и будит ожидающих, если проверок не осталось."""
+    if session_id is None or session_id not in _pending:
+        return
+    left = _pending[session_id] - 1
+    if left > 0:
+        _pending[session_id] = left
+        return
+    _pending.pop(session_id, None)
+    condition = _conditions.pop(session_id, None)
+    if condition is not None:
+        async with condition:
+            condition.notify_all()
+
+
+def pending(session_id) -> int:
+    """Сколько проверок сессии ещё в работе."""
+    return _pending.get(session_id, 0)
+
+
+async def wait_idle(session_id, timeout: float) -> bool:
+    """
+    Ждёт, пока у сессии не останется проверок в работе, но не дольше timeout секунд.
+    Возвращает True, если всё завершилось, False — если вышли по таймауту.
+    Пишет метрику session_done_wait_seconds.
+    """
+    started = time.perf_counter()
+    condition = _conditions.get(session_id)
+    finished = True
+    if condition is not None and pending(session_id) > 0:
+        try:
+            async with condition:
+                await asyncio.wait_for(condition.wait_for(lambda: pending(session_id) == 0), timeout)
+        except asyncio.TimeoutError:
+            finished = False
+    metrics.observe("session_done_wait_seconds", time.perf_counter() - started,
+                    result="ok" if finished else "timeout")
+    return finished
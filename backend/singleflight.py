@@ -0,0 +1,52 @@
+# singleflight.py
+# Объединение одинаковых одновременных запросов к LLM.
+# Если несколько пользователей одновременно запрашивают один и тот же промпт (одна тема, одна пара
+# «оригинал — перевод» для объяснения), к OpenAI уходит один запрос, а остальные ждут его результат.
+# Кэшем это не является: после завершения запроса ключ освобождается.
+import re
+import asyncio
+import hashlib
+import unicodedata
+
+try:
+    from backend import metrics
+except ImportError:
+    import metrics
+
+_inflight = {}  # ключ -> asyncio.Task
+
+
+def normalize_prompt(text: str) -> str:
+    """NFC и схлопнутые пробелы — промпты, отличающиеся только отступами, считаются одинаковыми."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+def make_key(task_name: str, *parts) -> str:
+    raw = "\x1f".join([task_name] + [normalize_prompt(str(part)) for part in parts])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _forget(key, task):
+    _inflight.pop(key, None)
+    # Ошибку получат ожидающие; если все они уже отменены — не даём asyncio ругаться на «непрочитанное исключение»
+    if not task.cancelled():
+        task.exception()
+
+
+async def single_flight(task_name: str, key_parts: tuple, coro_fn):
+    """
+    Выполняет await coro_fn() один раз для всех одновременных вызовов с тем же (task_name, key_parts).
+    Пишет llm_singleflight_total{task, result=leader|shared}; shared — сэкономленные запросы.
+    Отмена одного из ожидающих не отменяет общий запрос для остальных.
+    """
+    key = make_key(task_name, *key_parts)
+    task = _inflight.get(key)
+    if task is not None:
+        metrics.inc("llm_singleflight_total", task=task_name, result="shared")
+        return await asyncio.shield(task)
+
+    task = asyncio.ensure_future(coro_fn())
+    _inflight[key] = task
+    task.add_done_callback(lambda t: _forget(key, t))
+    metrics.inc("llm_singleflight_total", task=task_name, result="leader")
+    return await asyncio.shield(task)
@@ -0,0 +1,115 @@
+# state_store.py
+# Типизированное хранилище состояния пользователя с TTL и LRU-ограничением.
+# Заменяет хранение служебных данных прямо в context.user_data (где «вытеснение» удаляло первый попавшийся
+# ключ — хоть pending_translations) и переживает перезапуск бота: записи дублируются в таблицу bt_3_user_state.
+# В памяти значение хранится кортежем полей dataclass — без словаря на каждую запись.
+import os
+import json
+import time
+import logging
+from collections import OrderedDict
+from dataclasses import astuple, asdict, fields
+from datetime import datetime, timedelta
+
+try:
+    from backend import metrics
+    from backend.async_db import db_fetchone, db_execute
+except ImportError:
+    import metrics
+    from async_db import db_fetchone, db_execute
+
+USER_STATE_PERSIST = os.getenv("USER_STATE_PERSIST", "true").lower() in ("1", "true", "yes")
+
+
+class UserStateStore:
+    """
+    Хранилище записей одного типа (dataclass) по ключу (user_id, key).
+    Каждая запись живёт ttl_seconds; в памяти держим не больше max_entries записей (LRU),
+    остальное при необходимости дочитывается из БД.
+    """
+
+    def __init__(self, namespace: str, state_type, ttl_seconds: int, max_entries: int, persist: bool = USER_STATE_PERSIST):
+        self.namespace = namespace
+        self.state_type = state_type
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.persist = persist
+        self._field_names = tuple(f.name for f in fields(state_type))
+        self._entries = OrderedDict()  # (user_id, key) -> (expires_at monotonic, кортеж полей)
+
+    def _remember(self, entry_key, expires_at, values):
+        self._entries[entry_key] = (expires_at, values)
+        self._entries.move_to_end(entry_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            metrics.inc("user_state_evictions_total", namespace=self.namespace)
+        metrics.set_gauge("user_state_entries", len(self._entries), namespace=self.namespace)
+
+    async def put(self, user_id, key, state) -> None:
+        """Сохраняет state (экземпляр state_type) в памяти и, если включено, в bt_3_user_state."""
+        key = str(key)
+        self._remember((user_id, key), time.monotonic() + self.ttl_seconds, astuple(state))
+        if not self.persist:
+            return
+        try:
+            await db_execute("user_state_put", """
+                INSERT INTO bt_3_user_state (namespace, user_id, state_key, payload, expires_at)
+                VALUES (%s, %s, %s, %s::jsonb, %s)
+                ON CONFLICT (namespace, user_id, state_key)
+                DO UPDATE SET payload = EXCLUDED.payload, expires_at = EXCLUDED.expires_at;
+            """, (self.namespace, user_id, key, json.dumps(asdict(state), ensure_ascii=False),
+                  datetime.now() + timedelta(seconds=self.ttl_seconds)))
+        except Exception as e:
+            logging.warning(f"⚠️ Не удалось сохранить состояние {self.namespace}/{key} в БД: {e}")
+
+    async def get(self, user_id, key):
+        """Возвращает экземпляр state_type или None, если записи нет или её срок истёк."""
+        key = str(key)
+        entry_key = (user_id, key)
+        entry = self._entries.get(entry_key)
+        if entry is not None:
+            expires_at, values = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(entry_key)
+                metrics.inc("user_state_lookups_total", namespace=self.namespace, result="memory")
+                return self.state_type(*values)
+            del self._entries[entry_key]
+
+        if self.persist:
+            try:
+                row = await db_fetchone("user_state_get", """
+                    SELECT payload, EXTRACT(EPOCH FROM (expires_at - NOW()))
+                    FROM bt_3_user_state
+                    WHERE namespace = %s AND user_id = %s AND state_key = %s AND expires_at > NOW();
+                """, (self.namespace, user_id, key))
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось прочитать состояние {self.namespace}/{key} из БД: {e}")
+                row = None
+            if row is not None:
+                payload, ttl_left = row
+                values = tuple(payload.get(name) for name in self._field_names)
+                self._remember(entry_key, time.monotonic() + float(ttl_left), values)
+                metrics.inc("user_state_lookups_total", namespace=self.namespace, result="db")
+                return self.state_type(*values)
+
+        metrics.inc("user_state_lookups_total", namespace=self.namespace, result="miss")
+        return None
+
+    async def delete(self, user_id, key) -> None:
+        key = str(key)
+        self._entries.pop((user_id, key), None)
+        if not self.persist:
+            return
+        try:
+            await db_execute("user_state_delete", """
+                DELETE FROM bt_3_user_state WHERE namespace = %s AND user_id = %s AND state_key = %s;
+            """, (self.namespace, user_id, key))
+        except Exception as e:
+            logging.warning(f"⚠️ Не удалось удалить состояние {self.namespace}/{key} из БД: {e}")
+
+
+async def purge_expired_user_state(context=None) -> None:
+    """Удаляет из bt_3_user_state записи с истёкшим сроком (плановая задача)."""
+    if not USER_STATE_PERSIST:
+        return
+    await db_execute("user_state_purge", "DELETE FROM bt_3_user_state WHERE expires_at <= NOW();")
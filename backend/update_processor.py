@@ -0,0 +1,63 @@
+# update_processor.py
+# Параллельная обработка обновлений Telegram с сохранением порядка для каждого пользователя.
+# Обновления разных пользователей обрабатываются одновременно (до max_concurrent_updates),
+# а обновления одного пользователя — строго по очереди. Долгая проверка перевода одного
+# пользователя не задерживает нажатие кнопки другого.
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+try:
+    from backend import metrics
+except ImportError:
+    import metrics
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельно между пользователями, последовательно внутри одного пользователя."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}    # user_id -> asyncio.Lock
+        self._waiting = {}  # user_id -> сколько обновлений держат или ждут замок
+
+    @staticmethod
+    def _user_key(update):
+        if isinstance(update, Update) and update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update, coroutine) -> None:
+        user_key = self._user_key(update)
+        if user_key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._locks.get(user_key)
+        if lock is None:
+            lock = self._locks[user_key] = asyncio.Lock()
+        self._waiting[user_key] = self._waiting.get(user_key, 0) + 1
+        try:
+            # Сначала очередь пользователя, потом общий слот: ждущие своей очереди обновления
+            # не занимают слоты, нужные другим пользователям
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            left = self._waiting[user_key] - 1
+            if left:
+                self._waiting[user_key] = left
+            else:
+                del self._waiting[user_key]
+                del self._locks[user_key]
+            metrics.set_gauge("updates_users_in_flight", len(self._locks))
+
+    async def do_process_update(self, update, coroutine) -> None:
+        with metrics.timer("update_processing_seconds"):
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
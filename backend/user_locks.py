@@ -0,0 +1,73 @@
+# user_locks.py
+# Последовательное выполнение действий одного пользователя внутри процесса.
+# Обновления одного пользователя обработчики получают по очереди (PerUserUpdateProcessor, обработчики блокирующие),
+# поэтому внутри этой очереди два действия одного пользователя не пересекаются. Замок защищает от путей в обход
+# неё: обработчиков с block=False, колбэков и задач планировщика, вызывающих действия сессии вне обработки
+# обновления пользователя. Такой дубликат либо отклоняется сразу (try_hold), либо ждёт своей очереди (hold).
+# Уникальные индексы в БД остаются последней защитой (например, при нескольких экземплярах бота).
+import asyncio
+from contextlib import asynccontextmanager
+
+try:
+    from backend import metrics
+except ImportError:
+    import metrics
+
+
+class UserLocks:
+    """Набор asyncio.Lock по user_id; замки удаляются, когда их никто не держит и не ждёт."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._locks = {}
+        self._users = {}  # user_id -> сколько корутин держат или ждут замок
+
+    def _enter(self, user_id):
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        self._users[user_id] = self._users.get(user_id, 0) + 1
+        return lock
+
+    def _leave(self, user_id):
+        left = self._users[user_id] - 1
+        if left:
+            self._users[user_id] = left
+        else:
+            del self._users[user_id]
+            del self._locks[user_id]
+
+    def is_busy(self, user_id) -> bool:
+        lock = self._locks.get(user_id)
+        return lock is not None and lock.locked()
+
+    @asynccontextmanager
+    async def try_hold(self, user_id, action: str = ""):
+        """Захватывает замок, только если он свободен. Отдаёт True/False — выполнять ли действие."""
+        if self.is_busy(user_id):
+            metrics.inc("user_lock_rejected_total", scope=self.name, action=action)
+            yield False
+            return
+        lock = self._enter(user_id)
+        try:
+            async with lock:
+                yield True
+        finally:
+            self._leave(user_id)
+
+    @asynccontextmanager
+    async def hold(self, user_id, action: str = "", timeout: float = None):
+        """Ждёт замок (не дольше timeout секунд). Отдаёт True, если замок получен, иначе False."""
+        lock = self._enter(user_id)
+        acquired = False
+        try:
+            try:
+                await asyncio.wait_for(lock.acquire(), timeout)
+                acquired = True
+            except asyncio.TimeoutError:
+                metrics.inc("user_lock_timeout_total", scope=self.name, action=action)
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+            self._leave(user_id)
@@ -1,8 +1,8 @@
 import os
-import openai
-from openai import OpenAI
 import logging
 import psycopg2
+import psycopg2.extras
+import psycopg2.errors
 import datetime
 from datetime import datetime, time
 from telegram import Update
@@ -13,6 +13,9 @@ import asyncio
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import CallbackQueryHandler
 import hashlib
+import functools
+import secrets
+from contextlib import asynccontextmanager
 import re
 import html
 import requests
@@ -34,14 +37,34 @@ import io
 from datetime import datetime
 import logging
 import sys
-from backend.openai_manager import client, get_or_create_openai_resources, system_message # Теперь импортируем client и system_message
-from backend.database import init_db
+from backend.openai_manager import system_message
+from backend.migrations import ensure_schema
+from backend.db_pool import get_pooled_connection, get_pool_stats, close_pool
+from backend.async_db import db_transaction, db_fetchall, db_fetchone, shutdown_db_executor
+from backend import metrics
+from backend.llm_gateway import run_assistant_task, complete
+from backend.openai_guard import CircuitOpenError
+from backend.grading_schema import GRADING_JSON_SCHEMA, parse_grading_response
+from backend.grading_cache import get_cached, put_cached, hit_rate as grading_cache_hit_rate
+from backend import session_tracker
+from backend import rollups
+from backend.hot_queries import (
+    TODAY_SESSIONS_WHERE, OPEN_SESSION_TODAY_SQL, ACTIVE_SESSION_SQL, SENTENCES_TODAY_SQL, TRANSLATION_SAVED_TODAY_SQL,
+    WEEK_TRANSLATIONS_COUNT_SQL, WEEK_MISTAKES_KPI_SQL, USER_STATS_TODAY_SQL,
+)
+from backend.leaderboards import LEADERBOARD_REFRESH_MINUTES, refresh_leaderboards, load_leaderboard
+from backend.activity_buffer import record_activity, flush_activity, flush_activity_sync, ACTIVITY_FLUSH_INTERVAL
+from backend.send_queue import enqueue_send, drain as send_queue_drain, queue_depth as send_queue_depth
+from backend.state_store import UserStateStore, purge_expired_user_state
+from backend.update_processor import PerUserUpdateProcessor
+from backend.user_locks import UserLocks
+from dataclasses import dataclass
 from user_analytics import prepare_aggregate_data_by_period_and_draw_analytic_for_user, aggregate_data_for_charts, create_analytics_figure_async
 from load_data_from_db import load_data_for_analytics 
 from users_comparison_analytics import create_comparison_report_async
 from dateutil.relativedelta import relativedelta 
 from datetime import date, timedelta
-from backend.config_mistakes_data import VALID_CATEGORIES, VALID_SUBCATEGORIES, VALID_CATEGORIES_lower, VALID_SUBCATEGORIES_lower
+from backend.config_mistakes_data import MISTAKE_PAIR_BY_LOWER
 
 application = None
 
@@ -134,18 +157,8 @@ else:
     logging.error("❌ Ошибка: DATABASE_URL не задан. Проверь переменные окружения!")
 
 def get_db_connection():
-    return psycopg2.connect(DATABASE_URL, sslmode='require')
-
-# Проверка подключения
-conn = get_db_connection()
-cursor = conn.cursor()
-cursor.execute("SELECT version();")
-db_version = cursor.fetchone()
-
-print(f"✅ База данных подключена! Версия: {db_version}")
-
-cursor.close()
-conn.close()
+    # Соединение из общего пула (backend/db_pool.py): conn.close() возвращает его в пул, а не рвёт TLS-сессию
+    return get_pooled_connection()
 
 # # === Настройки бота ===
 TELEGRAM_Deutsch_BOT_TOKEN = os.getenv("TELEGRAM_Deutsch_BOT_TOKEN")
@@ -235,246 +248,6 @@ async def send_german_news(context: CallbackContext):
 
 
 
-# Используем контекстный менеджер для того чтобы Автоматически разрывает соединение закрывая курсор и соединения
-def initialise_database():
-    with get_db_connection() as connection:
-        with connection.cursor() as curr:
-
-            # Table with user translations with 80 or more points
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_successful_translations (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                sentence_id BIGINT,
-                score INT NOT NULL,
-                attempt INT NOT NULL,
-                date TIMESTAMP
-                );
-            """)  
-
-            # ✅ Таблица с оригинальными предложениями
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_sentences (
-                        id SERIAL PRIMARY KEY,
-                        sentence TEXT NOT NULL
-                        
-                );
-            """)
-
-            # ✅ Таблица для переводов пользователей
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_translations (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT NOT NULL,
-                        id_for_mistake_table INT,
-                        session_id BIGINT,
-                        username TEXT,
-                        sentence_id INT NOT NULL,
-                        user_translation TEXT,
-                        score INT,
-                        feedback TEXT,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-
-            # ✅ Новая таблица для всех сообщений пользователей (чтобы учитывать ленивых)
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_messages (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT NOT NULL UNIQUE,
-                        username TEXT NOT NULL,
-                        message TEXT NOT NULL,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-
-            # ✅ Таблица для ошибок пользователя при разговоре с агентом (Расширенная версия)
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_conversation_errors (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT NOT NULL,
-                        session_id TEXT,          -- Важливо: ID сесії для звіту після дзвінка
-                        
-                        -- Основні дані про помилку
-                        sentence_with_error TEXT NOT NULL,
-                        corrected_sentence TEXT NOT NULL,
-                        
-                        -- Деталізація (як у bt_3_detailed_mistakes)
-                        error_type TEXT,          -- Головна категорія (напр. Grammar)
-                        error_subtype TEXT,       -- Підкатегорія (напр. Present Simple)
-                        explanation_ru TEXT,      -- Пояснення російською
-                        explanation_en TEXT,      -- Пояснення англійською (опціонально)
-                        
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-
-            curr.execute("""
-                CREATE INDEX IF NOT EXISTS idx_voice_errors_user
-                ON bt_3_conversation_errors (user_id);
-            """)
-
-            curr.execute("""
-                CREATE INDEX IF NOT EXISTS idx_voice_errors_session
-                ON bt_3_conversation_errors (session_id);
-            """)
-
-            # ✅ Таблица для закладок пользователей (когда пользователь говорит агенту в процессе голосового звонка в комнате что он хочет сохранить эту фразу или слово)
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_bookmarks (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                session_id TEXT,
-                phrase TEXT NOT NULL,
-                context_note TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-
-            # ✅ Таблица daily_sentences
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_daily_sentences (
-                        id SERIAL PRIMARY KEY,
-                        date DATE NOT NULL DEFAULT CURRENT_DATE,
-                        sentence TEXT NOT NULL,
-                        unique_id INT NOT NULL,
-                        user_id BIGINT,
-                        session_id BIGINT,
-                        id_for_mistake_table INT
-                );
-            """)
-
-            # ✅ Таблица user_progress
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_user_progress (
-                    session_id BIGINT PRIMARY KEY,
-                    user_id BIGINT,
-                    username TEXT,
-                    start_time TIMESTAMP,
-                    end_time TIMESTAMP,
-                    completed BOOLEAN DEFAULT FALSE,
-                    CONSTRAINT unique_user_session_bt_3 UNIQUE (user_id, start_time)
-                );
-            """)
-
-            # ✅ Таблица для хранения ошибок перевода
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_translation_errors (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT NOT NULL,
-                        category TEXT NOT NULL CHECK (category IN ('Грамматика', 'Лексика', 'Падежи', 'Орфография', 'Синтаксис')),  
-                        error_description TEXT NOT NULL,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            # ✅ Таблица для хранения запасных предложений в случае отсутствия связи Или ошибки на стороне Open AI API
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_spare_sentences (
-                    id SERIAL PRIMARY KEY,
-                    sentence TEXT NOT NULL
-                );
-                         
-            """)
-
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS bt_3_attempts (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    id_for_mistake_table INT NOT NULL,
-                    attempt INT DEFAULT 1,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    
-                    CONSTRAINT unique_attempt UNIQUE (user_id, id_for_mistake_table)
-                         
-                );
-            """)
-
-            # таблица для хранения id assistant API Open AI
-            curr.execute("""
-                CREATE TABLE IF NOT EXISTS assistants(
-                    task_name TEXT PRIMARY KEY,
-                    assistant_id TEXT NOT NULL
-                    );
-            """)
-
-
-            # ✅ Таблица для хранения ошибок
-            curr.execute("""
-                    CREATE TABLE IF NOT EXISTS bt_3_detailed_mistakes (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT NOT NULL,
-                        sentence TEXT NOT NULL,
-                        added_data TIMESTAMP,
-                        main_category TEXT CHECK (main_category IN (
-                            -- 🔹 Nouns
-                            'Nouns', 'Cases', 'Verbs', 'Tenses', 'Adjectives', 'Adverbs', 
-                            'Conjunctions', 'Prepositions', 'Moods', 'Word Order', 'Other mistake'
-                        )),  
-                        sub_category TEXT CHECK (sub_category IN (
-                            -- 🔹 Nouns
-                            'Gendered Articles', 'Pluralization', 'Compound Nouns', 'Declension Errors',
-                            
-                            -- 🔹 Cases
-                            'Nominative', 'Accusative', 'Dative', 'Genitive',
-                            'Akkusativ + Preposition', 'Dative + Preposition', 'Genitive + Preposition',
-                            
-                            -- 🔹 Verbs
-                            'Placement', 'Conjugation', 'Weak Verbs', 'Strong Verbs', 'Mixed Verbs', 
-                            'Separable Verbs', 'Reflexive Verbs', 'Auxiliary Verbs', 'Modal Verbs',
-                            'Verb Placement in Subordinate Clause',
-                            
-                            -- 🔹 Tenses
-                            'Present', 'Past', 'Simple Past', 'Present Perfect', 
-                            'Past Perfect', 'Future', 'Future 1', 'Future 2',
-                            'Plusquamperfekt Passive', 'Futur 1 Passive', 'Futur 2 Passive',
-
-                            -- 🔹 Adjectives
-                            'Endings', 'Weak Declension', 'Strong Declension', 'Mixed Declension', 
-                            'Placement', 'Comparative', 'Superlative', 'Incorrect Adjective Case Agreement',
-
-                            -- 🔹 Adverbs
-                            'Placement', 'Multiple Adverbs', 'Incorrect Adverb Usage',
-
-                            -- 🔹 Conjunctions
-                            'Coordinating', 'Subordinating', 'Incorrect Use of Conjunctions',
-
-                            -- 🔹 Prepositions
-                            'Accusative', 'Dative', 'Genitive', 'Two-way',
-                            'Incorrect Preposition Usage',
-
-                            -- 🔹 Moods
-                            'Indicative', 'Declarative', 'Interrogative', 'Imperative',
-                            'Subjunctive 1', 'Subjunctive 2',
-
-                            -- 🔹 Word Order
-                            'Standard', 'Inverted', 'Verb-Second Rule', 'Position of Negation',
-                            'Incorrect Order in Subordinate Clause', 'Incorrect Order with Modal Verb',
-
-                            -- 🔹 Other
-                            'Unclassified mistake' -- Для ошибок, которые не попали в категории
-                        )),
-                        
-                        mistake_count INT DEFAULT 1, -- Количество раз, когда ошибка была зафиксирована
-                        first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- Время первой фиксации ошибки
-                        last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- Время последнего появления ошибки
-                        error_count_week INT DEFAULT 0, -- Количество ошибок за последнюю неделю
-                        sentence_id INT,
-                        correct_translation TEXT NOT NULL,
-                        score INT,
-                        attempt INT DEFAULT 1, 
-
-                        -- ✅ Уникальный ключ для предотвращения дубликатов
-                        CONSTRAINT for_mistakes_table_bt_3 UNIQUE (user_id, sentence, main_category, sub_category)
-                    );
-
-            """)
-                         
-    connection.commit()
-
-    print("✅ Таблицы проверены и готовы к использованию.")
-
-initialise_database()
-
 async def log_all_messages(update: Update, context: CallbackContext):
     """Логируем ВСЕ текстовые сообщения для отладки."""
     try:
@@ -486,22 +259,92 @@ async def log_all_messages(update: Update, context: CallbackContext):
         logging.error(f"❌ Ошибка логирования сообщения: {e}")
     
 
+# ✅ Сервисные сообщения храним по сессиям: context.user_data["service_messages"] = {session_id | None: [message_id, ...]}.
+# None — сообщения до начала сессии (выбор темы и т.п.). Списки ограничены, старые сессии вытесняются.
+SERVICE_MESSAGES_PER_SESSION_LIMIT = int(os.getenv("SERVICE_MESSAGES_PER_SESSION_LIMIT", "300"))
+SERVICE_MESSAGES_SESSIONS_KEPT = 3
+TELEGRAM_DELETE_BATCH_SIZE = 100  # лимит deleteMessages в Bot API
+
+
 # Функция для добавления в словарь всех id Сообщений которые потом я буду удалять, Это служебные сообщения вспомогательные
 def add_service_msg_id(context, message_id):
-    context_id = id(context)
-    logging.info(f"DEBUG: context_id={context_id} в add_service_msg_id, добавляем message_id={message_id}")
-    if "service_message_ids" not in context.user_data:
-        logging.info(f"📝 Создаём service_message_ids для user_id={context._user_id}")
-        context.user_data["service_message_ids"] = []
-    context.user_data["service_message_ids"].append(message_id)
-    logging.info(f"DEBUG: Добавлен message_id: {message_id}, текущий список: {context.user_data['service_message_ids']}")
+    sessions = context.user_data.setdefault("service_messages", {})
+    session_key = context.user_data.get("active_session_id")
+    message_ids = sessions.setdefault(session_key, [])
+    message_ids.append(message_id)
+    if len(message_ids) > SERVICE_MESSAGES_PER_SESSION_LIMIT:
+        del message_ids[:-SERVICE_MESSAGES_PER_SESSION_LIMIT]
+    while len(sessions) > SERVICE_MESSAGES_SESSIONS_KEPT:
+        sessions.pop(next(iter(sessions)))
+    logging.debug(f"DEBUG: Добавлен message_id={message_id} (сессия {session_key}), всего в сессии: {len(message_ids)}")
+
+
+def pop_service_msg_ids(context, session_id):
+    """Забирает id сервисных сообщений сессии (и сообщений до её начала) для удаления."""
+    sessions = context.user_data.get("service_messages", {})
+    return sessions.pop(None, []) + sessions.pop(session_id, [])
 
 
-#Имитация набора текста с typing-индикатором
-async def simulate_typing(context, chat_id, duration=3):
-    """Эмулирует набор текста в чате."""
-    await context.bot.send_chat_action(chat_id=chat_id, action="typing")
-    await asyncio.sleep(duration)  # Имитация задержки перед отправкой текста
+# ✅ Замок жизненного цикла сессии пользователя: выбор темы → старт → завершение (см. backend/user_locks.py)
+session_locks = UserLocks("session")
+
+
+def session_action(action, wait_timeout=None):
+    """
+    Выполняет обработчик под замком пользователя.
+    wait_timeout=None — повторное нажатие, пока идёт предыдущее действие, отклоняется сразу (до запросов к модели);
+    иначе действие ждёт своей очереди не дольше wait_timeout секунд.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+            user = update.effective_user
+            if user is None:
+                return await func(update, context, *args, **kwargs)
+            if wait_timeout is None:
+                guard = session_locks.try_hold(user.id, action)
+            else:
+                guard = session_locks.hold(user.id, action, timeout=wait_timeout)
+            async with guard as acquired:
+                if acquired:
+                    return await func(update, context, *args, **kwargs)
+            logging.info(f"⏳ Действие '{action}' пользователя {user.id} отклонено: выполняется предыдущее")
+            if update.effective_message:
+                msg = await update.effective_message.reply_text("⏳ Предыдущее действие ещё выполняется, подождите немного.")
+                add_service_msg_id(context, msg.message_id)
+        return wrapper
+    return decorator
+
+
+# ✅ Индикатор набора, пока идёт реальная работа (ответ модели), а не фиксированная пауза.
+# Telegram показывает "typing" ~5 секунд, поэтому повторяем каждые 4. Параллельные проверки в одном чате
+# делят один цикл отправки.
+TYPING_REFRESH_SECONDS = 4
+_typing_loops = {}  # chat_id -> [task, число активных проверок]
+
+
+async def _typing_loop(bot, chat_id):
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action="typing")
+        except TelegramError as e:
+            logging.debug(f"typing indicator: {e}")
+        await asyncio.sleep(TYPING_REFRESH_SECONDS)
+
+
+@asynccontextmanager
+async def typing_while_working(bot, chat_id):
+    entry = _typing_loops.get(chat_id)
+    if entry is None:
+        entry = _typing_loops[chat_id] = [asyncio.create_task(_typing_loop(bot, chat_id)), 0]
+    entry[1] += 1
+    try:
+        yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            entry[0].cancel()
+            _typing_loops.pop(chat_id, None)
 
 
 
@@ -515,8 +358,6 @@ async def send_main_menu(update: Update, context: CallbackContext):
         ["🎙 Начать урок", "👥 Групповой звонок"]
     ]
     
-    # создаем в словаре клю service_message_ids Список для хранения всех id Сообщений, Для того чтобы потом можно было их удалить после выполнения перевода
-    context.user_data.setdefault("service_message_ids", [])
 
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
@@ -564,51 +405,19 @@ def get_public_web_url():
     
     return "http://localhost:8000"  # Локальный fallback (если нужно)
 
-async def handle_button_click(update: Update, context: CallbackContext):
-    """Обрабатывает нажатия на кнопки главного меню."""
-    
-    print("🛠 handle_button_click() вызван!")  # Логируем сам вызов функции
-
-    if not update.message:
-        print("❌ Ошибка: update.message отсутствует!")
-        return
-    
-    text = update.message.text.strip()
-    print(f"📥 Получено сообщение: {text}")
-
-    # Добавляем message_id пользовательского сообщения в список сервисных сообщений
-    add_service_msg_id(context, update.message.message_id)
-    logging.info(f"📩 Добавлен message_id пользовательского сообщения: {update.message.message_id}")
-    
-    if text == "📌 Выбрать тему":
-        await choose_topic(update, context)
-    elif text == "🚀 Начать перевод":
-        await letsgo(update, context)
-    elif text == "✅ Завершить перевод":
-        await done(update, context)
-    elif text == "🟡 Посмотреть свою статистику":
-        await user_stats(update, context)
-    elif text == "📜 Проверить перевод":
-        logging.info(f"📌 Пользователь {update.message.from_user.id} нажал кнопку '📜 Проверить перевод'. Запускаем проверку.")
-        await check_translation_from_text(update, context)  # ✅ Теперь сразу запускаем проверку переводов
-    
-    elif text == "🎙 Начать урок":
-        #frontend_url = "https://83df2cddf824.ngrok-free.app"
-        frontend_url = await asyncio.to_thread(get_public_web_url)
-        message_text = (
-            "Your Room for conversation is ready\n\n"
-            f'Press <a href="{frontend_url}">the link</a>, to connect the room'
-        )
- 
-        await update.message.reply_text(
-        text=message_text,
-        parse_mode='HTML'
-        )
-
+async def send_lesson_link(update: Update, context: CallbackContext):
+    """Кнопка '🎙 Начать урок': отправляет ссылку на комнату для разговора."""
+    #frontend_url = "https://83df2cddf824.ngrok-free.app"
+    frontend_url = await asyncio.to_thread(get_public_web_url)
+    message_text = (
+        "Your Room for conversation is ready\n\n"
+        f'Press <a href="{frontend_url}">the link</a>, to connect the room'
+    )
 
-        #await start_lesson(update, context)
-    #elif text == "👥 Групповой звонок":
-        #await group_call(update, context)
+    await update.message.reply_text(
+    text=message_text,
+    parse_mode='HTML'
+    )
 
 
 # 🔹 **Функция, которая запускает проверку переводов**
@@ -655,7 +464,6 @@ async def check_translation_from_text(update: Update, context: CallbackContext):
 
 async def start(update: Update, context: CallbackContext):
     """Запуск бота и отправка главного меню."""
-    context.user_data.setdefault("service_message_ids", [])  # Инициализируем список
     await send_main_menu(update, context)
 
 async def log_message(update: Update, context: CallbackContext):
@@ -674,24 +482,8 @@ async def log_message(update: Update, context: CallbackContext):
     # Логируем данные для диагностики
     print(f"📥 Получено сообщение от {username} ({user.id}): {message_text}")
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try: 
-        cursor.execute("""
-            INSERT INTO bt_3_messages (user_id, username, message)
-            VALUES(%s, %s, %s)
-            ON CONFLICT (user_id)
-            DO UPDATE SET timestamp = NOW();
-            """,
-            (user.id, username, 'user_message')
-        )
-
-        conn.commit()
-    except Exception as e:
-        print(f"❌ Ошибка при записи в базу: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+    # ✅ Только отметка в памяти: в bt_3_messages пишет flush_activity одним upsert раз в ACTIVITY_FLUSH_INTERVAL сек
+    record_activity(user.id, username)
 
 # утреннее приветствие членом группы
 async def send_morning_reminder(context:CallbackContext):
@@ -723,14 +515,14 @@ async def send_morning_reminder(context:CallbackContext):
 
 
 
+@session_action("letsgo")
 async def letsgo(update: Update, context: CallbackContext):
+    started = asyncio.get_running_loop().time()
     user = update.message.from_user
     user_id = user.id
     chat_id = update.message.chat_id  # ✅ Исправленный атрибут
     username = user.username or user.first_name
 
-    context.user_data.setdefault("service_message_ids", [])
-
      # ✅ Если словаря `start_times` нет — создаём его (это может быть в начале запуска бота, Когда ещё нет словаря)
     if "start_times" not in context.user_data:
         context.user_data["start_times"] = {}
@@ -755,44 +547,41 @@ async def letsgo(update: Update, context: CallbackContext):
         add_service_msg_id(context, msg_1.message_id)
         return  # ⛔ Прерываем выполнение функции, если тема не выбрана
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # 🔹 Генерируем session_id на основе user_id + текущего времени
+    session_id = int(hashlib.md5(f"{user_id}{datetime.now()}".encode()).hexdigest(), 16) % (10 ** 12)
 
-    # Проверяем, не запустил ли уже пользователь перевод (но только за СЕГОДНЯ!)
-    cursor.execute("""
-        SELECT user_id FROM bt_3_user_progress
-        WHERE user_id = %s AND start_time::date = CURRENT_DATE AND completed = FALSE;
-        """, (user_id, ))
-    active_session = cursor.fetchone()
+    def start_session(cursor):
+        # Проверяем, не запустил ли уже пользователь перевод (но только за СЕГОДНЯ!)
+        cursor.execute(OPEN_SESSION_TODAY_SQL, (user_id, ))
+        if cursor.fetchone() is not None:
+            return False
 
-    if active_session is not None:
+        # ✅ **Автоматически завершаем вчерашние сессии**
+        rollups.close_sessions(cursor, "user_id = %s AND start_time < CURRENT_DATE", (user_id,))
+
+        # ✅ **Создаём новую запись в `user_progress`, НЕ ЗАТИРАЯ старые сессии и получаем `session_id`****
+        cursor.execute("""
+            INSERT INTO bt_3_user_progress (session_id, user_id, username, start_time, completed) 
+            VALUES (%s, %s, %s, NOW(), FALSE);
+        """, (session_id, user_id, username))
+        return True
+
+    try:
+        session_started = await db_transaction("letsgo_start_session", start_session)
+    except psycopg2.errors.UniqueViolation:
+        # Параллельный старт (например, другой экземпляр бота) успел раньше — uq_bt_3_user_progress_open_session
+        session_started = False
+
+    if not session_started:
         logging.info(f"⏳ Пользователь {username} ({user_id}) уже начал перевод сегодня.")
         #await update.message.reply_animation("https://media.giphy.com/media/3o7aD2saalBwwftBIY/giphy.gif")
         msg_2 = await update.message.reply_text("❌ Вы уже начали перевод! Завершите его перед повторным запуском нажав на кнопку '✅ Завершить перевод'")
         logging.info(f"📩 Отправлено сообщение об активной сессии с ID={msg_2.message_id}")
         add_service_msg_id(context, msg_2.message_id)
-        cursor.close()
-        conn.close()
         return
 
-    # ✅ **Автоматически завершаем вчерашние сессии**
-    cursor.execute("""
-        UPDATE bt_3_user_progress
-        SET end_time = NOW(), completed = TRUE
-        WHERE user_id = %s AND start_time::date < CURRENT_DATE AND completed = FALSE;
-    """, (user_id,))
-
-    # 🔹 Генерируем session_id на основе user_id + текущего времени
-    session_id = int(hashlib.md5(f"{user_id}{datetime.now()}".encode()).hexdigest(), 16) % (10 ** 12)
-
-    # ✅ **Создаём новую запись в `user_progress`, НЕ ЗАТИРАЯ старые сессии и получаем `session_id`****
-    cursor.execute("""
-        INSERT INTO bt_3_user_progress (session_id, user_id, username, start_time, completed) 
-        VALUES (%s, %s, %s, NOW(), FALSE);
-    """, (session_id, user_id, username))
-    
-    conn.commit()
-
+    # Дальнейшие сервисные сообщения относятся к этой сессии (их удалит done())
+    context.user_data["active_session_id"] = session_id
 
     # ✅ **Выдаём новые предложения**
     sentences = [s.strip() for s in await get_original_sentences(user_id, context) if s.strip()]
@@ -801,16 +590,8 @@ async def letsgo(update: Update, context: CallbackContext):
         msg_3 = await update.message.reply_text("❌ Ошибка: не удалось получить предложения. Попробуйте позже.")
         logging.info(f"📩 Отправлено сообщение: ❌ Ошибка: не удалось получить предложения. Попробуйте позже с ID={msg_3.message_id}")
         add_service_msg_id(context, msg_3.message_id)       
-        cursor.close()
-        conn.close()
         return
 
-    # Определяем стартовый индекс (если пользователь делал /getmore)
-    cursor.execute("""
-        SELECT COUNT(*) FROM bt_3_daily_sentences WHERE date = CURRENT_DATE AND user_id = %s;
-    """, (user_id,))
-    last_index = cursor.fetchone()[0]
-
     # Добавляем логирование, чтобы видеть, были ли исправления
     original_sentences = sentences
     sentences = correct_numbering(sentences)
@@ -819,43 +600,41 @@ async def letsgo(update: Update, context: CallbackContext):
         if before != after:
             logging.info(f"⚠️ Исправлена нумерация: '{before}' → '{after}'")
 
-    # Записываем bсе предложения в базу
-    tasks = []
-
-    for i, sentence in enumerate(sentences, start=last_index+1):
-        # ✅ Проверяем, есть ли уже предложение с таким текстом
-        cursor.execute("""
-            SELECT id_for_mistake_table
-            FROM bt_3_daily_sentences
-            WHERE sentence = %s
-            LIMIT 1;
-        """, (sentence, ))
-        result = cursor.fetchone()
-
-        if result:
-            id_for_mistake_table = result[0]
-            logging.info(f"✅ Найден существующий id_for_mistake_table = {id_for_mistake_table} для текста: '{sentence}'")
-        else:
-            # ✅ Если текста нет — получаем максимальный ID и создаём новый
-            cursor.execute("""
-                SELECT MAX(id_for_mistake_table) FROM bt_3_daily_sentences;
-            """)
-            result = cursor.fetchone()
-            max_id = result[0] if result and result[0] is not None else 0
-            id_for_mistake_table = max_id + 1
-            logging.info(f"✅ Присваиваем новый id_for_mistake_table = {id_for_mistake_table} для текста: '{sentence}'")
-
-        # ✅ Вставляем предложение в таблицу с id_for_mistake_table
+    def save_sentences(cursor):
+        # ✅ Одним запросом: находим/выделяем id_for_mistake_table для всех предложений сразу
+        # (словарь bt_3_sentence_dictionary с уникальным хэшем текста и последовательностью вместо MAX()+1)
+        # и вставляем все строки сессии одним multi-row INSERT.
+        # Нумерация продолжается после уже выданных сегодня предложений (если пользователь делал /getmore).
         cursor.execute("""
+            WITH input AS (
+                SELECT s.sentence, s.ord
+                FROM unnest(%s::text[]) WITH ORDINALITY AS s(sentence, ord)
+            ),
+            resolved AS (
+                INSERT INTO bt_3_sentence_dictionary (sentence_hash, sentence)
+                SELECT DISTINCT ON (md5(sentence)) md5(sentence), sentence FROM input
+                ON CONFLICT (sentence_hash) DO UPDATE
+                    SET sentence = COALESCE(bt_3_sentence_dictionary.sentence, EXCLUDED.sentence)
+                RETURNING id, sentence_hash
+            ),
+            last_index AS (
+                SELECT COUNT(*) AS n FROM bt_3_daily_sentences WHERE date = CURRENT_DATE AND user_id = %s
+            )
             INSERT INTO bt_3_daily_sentences (date, sentence, unique_id, user_id, session_id, id_for_mistake_table)
-            VALUES (CURRENT_DATE, %s, %s, %s, %s, %s);
-        """, (sentence, i, user_id, session_id, id_for_mistake_table))
-        
-        tasks.append(f"{i}. {sentence}")
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+            SELECT CURRENT_DATE, i.sentence, last_index.n + i.ord, %s, %s, r.id
+            FROM input i
+            JOIN resolved r ON r.sentence_hash = md5(i.sentence)
+            CROSS JOIN last_index
+            ORDER BY i.ord
+            RETURNING unique_id, sentence, id_for_mistake_table;
+        """, (sentences, user_id, user_id, session_id))
+        rows = sorted(cursor.fetchall())
+        for unique_id, sentence, id_for_mistake_table in rows:
+            logging.info(f"✅ id_for_mistake_table = {id_for_mistake_table} для предложения №{unique_id}: '{sentence}'")
+        rollups.add_sentences(cursor, user_id, username, len(rows))
+        return [f"{unique_id}. {sentence}" for unique_id, sentence, _ in rows]
+
+    tasks = await db_transaction("letsgo_save_sentences", save_sentences)
 
     logging.info(f"🚀 Пользователь {username} ({user_id}) начал перевод. Записано {len(tasks)} предложений.")
 
@@ -883,41 +662,32 @@ async def letsgo(update: Update, context: CallbackContext):
     )
     logging.info(f"📩 Отправлено сообщение с предложениями с ID={msg_5.message_id}")
     add_service_msg_id(context, msg_5.message_id)
+    # ⏱ Время от нажатия «Начать перевод» до получения предложений
+    metrics.observe("session_start_seconds", asyncio.get_running_loop().time() - started)
 
 
 
-# 🔹 **Функция, которая запоминает переводы, но не проверяет их**
-async def handle_user_message(update: Update, context: CallbackContext):
-    # ✅ Проверяем, содержит ли update.message данные
-    if update.message is None or update.message.text is None:
-        logging.warning("⚠️ update.message отсутствует или пустое.")
-        return  # ⛔ Прерываем выполнение, если сообщение отсутствует
-
-    user_id = update.message.from_user.id
-    text = update.message.text.strip()
+# Строки вида "1. перевод" (поддержка многострочных сообщений); компилируется один раз
+TRANSLATION_LINE_PATTERN = re.compile(r"^(\d+)\.\s*([^\d\n]+(?:\n[^\d\n]+)*)", re.MULTILINE)
 
-    # Проверяем, является ли сообщение переводом (поддержка многострочных сообщений)
-    pattern = re.compile(r"^(\d+)\.\s*([^\d\n]+(?:\n[^\d\n]+)*)", re.MULTILINE)
-    translations = pattern.findall(text)
 
-    if translations:
-        if "pending_translations" not in context.user_data:
-            context.user_data["pending_translations"] = []
-
-        for num, trans in translations:
-            full_translation = f"{num}. {trans.strip()}"
-            context.user_data["pending_translations"].append(full_translation)
-            logging.info(f"📝 Добавлен перевод: {full_translation}")
-
-        msg = await update.message.reply_text(
-            "✅ Ваш перевод сохранён.\n\n"
-            "Когда будете готовы, нажмите:\n"
-            "📜 Проверить перевод.\n\n"
-            "✅ Завершить перевод чтобы зафиксировать время.\n"
-            )
-        add_service_msg_id(context, msg.message_id)
-    else:
-        await handle_button_click(update, context)
+# 🔹 **Функция, которая запоминает переводы, но не проверяет их**
+async def store_pending_translations(update: Update, context: CallbackContext, translations):
+    if "pending_translations" not in context.user_data:
+        context.user_data["pending_translations"] = []
+
+    for num, trans in translations:
+        full_translation = f"{num}. {trans.strip()}"
+        context.user_data["pending_translations"].append(full_translation)
+        logging.info(f"📝 Добавлен перевод: {full_translation}")
+
+    msg = await update.message.reply_text(
+        "✅ Ваш перевод сохранён.\n\n"
+        "Когда будете готовы, нажмите:\n"
+        "📜 Проверить перевод.\n\n"
+        "✅ Завершить перевод чтобы зафиксировать время.\n"
+        )
+    add_service_msg_id(context, msg.message_id)
 
 
 async def delete_message_with_retry(bot, chat_id, message_id, retries=3, delay=2):
@@ -939,6 +709,42 @@ async def delete_message_with_retry(bot, chat_id, message_id, retries=3, delay=2
     print(f"❌ Не удалось удалить сообщение {message_id} после {retries} попыток")
 
 
+async def delete_service_messages(bot, chat_id, message_ids):
+    """Удаляет сообщения пачками через deleteMessages (до 100 за вызов); при ошибке пачки — по одному."""
+    message_ids = list(dict.fromkeys(message_ids))
+    started = asyncio.get_running_loop().time()
+    for i in range(0, len(message_ids), TELEGRAM_DELETE_BATCH_SIZE):
+        chunk = message_ids[i:i + TELEGRAM_DELETE_BATCH_SIZE]
+        try:
+            # Уже удалённые / слишком старые сообщения Telegram просто пропускает
+            await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+        except TelegramError as e:
+            logging.warning(f"⚠️ Пакетное удаление {len(chunk)} сообщений не удалось ({e}), удаляем по одному")
+            for message_id in chunk:
+                await delete_message_with_retry(bot, chat_id, message_id, retries=1)
+        metrics.inc("service_messages_deleted_total", len(chunk))
+    metrics.observe("service_messages_cleanup_seconds", asyncio.get_running_loop().time() - started)
+    logging.info(f"🧹 Удалено сервисных сообщений: {len(message_ids)} в чате {chat_id}")
+
+
+_cleanup_tasks = set()
+
+
+def schedule_service_message_cleanup(bot, chat_id, message_ids):
+    """Удаление сервисных сообщений в фоне — пользователь не ждёт его после итогового ответа."""
+    if not message_ids:
+        return
+    task = asyncio.create_task(delete_service_messages(bot, chat_id, message_ids))
+    # Держим ссылку на задачу, иначе сборщик мусора может остановить её раньше времени
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+
+# Сколько done() ждёт незавершённые проверки переводов сессии (раньше — до 40 опросов БД по 5 секунд)
+SESSION_DONE_TIMEOUT = float(os.getenv("SESSION_DONE_TIMEOUT", "120"))
+
+
+@session_action("done", wait_timeout=SESSION_DONE_TIMEOUT)
 async def done(update: Update, context: CallbackContext):
     user = update.message.from_user
     user_id = user.id
@@ -946,102 +752,55 @@ async def done(update: Update, context: CallbackContext):
     logging.info(f"DEBUG: context_id={context_id} в done")
 
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # 🔹 Проверяем, есть ли у пользователя активная сессия
-    cursor.execute("""
-        SELECT session_id
-        FROM bt_3_user_progress 
-        WHERE user_id = %s AND completed = FALSE
-        ORDER BY start_time DESC
-        LIMIT 1;""", 
-        (user_id,))
-    session = cursor.fetchone()
+    session = await db_fetchone("done_active_session", ACTIVE_SESSION_SQL, (user_id,))
 
     if not session:
         msg_1 = await update.message.reply_text("❌ У вас нет активных сессий! Используйте кнопки: '📌 Выбрать тему' -> '🚀 Начать перевод' чтобы начать.")
         logging.info(f"📩 Отправлено сообщение об отсутствии сессии с ID={msg_1.message_id}")
         add_service_msg_id(context, msg_1.message_id)
-        cursor.close()
-        conn.close()
         return
     session_id = session[0]   # ID текущей сессии
 
-    message_ids = context.user_data.get("service_message_ids", [])
 
     # 📊 Получаем общее количество предложений
-    cursor.execute("""
+    total_sentences = (await db_fetchone("done_total_sentences", """
         SELECT COUNT(*) 
         FROM bt_3_daily_sentences 
         WHERE user_id = %s AND session_id = %s;
-        """, (user_id, session_id))
-    
-    total_sentences = cursor.fetchone()[0]
+        """, (user_id, session_id)))[0]
     logging.info(f"🔄 Ожидаем записи всех переводов пользователя {user_id}. Всего предложений: {total_sentences}")
 
     # Получаем количество отправленных переводов (из pending_translations)
     pending_translations_count = len(context.user_data.get("pending_translations", []))
     logging.info(f"📤 Пользователь отправил переводов: {pending_translations_count}")
 
-    # Даем время для завершения асинхронных задач (например, записи переводов из check_translation_from_text)
-    logging.info("⏳ Даем время для завершения записи переводов в базу...")
-    await asyncio.sleep(5)  # Задержка 5 секунд перед первой проверкой
-
-    # Получаем количество записанных переводов в базе
-    cursor.execute("""
-        SELECT COUNT(*) 
-        FROM bt_3_translations 
-        WHERE user_id = %s AND session_id = %s;
-        """, (user_id, session_id))
-    translated_count = cursor.fetchone()[0]
-    logging.info(f"📬 Уже записано переводов: {translated_count}/{pending_translations_count}")
-
-
     # Проверяем, если отправленных переводов больше, чем предложений в сессии
     if pending_translations_count > total_sentences:
         logging.warning(f"⚠️ pending_translations_count ({pending_translations_count}) больше total_sentences ({total_sentences})")
         pending_translations_count = min(pending_translations_count, total_sentences)
 
-    #await asyncio.sleep(10)
-
+    # ✅ Ждём завершения проверок, которые ещё идут (check_user_translation отмечает каждую в session_tracker).
+    # Соединение с БД во время ожидания не занято; выходим сразу после последней проверки или по таймауту
+    in_flight = session_tracker.pending(session_id)
+    if in_flight:
+        logging.info(f"⏳ Ожидаем завершения {in_flight} проверок сессии {session_id} (не дольше {SESSION_DONE_TIMEOUT} сек)...")
+        if not await session_tracker.wait_idle(session_id, SESSION_DONE_TIMEOUT):
+            logging.warning(f"⚠️ Не все проверки сессии {session_id} завершились за {SESSION_DONE_TIMEOUT} сек: "
+                            f"осталось {session_tracker.pending(session_id)}")
 
-    # Ожидаем, пока все отправленные переводы не запишутся в базу
-    max_attempts = 40  # Максимум 30 попыток (30 * 5 секунд = 150 секунд)
-    attempt = 0
-    start_time = datetime.now()
-
-    logging.info(f"🚩 START while-loop: translated_count={translated_count}, pending_translations_count={pending_translations_count}")
-
-    while translated_count < pending_translations_count and attempt < max_attempts:
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM bt_3_translations 
-            WHERE user_id = %s AND session_id = %s;
-            """, (user_id, session_id))
-        translated_count = cursor.fetchone()[0]
-        elapsed_time = (datetime.now() - start_time).total_seconds()
-        logging.info(f"⌛ Проверяем запись переводов: {translated_count}/{pending_translations_count}. Прошло {elapsed_time:.1f} сек, попытка {attempt + 1}")
-
-        if translated_count >= pending_translations_count:
-            logging.info(f"✅ Все отправленные переводы записаны: {translated_count}/{pending_translations_count}")
-            break
-
-        await asyncio.sleep(5)  # Ждем 5 секунд
-        attempt += 1
-
-    # Логируем, если не все переводы записаны
-    if translated_count < pending_translations_count and attempt >= max_attempts:
-        logging.warning(f"⚠️ Не все переводы записаны после {max_attempts} попыток: {translated_count}/{pending_translations_count}")
+    # Получаем количество записанных переводов в базе
+    translated_count = (await db_fetchone("done_count_translations", """
+        SELECT COUNT(*) 
+        FROM bt_3_translations 
+        WHERE user_id = %s AND session_id = %s;
+        """, (user_id, session_id)))[0]
+    logging.info(f"📬 Записано переводов: {translated_count}/{pending_translations_count}")
 
 
-    # Завершаем сессию
-    cursor.execute("""
-        UPDATE bt_3_user_progress
-        SET end_time = NOW(), completed = TRUE
-        WHERE user_id = %s AND session_id = %s AND completed = FALSE;
-        """, (user_id, session_id))
-    conn.commit()
+    # Завершаем сессию (вместе с дневным агрегатом для отчётов)
+    await db_transaction("done_close_session", rollups.close_sessions,
+                         "user_id = %s AND session_id = %s", (user_id, session_id))
 
     # Сбрасываем pending_translations
     context.user_data["pending_translations"] = []
@@ -1066,21 +825,10 @@ async def done(update: Update, context: CallbackContext):
             f"Все {total_sentences} предложений этой сессии переведены! 🚀",
             parse_mode="Markdown"
         )
-    
 
-    # Deletion messages from the chat
-    for message_id in message_ids:
-        try:
-            await delete_message_with_retry(context.bot, update.effective_chat.id, message_id)
-        except TelegramError as e:
-            logging.warning(f"⚠️ Не удалось удалить сервисное сообщение {message_id}: {e}")
-    
-    # Сбрасываем список
-    logging.debug(f"DEBUG: Сбрасываем service_message_ids. Было: {context.user_data.get('service_message_ids', '[] (ключ отсутствовал или пуст)')}")
-    context.user_data["service_message_ids"] = []
-
-    cursor.close()
-    conn.close()
+    # ✅ Удаляем сервисные сообщения сессии пачками и в фоне — итоговый ответ уже отправлен
+    schedule_service_message_cleanup(context.bot, update.effective_chat.id, pop_service_msg_ids(context, session_id))
+    context.user_data.pop("active_session_id", None)
     
 
 def correct_numbering(sentences):
@@ -1097,15 +845,11 @@ def correct_numbering(sentences):
 
 
 # Создаёт кнопки с темами (Business, Medicine, Hobbies и т. д.).
+@session_action("choose_topic")
 async def choose_topic(update: Update, context: CallbackContext):
     print("🔹 Функция choose_topic() вызвана!")  # 👈 Логируем вызов
     global TOPICS
     
-    context.user_data.setdefault("service_message_ids", [])
-    message_ids = context.user_data["service_message_ids"]
-    #message_ids = context.user_data.get("service_message_ids", [])
-    print(f"DEBUG: message_ids in choose_topic function: {message_ids}")
-    
     buttons = []
     row = []
     for i, topic in enumerate(TOPICS, 1):
@@ -1146,57 +890,154 @@ async def topic_selected(update: Update, context: CallbackContext):
 
 
 
+# === Запас предложений по темам ===
+# letsgo не должен ждать GPT: предложения генерируются заранее (ночью и при опустошении запаса)
+# и лежат в bt_3_sentence_inventory. Старт сессии только атомарно забирает N свободных строк.
+SENTENCE_INVENTORY_TARGET = int(os.getenv("SENTENCE_INVENTORY_TARGET", "35"))  # ~5 сессий на тему
+SENTENCE_INVENTORY_LOW_WATERMARK = int(os.getenv("SENTENCE_INVENTORY_LOW_WATERMARK", "14"))
+SENTENCE_INVENTORY_BATCH = int(os.getenv("SENTENCE_INVENTORY_BATCH", "10"))
+
+_inventory_refills_in_progress = set()
+_inventory_refill_tasks = set()
+
+
+def clean_generated_sentences(raw_text):
+    """Разбивает ответ GPT на строки и оставляет только нормальные русские предложения без нумерации."""
+    cleaned = []
+    for line in raw_text.split("\n"):
+        sentence = re.sub(r"^\s*(?:\d+[.)]|[-*•])\s*", "", line).strip().strip('"«»').strip()
+        if not sentence or not re.search(r"[а-яА-ЯёЁ]", sentence):
+            continue
+        if len(sentence.split()) < 4 or len(sentence) > 400:
+            continue
+        if sentence not in cleaned:
+            cleaned.append(sentence)
+    return cleaned
+
+
+async def generate_sentence_batch(topic, num_sentences):
+    """Один запрос к GPT за пачкой предложений по теме (без запасных вариантов)."""
+    user_message = f"""
+    Number of sentences: {num_sentences}. Topic: "{topic}".
+    """
+    raw_text = await run_assistant_task("generate_sentences", user_message, "generate_sentences_inventory")
+    return clean_generated_sentences(raw_text)
+
+
+async def claim_inventory_sentences(topic, count, user_id):
+    """Атомарно забирает до count свободных предложений темы. Параллельные сессии не получат одни и те же строки."""
+    rows = await db_fetchall("inventory_claim", """
+        UPDATE bt_3_sentence_inventory
+        SET claimed_by = %s, claimed_at = NOW()
+        WHERE id IN (
+            SELECT id FROM bt_3_sentence_inventory
+            WHERE topic = %s AND claimed_at IS NULL
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING sentence;
+    """, (user_id, topic, count))
+    return [row[0] for row in rows]
+
+
+async def count_inventory(topic):
+    row = await db_fetchone("inventory_count", """
+        SELECT COUNT(*) FROM bt_3_sentence_inventory WHERE topic = %s AND claimed_at IS NULL;
+    """, (topic,))
+    available = row[0] if row else 0
+    metrics.set_gauge("sentence_inventory_available", available, topic=topic)
+    if available < SENTENCE_INVENTORY_LOW_WATERMARK:
+        logging.warning(f"⚠️ Запас предложений по теме '{topic}' ниже порога: {available} < {SENTENCE_INVENTORY_LOW_WATERMARK}")
+        metrics.inc("sentence_inventory_low_watermark_total", topic=topic)
+    return available
+
+
+async def replenish_topic_inventory(topic):
+    """Пополняет запас темы до SENTENCE_INVENTORY_TARGET пачками по SENTENCE_INVENTORY_BATCH."""
+    if topic in _inventory_refills_in_progress:
+        return 0
+    _inventory_refills_in_progress.add(topic)
+    added = 0
+    try:
+        missing = SENTENCE_INVENTORY_TARGET - await count_inventory(topic)
+        while missing > 0:
+            batch = await generate_sentence_batch(topic, min(SENTENCE_INVENTORY_BATCH, missing))
+            if not batch:
+                logging.warning(f"⚠️ GPT не вернул предложений для темы '{topic}', пополнение прервано.")
+                break
+
+            def save_batch(cursor):
+                psycopg2.extras.execute_values(cursor, """
+                    INSERT INTO bt_3_sentence_inventory (topic, sentence) VALUES %s;
+                """, [(topic, sentence) for sentence in batch])
+
+            await db_transaction("inventory_save_batch", save_batch)
+            added += len(batch)
+            missing -= len(batch)
+        logging.info(f"✅ Запас по теме '{topic}' пополнен на {added} предложений.")
+    except Exception as e:
+        logging.error(f"❌ Ошибка пополнения запаса по теме '{topic}': {e}")
+    finally:
+        _inventory_refills_in_progress.discard(topic)
+    metrics.inc("sentence_inventory_generated_total", added, topic=topic)
+    return added
+
+
+async def refill_inventory_if_low(topic):
+    if await count_inventory(topic) < SENTENCE_INVENTORY_LOW_WATERMARK:
+        await replenish_topic_inventory(topic)
+
+
+def schedule_inventory_refill(topic):
+    """Проверяет запас темы и при необходимости пополняет его в фоне, не задерживая ответ пользователю."""
+    if topic not in _inventory_refills_in_progress:
+        task = asyncio.create_task(refill_inventory_if_low(topic))
+        # Держим ссылку на задачу, иначе сборщик мусора может остановить её раньше времени
+        _inventory_refill_tasks.add(task)
+        task.add_done_callback(_inventory_refill_tasks.discard)
+
+
+async def replenish_sentence_inventory(context: CallbackContext = None):
+    """Плановое пополнение запаса по всем темам (запускается вне часов пик)."""
+    for topic in TOPICS:
+        await replenish_topic_inventory(topic)
+
+
 # === Функция для генерации новых предложений с помощью GPT-4 ===
 async def generate_sentences(user_id, num_sentances, context: CallbackContext = None):
     #client_deepseek = OpenAI(api_key = api_key_deepseek,base_url="https://api.deepseek.com")
     
     task_name = f"generate_sentences"
     system_instruction_key = f"generate_sentences"
-    assistant_id, _ = await get_or_create_openai_resources(system_instruction_key, task_name)
-            
-    # ✅ Создаём новый thread каждый раз
-    thread = await client.beta.threads.create()
-    thread_id = thread.id
 
     chosen_topic = context.user_data.get("chosen_topic", "Random sentences")  # Default: General topic
 
+    # ✅ Сначала берём готовые предложения из запаса — без ожидания GPT
+    claimed = []
+    if chosen_topic in TOPICS:
+        try:
+            claimed = await claim_inventory_sentences(chosen_topic, num_sentances, user_id)
+        except Exception as e:
+            logging.error(f"❌ Не удалось взять предложения из запаса: {e}")
+        schedule_inventory_refill(chosen_topic)
+        if len(claimed) >= num_sentances:
+            metrics.inc("sentence_inventory_claims_total", topic=chosen_topic, result="full")
+            return claimed
+        metrics.inc("sentence_inventory_claims_total", topic=chosen_topic, result="partial" if claimed else "empty")
+        num_sentances -= len(claimed)
+
 
     # if chosen_topic != "Random sentences":
     user_message = f"""
     Number of sentences: {num_sentances}. Topic: "{chosen_topic}".
     """
 
-    #Генерация с помощью GPT     
-    for attempt in range(5): # Пробуем до 5 раз при ошибке
+    #Генерация с помощью GPT (429 и сетевые ошибки повторяет openai_guard; здесь — только пустой ответ)
+    for attempt in range(3):
         try:
-            await client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=user_message
-            )
-
-            run = await client.beta.threads.runs.create(
-                thread_id=thread_id,
-                assistant_id=assistant_id
-            )
-            while True:
-                run_status = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                if run_status.status == "completed":
-                    break
-                await asyncio.sleep(1)  # подожди чуть-чуть
-            
-
-            # Получаем сообщения после завершения run
-            messages = await client.beta.threads.messages.list(thread_id=thread_id)
-            last_message = messages.data[0]  # обычно последнее — ответ
-            sentences = last_message.content[0].text.value
-
-            try:
-                await client.beta.threads.delete(thread_id=thread_id)
-                logging.info(f"🗑️ Thread удалён: {thread_id}")
-
-            except Exception as e:
-                logging.warning(f"Не удалось удалить thread: {e}")
+            # Одновременные сессии на ту же тему получают один общий ответ модели
+            sentences = await run_assistant_task(system_instruction_key, user_message, task_name, coalesce=True)
 
             # response = await client.chat.completions.create(
             #     model = "gpt-4-turbo",
@@ -1206,12 +1047,14 @@ async def generate_sentences(user_id, num_sentances, context: CallbackContext =
             filtered_sentences = [s.strip() for s in sentences.split("\n") if s.strip()] # ✅ Фильтруем пустые строки
             
             if filtered_sentences:
-                return filtered_sentences
+                return claimed + filtered_sentences
             
-        except openai.RateLimitError:
-            wait_time = (attempt +1) * 2 # Задержка: 2, 4, 6 сек...
-            print(f"⚠️ OpenAI API Rate Limit. Ждем {wait_time} сек...")
-            await asyncio.sleep(wait_time)
+        except CircuitOpenError:
+            logging.warning("🔌 OpenAI недоступен (circuit open) — сразу берём запасные предложения")
+            break
+        except Exception as e:
+            logging.error(f"❌ Ошибка генерации предложений: {e}")
+            break
     
     print("❌ Ошибка: не удалось получить ответ от OpenAI. Используем запасные предложения.")
 
@@ -1235,110 +1078,95 @@ async def generate_sentences(user_id, num_sentances, context: CallbackContext =
     # print("❌ Ошибка: не удалось получить ответ от OpenAI. Используем запасные предложения.")
 
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
+    spare_rows = await db_fetchall("spare_sentences", """
         SELECT sentence FROM bt_3_spare_sentences ORDER BY RANDOM() LIMIT 7;""")
-    spare_rows = cursor.fetchall()
-
-    cursor.close()
-    conn.close()
 
     if spare_rows:
-        return [row[0].strip() for row in spare_rows if row[0].strip()]
+        return claimed + [row[0].strip() for row in spare_rows if row[0].strip()][:num_sentances]
     else:
         print("❌ Ошибка: даже запасные предложения отсутствуют.")
-        return ["Запасное предложение 1", "Запасное предложение 2"]
+        return claimed or ["Запасное предложение 1", "Запасное предложение 2"]
 
 
 async def recheck_score_only(original_text, user_translation):
 
     task_name = "recheck_translation"
     system_instruction_key = "recheck_translation"
-    assistant_id, _ = await get_or_create_openai_resources(system_instruction_key, task_name)
-            
-    # ✅ Создаём новый thread каждый раз
-    thread = await client.beta.threads.create()
-    thread_id = thread.id
 
     user_message = f"""
     Original sentence (Russian): "{original_text}"  
     User's translation (German): "{user_translation}"
     """ 
     
-    #Генерация с помощью GPT     
-    for attempt in range(3): # Пробуем до 3 раз при ошибке
+    #Генерация с помощью GPT: 429 и сетевые ошибки повторяет openai_guard, здесь — только неразборчивый ответ
+    for attempt in range(3):
         try:
-            await client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=user_message
-            )
+            text = await run_assistant_task(system_instruction_key, user_message, task_name)
+        except CircuitOpenError:
+            break
+        except Exception as e:
+            print(f"❌ Ошибка при перепроверке score: {e}")
+            break
 
-            run = await client.beta.threads.runs.create(
-                thread_id=thread_id,
-                assistant_id=assistant_id
-            )
-            while True:
-                run_status = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                if run_status.status == "completed":
-                    break
-                await asyncio.sleep(1)  # подожди чуть-чуть
-            
+        print(f"🔁 Ответ на перепроверку оценки:\n{text}")
+        if "score" in text.lower():
+            reassessed_score = text.lower().split("score:")[-1].split("/")[0].strip()
+            try:
+                reassessed_score = int(reassessed_score)
+                print(f"🔁 GPT повторно оценил на: {reassessed_score}/100")
+                return str(reassessed_score)
+            except ValueError:
+                print(f"⚠️ Не удалось привести reassessed_score к числу: {reassessed_score}")
+        
+    return "0" # fallback, если GPT не ответил
 
-            # Получаем сообщения после завершения run
-            messages = await client.beta.threads.messages.list(thread_id=thread_id)
-            last_message = messages.data[0]  # обычно последнее — ответ
-            text = last_message.content[0].text.value
 
-            try:
-                await client.beta.threads.delete(thread_id=thread_id)
-                logging.info(f"🗑️ Thread удалён: {thread_id}")
+# Быстрая обратная связь: результат с кнопкой одним сообщением, без промежуточного "⏳ Посмотрим..." и edit_text
+GRADING_FAST_FEEDBACK = os.getenv("GRADING_FAST_FEEDBACK", "true").lower() in ("1", "true", "yes")
 
-            except Exception as e:
-                logging.warning(f"Не удалось удалить thread: {e}")
+# Проверка перевода в режиме строгого JSON (schema в backend/grading_schema.py).
+# GRADING_STRICT_JSON=false возвращает старый текстовый формат Score:/Mistake Categories:/...
+GRADING_STRICT_JSON = os.getenv("GRADING_STRICT_JSON", "true").lower() in ("1", "true", "yes")
+GRADING_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "grading_result", "schema": GRADING_JSON_SCHEMA, "strict": True},
+}
 
-            
-            print(f"🔁 Ответ на перепроверку оценки:\n{text}")
-            if "score" in text.lower():
-                reassessed_score = text.lower().split("score:")[-1].split("/")[0].strip()
-                try:
-                    reassessed_score = int(reassessed_score)
-                    print(f"🔁 GPT повторно оценил на: {reassessed_score}/100")
-                    return str(reassessed_score)
-                except ValueError:
-                    print(f"⚠️ Не удалось привести reassessed_score к числу: {reassessed_score}")
-                    continue
 
-        except Exception as e:
-            print(f"❌ Ошибка при перепроверке score: {e}")
-            continue
-        
-    return "0" # fallback, если GPT не ответил
+@dataclass
+class ExplainState:
+    """Данные для кнопки '❓ Explain me GPT' под результатом проверки."""
+    original_text: str
+    user_translation: str
+
+
+# Ключ — токен из callback_data кнопки. Запись живёт сутки; в памяти не больше EXPLAIN_STATE_MAX_ENTRIES
+explain_states = UserStateStore(
+    "explain", ExplainState,
+    ttl_seconds=int(os.getenv("EXPLAIN_STATE_TTL", str(24 * 3600))),
+    max_entries=int(os.getenv("EXPLAIN_STATE_MAX_ENTRIES", "2000")),
+)
 
 
 async def check_translation(original_text, user_translation, update: Update, context: CallbackContext, sentence_number):
 
     task_name = f"check_translation"
     system_instruction_key = f"check_translation"
-    assistant_id, _ = await get_or_create_openai_resources(system_instruction_key, task_name)
-            
-    # ✅ Создаём новый thread каждый раз
-    thread = await client.beta.threads.create()
-    thread_id = thread.id
 
     # Initialize variables with default values at the beginning of the function
     score = None  # Default score
     categories = []
     subcategories = []
+    mistake_pairs = []
     #correct_translation = "there is no information."  # Default translation
     correct_translation = None
     
-    # ✅ Показываем сообщение о начале проверки
-    message = await context.bot.send_message(chat_id=update.message.chat_id, text="⏳ Посмотрим на что ты способен...")
-    
-    await simulate_typing(context, update.message.chat_id, duration=3)
+    chat_id = update.message.chat_id
+
+    # ✅ Показываем сообщение о начале проверки (в быстром режиме хватает индикатора набора)
+    message = None
+    if not GRADING_FAST_FEEDBACK:
+        message = await context.bot.send_message(chat_id=chat_id, text="⏳ Посмотрим на что ты способен...")
 
     user_message = f"""
 
@@ -1347,131 +1175,88 @@ async def check_translation(original_text, user_translation, update: Update, con
 
     """
 
-    for attempt in range(3):
-        try:
-            logging.info(f" GPT started working on {original_text} sentence. Passing data to GPT model")
-            start_time = asyncio.get_running_loop().time()
+    # ✅ Такой же перевод такого же предложения уже проверяли — берём готовую оценку из кэша
+    instruction_key = "check_translation_json" if GRADING_STRICT_JSON else system_instruction_key
+    llm_started = asyncio.get_running_loop().time()
+    cached = await get_cached("grading", instruction_key, original_text, user_translation)
+    if cached:
+        score = str(cached["score"])
+        correct_translation = cached["correct_translation"]
+        mistake_pairs = [tuple(pair) for pair in cached["mistakes"]]
+        categories = list(dict.fromkeys(cat for cat, _ in mistake_pairs))
+        subcategories = list(dict.fromkeys(sub for _, sub in mistake_pairs))
+        logging.info(f"♻️ Оценка для '{original_text}' взята из кэша")
+    else:
+        async with typing_while_working(context.bot, chat_id):
+            for attempt in range(3):
+                try:
+                    logging.info(f" GPT started working on {original_text} sentence. Passing data to GPT model")
+                    start_time = asyncio.get_running_loop().time()
             
-            await client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=user_message
-            )
+                    if GRADING_STRICT_JSON:
+                        collected_text = await complete(
+                            "check_translation_json", user_message, task_name=task_name,
+                            response_format=GRADING_RESPONSE_FORMAT
+                        )
+                    else:
+                        collected_text = await run_assistant_task(system_instruction_key, user_message, task_name)
+                    logging.info(f"We got a reply from GPT model for sentence {original_text}")
+
+                    # ✅ Логируем полный ответ для анализа
+                    print(f"🔎 FULL RESPONSE:\n{collected_text}")
+
+                    # ✅ Разбираем ответ: битый JSON / старый текстовый формат чинится локально, без повторного запроса
+                    grading = parse_grading_response(collected_text, expect_json=GRADING_STRICT_JSON)
+                    if grading is None:
+                        # Обязательных полей нет даже после ремонта — только тогда повторяем запрос к модели
+                        metrics.inc("grading_rerequest_total", reason="unparseable")
+                        raise ValueError("Missing required fields: Score / Correct Translation")
+
+                    categories = grading.categories
+                    subcategories = grading.subcategories
+                    mistake_pairs = grading.mistakes
+                    correct_translation = grading.correct_translation
+
+                    # ✅ Логируем
+                    print(f"🔎 MISTAKES in check_translation function (User {update.message.from_user.id}): {mistake_pairs}")
+
+                    if grading.score == 0:
+                        print(f"⚠️ GPT поставил 0. Запрашиваем повторную оценку...")
+                        metrics.inc("grading_rerequest_total", reason="zero_score")
+                        reassessed_score = await recheck_score_only(original_text, user_translation)
+                        print(f"🔁 GPT повторно оценил на: {reassessed_score}/100")
+                        score = reassessed_score
+                        break
 
-            run = await client.beta.threads.runs.create(
-                thread_id=thread_id,
-                assistant_id=assistant_id
-            )
-            while True:
-                run_status = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                if run_status.status == "completed":
+                    score = str(grading.score)
+                    print(f"✅ Успешно получены все обязательные данные на попытке {attempt + 1}")
                     break
-                await asyncio.sleep(2)  # подожди чуть-чуть
-
-
-            # Получаем сообщения после завершения run
-            messages = await client.beta.threads.messages.list(thread_id=thread_id)
-            last_message = messages.data[0]  # обычно последнее — ответ
-            collected_text = last_message.content[0].text.value
-            logging.info(f"We got a reply from GPT model for sentence {original_text}")
-            
-            try:
-                await client.beta.threads.delete(thread_id=thread_id)
-                logging.info(f"🗑️ Thread удалён: {thread_id}")
-
-            except Exception as e:
-                logging.warning(f"Не удалось удалить thread: {e}")
-                
-
-            # ✅ Логируем полный ответ для анализа
-            print(f"🔎 FULL RESPONSE:\n{collected_text}")
-
-
-            # ✅ Парсим результат
-            score_str = collected_text.split("Score: ")[-1].split("/")[0].strip() if "Score:" in collected_text else None
-            
-            #my offer to split by ", " because it is a string and take all list
-            # ✅ Ограничиваем строку до конца строки с помощью split("\n")[0]
-            categories = collected_text.split("Mistake Categories: ")[-1].split("\n")[0].split(", ") if "Mistake Categories:" in collected_text else []
-            subcategories = collected_text.split("Subcategories: ")[-1].split("\n")[0].split(", ") if "Subcategories:" in collected_text else []
 
-            #severity = collected_text.split("Severity: ")[-1].split("\n")[0].strip() if "Severity:" in collected_text and len(collected_text.split("Severity: ")[-1].split("\n")) > 0 else None
-            
-            #correct_translation = collected_text.split("Correct Translation: ")[-1].strip() if "Correct Translation:" in collected_text else None
 
-            match = re.search(r'Correct Translation:\s*(.+?)(?:\n|\Z)', collected_text)
-            if match:
-                correct_translation = match.group(1).strip()
-            
-            # ✅ Логируем До обработки
-            print(f"🔎 RAW CATEGORIES BEFORE HANDLING in check_translation function (User {update.message.from_user.id}): {', '.join(categories)}")
-            print(f"🔎 RAW SUBCATEGORIES BEFORE HANDLING in check_translation function (User {update.message.from_user.id}): {', '.join(subcategories)}")
-            
-            # my offer for category: i would reduce all unneccessary symbols not only ** except from words and commas (what do you think!?)
-            categories = [re.sub(r"[^0-9a-zA-Z\s,+\-–]", "", cat).strip() for cat in categories if cat.strip()]
-            # my offer for subcategory: i would reduce all unneccessary symbols not only ** except from words and commas (what do you think!?)
-            subcategories = [re.sub(r"[^0-9a-zA-Z\s,+\-–]", "", subcat).strip() for subcat in subcategories if subcat.strip()]
+                except CircuitOpenError:
+                    # Кэш уже проверен выше — ждать бессмысленно; оценку не придумываем,
+                    # grade_submitted_translation попросит отправить перевод позже и ничего не сохранит
+                    logging.warning(f"🔌 OpenAI недоступен (circuit open), перевод №{sentence_number} не проверен")
+                    if message is not None:
+                        await message.delete()
+                    raise
 
-            # ✅ Преобразуем строки в списки: my offer
-            categories = [cat.strip() for cat in categories if cat.strip()]
-            subcategories = [subcat.strip() for subcat in subcategories if subcat.strip()]
+                except Exception as e:
+                    # 429 и сетевые ошибки уже повторил openai_guard; здесь — неразборчивый ответ модели
+                    logging.error(f"❌ Ошибка: {e}")
+                    print(f"❌ Ошибка в цикле обработки: {e}")
 
-            # ✅ Логируем
-            print(f"🔎 RAW CATEGORIES AFTER HANDLING in check_translation function (User {update.message.from_user.id}): {', '.join(categories)}")
-            print(f"🔎 RAW SUBCATEGORIES AFRET HANDLING (User {update.message.from_user.id}): {', '.join(subcategories)}")
+        # Нулевую оценку не кэшируем: "0" — это и fallback recheck_score_only, когда модель не ответила
+        if score and score.isdigit() and int(score) > 0 and correct_translation:
+            await put_cached("grading", instruction_key, original_text, user_translation, {
+                "score": int(score),
+                "correct_translation": correct_translation,
+                "mistakes": [list(pair) for pair in mistake_pairs],
+            })
 
-            
-            if not categories:
-                print(f"⚠️ Категории отсутствуют в ответе GPT")
-            if not subcategories:
-                print(f"⚠️ Подкатегории отсутствуют в ответе GPT")
-
-            if score_str and correct_translation:
-                try:
-                    score_int = int(score_str)
-                except ValueError:
-                    print(f"⚠️ Не удалось привести score_str к числу: {score_str}")
-                    print(f"⚠️ GPT вернул некорректный формат оценки. Запрашиваем повторную оценку...")
-                    reassessed_score = await recheck_score_only(original_text, user_translation)
-                    print(f"🔁 GPT повторно оценил на: {reassessed_score}/100")
-                    score = reassessed_score
-                    break  # завершаем цикл успешно
-
-                if score_int == 0:
-                    print(f"⚠️ GPT поставил 0. Запрашиваем повторную оценку...")
-                    reassessed_score = await recheck_score_only(original_text, user_translation)
-                    print(f"🔁 GPT повторно оценил на: {reassessed_score}/100")
-                    score = reassessed_score
-                    break
-
-                score = score_str
-                print(f"✅ Успешно получены все обязательные данные на попытке {attempt + 1}")
-                break
-            
-            else:
-                missing_fields = []
-                if not score_str:
-                    missing_fields.append("Score")
-                #if not severity:
-                #    missing_fields.append("Severity")
-                if not correct_translation:
-                    missing_fields.append("Correct Translation")
-                print(f"⚠️ Не получены обязательные поля: {', '.join(missing_fields)}. Повторяем запрос...")
-                raise ValueError(f"Missing required fields: "
-                     f"{'Score' if not score_str else ''} "
-                     f"{'Correct Translation' if not correct_translation else ''}")
-
-
-        except openai.RateLimitError:
-            wait_time = (attempt + 1) * 5
-            print(f"⚠️ OpenAI API перегружен. Ждём {wait_time} сек...")
-            await asyncio.sleep(wait_time)
-
-        except Exception as e:
-            logging.error(f"❌ Ошибка: {e}")
-            print(f"❌ Ошибка в цикле обработки: {e}")
-            await asyncio.sleep(5)
 
+    llm_seconds = asyncio.get_running_loop().time() - llm_started
+    metrics.observe("grading_stage_seconds", llm_seconds, stage="llm")
 
     # ✅ Убираем лишние пробелы для ровного форматирования
     result_text = f"""
@@ -1486,46 +1271,46 @@ async def check_translation(original_text, user_translation, update: Update, con
     if score and score.isdigit() and int(score) > 75:
         result_text += "\n✅ Перевод на высоком уровне."
 
-    # ✅ Отправляем текст в Telegram с поддержкой HTML
-    sent_message = await context.bot.send_message(
-        chat_id=update.message.chat_id,
-        text=escape_html_with_bold(result_text),
-        parse_mode="HTML"
-    )
-
-    message_id = sent_message.message_id
-    
-    # ✅ Сохраняем данные в context.user_data
-    if len(context.user_data) >= 10:
-        oldest_key = next(iter(context.user_data))
-        del context.user_data[oldest_key]  # Удаляем самые старые данные
-
-    context.user_data[f"translation_{message_id}"] = {
-        "original_text": original_text,
-        "user_translation": user_translation
-    }
-
-    # ✅ Удаляем сообщение с индикатором "Генерация ответа"
-    await message.delete()
-
-    # ✅ Добавляем инлайн-кнопку после отправки сообщения
-    keyboard = [[InlineKeyboardButton("❓ Explain me GPT", callback_data=f"explain:{message_id}")]]
+    telegram_started = asyncio.get_running_loop().time()
+    # Кнопка ссылается на короткий токен, а не на message_id, поэтому её можно отправить сразу
+    explain_token = secrets.token_urlsafe(8)
+    await explain_states.put(update.message.from_user.id, explain_token, ExplainState(original_text, user_translation))
+    keyboard = [[InlineKeyboardButton("❓ Explain me GPT", callback_data=f"explain:{explain_token}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    # ✅ Задержка в 1,5 секунды для предотвращения блокировки
-    await asyncio.sleep(1.5)
+    if GRADING_FAST_FEEDBACK:
+        # ✅ Результат вместе с кнопкой — один send_message
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=escape_html_with_bold(result_text),
+            reply_markup=reply_markup,
+            parse_mode="HTML"
+        )
+    else:
+        # ✅ Отправляем текст в Telegram с поддержкой HTML
+        sent_message = await context.bot.send_message(
+            chat_id=chat_id,
+            text=escape_html_with_bold(result_text),
+            parse_mode="HTML"
+        )
+
+        # ✅ Удаляем сообщение с индикатором "Генерация ответа"
+        await message.delete()
 
-    # ✅ Редактируем сообщение, добавляем кнопку
-    await sent_message.edit_text(
-        text=escape_html_with_bold(result_text),
-        reply_markup=reply_markup,
-        parse_mode="HTML"
-        )                        
+        # ✅ Редактируем сообщение, добавляем кнопку
+        await sent_message.edit_text(
+            text=escape_html_with_bold(result_text),
+            reply_markup=reply_markup,
+            parse_mode="HTML"
+            )
+    telegram_seconds = asyncio.get_running_loop().time() - telegram_started
+    metrics.observe("grading_stage_seconds", telegram_seconds, stage="telegram")
+    logging.info(f"⏱ Предложение {sentence_number}: LLM {llm_seconds:.2f} сек, Telegram {telegram_seconds:.2f} сек")
 
     # ✅ Логируем успешную проверку
     logging.info(f"✅ Перевод проверен для пользователя {update.message.from_user.id}")
 
-    return result_text, categories, subcategories, score, correct_translation
+    return result_text, categories, subcategories, score, correct_translation, mistake_pairs
 
 
 async def handle_explain_request(update: Update, context: CallbackContext):
@@ -1538,9 +1323,10 @@ async def handle_explain_request(update: Update, context: CallbackContext):
     try:
         logging.info(f"🔹 Callback data: {query.data}")
 
-        # ✅ Получаем `message_id` из callback_data
-        message_id = int(query.data.split(":")[1])
-        logging.info(f"✅ Извлечённый message_id: {message_id}")
+        # ✅ Токен данных из callback_data (у старых кнопок это был message_id); отвечаем на сообщение с кнопкой
+        explain_key = query.data.split(":", 1)[1]
+        message_id = query.message.message_id
+        logging.info(f"✅ Ключ объяснения: {explain_key}, message_id: {message_id}")
         
         # Логируем сообщение, к которому пытаемся прикрепить комментарий
         chat_id = update.callback_query.message.chat_id
@@ -1565,16 +1351,16 @@ async def handle_explain_request(update: Update, context: CallbackContext):
 
 
         #✅ Ищем в сохранённых данных
-        data = context.user_data.get(f"translation_{message_id}")
+        data = await explain_states.get(query.from_user.id, explain_key)
         if not data:
-            logging.error(f"❌ Данные для message_id {message_id} не найдены в context.user_data!")
+            logging.error(f"❌ Данные для {explain_key} не найдены (истёк срок или чужое сообщение)!")
             msg = await query.message.reply_text("❌ Данные перевода не найдены!")
             add_service_msg_id(context, msg.message_id)
             return       
 
         # ✅ Получаем текст оригинала и перевода
-        original_text = data["original_text"]
-        user_translation = data["user_translation"]
+        original_text = data.original_text
+        user_translation = data.user_translation
         # ✅ Запускаем объяснение с помощью Claude
         explanation = await check_translation_with_claude(original_text, user_translation, update, context)
         if not explanation:
@@ -1599,7 +1385,7 @@ async def handle_explain_request(update: Update, context: CallbackContext):
             )
         
         # ✅ Удаляем данные после успешной обработки
-        del context.user_data[f"translation_{message_id}"]
+        await explain_states.delete(query.from_user.id, explain_key)
         print(f"✅ Удалены данные для message_id {message_id}")
 
     except TelegramError as e:
@@ -1620,11 +1406,6 @@ async def handle_explain_request(update: Update, context: CallbackContext):
 async def check_translation_with_claude(original_text, user_translation, update, context):
     task_name = f"check_translation_with_claude"
     system_instruction_key = f"check_translation_with_claude"
-    assistant_id, _ = await get_or_create_openai_resources(system_instruction_key, task_name)
-            
-    # ✅ Создаём новый thread каждый раз
-    thread = await client.beta.threads.create()
-    thread_id = thread.id
 
     if update.callback_query:
         user = update.callback_query.from_user
@@ -1646,71 +1427,41 @@ async def check_translation_with_claude(original_text, user_translation, update,
     # print(f"📢 Available models: {available_models}")
     
     #model_name = "claude-3-7-sonnet-20250219"  
-    
-    for attempt in range(3):
-        try:
-            #it is correct working with Claude model
-            # response = await client.messages.create(
-            #     model=model_name,
-            #     messages=[{"role": "user", "content": prompt}],
-            #     max_tokens=500,
-            #     temperature=0.2
-            # )
-            
-            await client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=user_message
-            )
-
-            run = await client.beta.threads.runs.create(
-                thread_id=thread_id,
-                assistant_id=assistant_id
-            )
-            while True:
-                run_status = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                if run_status.status == "completed":
-                    break
-                await asyncio.sleep(1)  # подожди чуть-чуть
-            
-
-            # Получаем сообщения после завершения run
-            messages = await client.beta.threads.messages.list(thread_id=thread_id)
-            last_message = messages.data[0]  # обычно последнее — ответ
-            response = last_message.content[0].text.value
-
-            try:
-                await client.beta.threads.delete(thread_id=thread_id)
-                logging.info(f"🗑️ Thread удалён: {thread_id}")
-
-            except Exception as e:
-                logging.warning(f"Не удалось удалить thread: {e}")
 
-            logging.info(f"📥 FULL RESPONSE BODY: {response}")
+    # ✅ Объяснение для такой же пары (оригинал, перевод) уже строили — отдаём из кэша
+    cached_explanation = await get_cached("explanation", system_instruction_key, original_text, user_translation)
+    if cached_explanation:
+        logging.info(f"♻️ Объяснение для '{original_text}' взято из кэша")
+        return cached_explanation
+    
+    # Повторы при 429 и сетевых ошибках делает openai_guard — здесь один вызов, любая ошибка окончательная
+    try:
+        #it is correct working with Claude model
+        # response = await client.messages.create(
+        #     model=model_name,
+        #     messages=[{"role": "user", "content": prompt}],
+        #     max_tokens=500,
+        #     temperature=0.2
+        # )
+
+        # Два нажатия "Explain me GPT" на одну пару (оригинал, перевод) — один запрос к модели
+        response = await run_assistant_task(system_instruction_key, user_message, task_name, coalesce=True)
+    except CircuitOpenError:
+        logging.warning("🔌 OpenAI недоступен (circuit open) — объяснение сейчас не построить")
+        return "❌ Ошибка: Сервис объяснений временно недоступен, попробуйте позже."
+    except Exception as e:
+        logging.error(f"❌ API Error from Claude: {e}")
+        return "❌ Ошибка: Не удалось обработать ответ от Claude."
 
-            if response:
-                cloud_response = response
-                #this is for the claude model
-                #cloud_response = response.content[0].text
-                break
-            else:
-                logging.warning("⚠️ Claude returned an empty response.")
-                print("❌ Ошибка: Claude вернул пустой ответ. We will try one more time in 5 seconds")
-                await asyncio.sleep(5)
-        
-        except Exception as e:
-            logging.error(f"❌ API Error from Claude: {e}")
-            # Если ошибка действительно критическая — можно добавить проверку и выйти из цикла
-            if "authentication" in str(e).lower() or "invalid token" in str(e).lower():
-                logging.error("🚨 Критическая ошибка — завершаем цикл")
-                break
-            else:
-                logging.warning("⚠️ Попробуем снова через 5 секунд...")
-                await asyncio.sleep(5)
+    logging.info(f"📥 FULL RESPONSE BODY: {response}")
 
-    else:
-        print("❌ Ошибка: Пустой ответ от Claude после 3 попыток")
+    if not response:
+        logging.warning("⚠️ Claude returned an empty response.")
         return "❌ Ошибка: Не удалось обработать ответ от Claude."
+
+    cloud_response = response
+    #this is for the claude model
+    #cloud_response = response.content[0].text
     
     list_of_errors_pattern = re.findall(r'(Error)\s*(\d+)\:*\s*(.+?)(?:\n|$)', cloud_response, flags=re.DOTALL)
 
@@ -1733,178 +1484,369 @@ async def check_translation_with_claude(original_text, user_translation, update,
     for line in list_of_errors_pattern:
         result_list.append(f"🔴*{line[0]} {line[1]}*: {line[2]}\n")
 
-    # Добавляем корректный перевод
-    for item in correct_translation:
-        result_list.append(f"✅*{item[0]}*:\n➡️ {item[1]}\n")
+    # Добавляем корректный перевод
+    for item in correct_translation:
+        result_list.append(f"✅*{item[0]}*:\n➡️ {item[1]}\n")
+
+    # Добавляем объяснения грамматики
+    for k in grammar_explanation_pattern:
+        result_list.append(f"🟡*{k[0]}*:")  # Добавляем заголовок
+        grammar_parts = k[1].split("\n")  # Разбиваем текст по строкам
+        for part in grammar_parts:
+            clean_part = part.strip()
+            if clean_part and clean_part not in ["-", ":"]:
+                result_list.append(f"🔥{clean_part}")
+    #result_list.append("\n")    
+
+    # Добавляем альтернативные варианты
+    for a in altern_sentence_pattern:
+        result_list.append(f"\n🔵*{a[0]}*:\n {a[1].strip()}\n")  # Убираем лишние пробелы
+
+    # Добавляем синонимы
+    if synonyms_pattern:
+        result_list.append("➡️ *Synonyms*:")
+        #count = 0
+        for s in synonyms_pattern:
+            synonym_parts = s.split("\n")
+            for part in synonym_parts:
+                clean_part = part.strip()
+                if not clean_part:
+                    continue
+                # if count > 0 and count % 2 == 0:
+                #     result_list.append(f"{'-'*33}")
+                result_list.append(f"🔄 {clean_part}")
+                #count += 1
+
+    # результат
+    result_line_for_output = "\n".join(result_list)
+    await put_cached("explanation", system_instruction_key, original_text, user_translation, result_line_for_output)
+
+    return result_line_for_output
+
+
+
+async def log_translation_mistake(user_id, original_text, user_translation, categories, subcategories, score, correct_translation, mistake_pairs=None, sentence_id=None):
+    #client = anthropic.Client(api_key=CLAUDE_API_KEY)
+
+    # ✅ Логируем нормализованные значения
+    if categories:
+        print(f"🔎 LIST OF CATEGORIES FROM log_translation_function: {', '.join(categories)}")
+
+    if subcategories:
+        print(f"🔎 LIST OF SUBCATEGORIES log_translation_function: {', '.join(subcategories)}")
+
+    if not isinstance(user_id, int):
+        print(f"❌ Ошибка типа данных: user_id = {type(user_id)}")
+        return
+
+    # ✅ Пары ошибок в каноническом написании. Проверка и восстановление регистра — один поиск
+    # в MISTAKE_PAIR_BY_LOWER вместо перебора VALID_CATEGORIES / VALID_SUBCATEGORIES
+    if mistake_pairs is not None:
+        # Пары из структурированного ответа уже проверены по config_mistakes_data (backend/grading_schema.py) —
+        # берём их как есть, без декартова произведения категорий и подкатегорий
+        candidates = [(cat.lower(), subcat.lower()) for cat, subcat in mistake_pairs]
+    else:
+        candidates = [(cat.lower(), subcat.lower()) for cat in categories for subcat in subcategories]
+    # dict вместо set — без дублей (multi-row upsert не может дважды обновить одну строку) и в исходном порядке
+    valid_combinations = list(dict.fromkeys(
+        MISTAKE_PAIR_BY_LOWER[pair] for pair in candidates if pair in MISTAKE_PAIR_BY_LOWER
+    ))
+
+    if valid_combinations:
+        print(f"✅ Найдены следующие валидные комбинации ошибок:")
+        for main_category, sub_category in valid_combinations:
+            print(f"➡️ {main_category} - {sub_category}")
+    else:
+        # ❗ Если не удалось классифицировать → помечаем как неклассифицированную ошибку
+        print(f"⚠️ Ошибка классификации — помечаем как неклассифицированную.")
+        valid_combinations = [("Other mistake", "Unclassified mistake")]
+
+    score = int(score) if score else 0
+    main_categories = [main_category for main_category, _ in valid_combinations]
+    sub_categories = [sub_category for _, sub_category in valid_combinations]
+
+    # ✅ Запись в базу данных: все ошибки предложения — одним многострочным upsert в одной транзакции
+    def write_mistakes(cursor):
+        #sentence_id В нашем случае это идентификатор id_for_mistake_table Из таблицы bt_3_daily_sentences (для одинаковых предложений он одинаков) Для разных он разный.
+        # это нужно чтобы правильно Помечать предложения особенно одинаковые предложения и потом их правильно удалять из базы данных на основании этого идентификатора
+        # Если id не передали — берём его из словаря по хэшу текста (уникальный индекс) в том же запросе.
+        #score = EXCLUDED.score означает:
+        # "Обновить поле score в существующей строке, установив его в то значение score, которое мы только что пытались вставить in VALUES".
+        cursor.execute("""
+            INSERT INTO bt_3_detailed_mistakes (
+                user_id, sentence, added_data, main_category, sub_category, mistake_count, sentence_id, correct_translation, score
+            )
+            SELECT %s, %s, NOW(), m.main_category, m.sub_category, 1,
+                   COALESCE(%s::int, (SELECT id FROM bt_3_sentence_dictionary WHERE sentence_hash = md5(%s))),
+                   %s, %s
+            FROM unnest(%s::text[], %s::text[]) AS m(main_category, sub_category)
+            ON CONFLICT (user_id, sentence, main_category, sub_category)
+            DO UPDATE SET
+                mistake_count = bt_3_detailed_mistakes.mistake_count + 1,
+                attempt = bt_3_detailed_mistakes.attempt + 1,
+                last_seen = NOW(),
+                score = EXCLUDED.score
+            RETURNING sentence_id;
+        """, (user_id, original_text, sentence_id, original_text, correct_translation, score, main_categories, sub_categories))
+        return [row[0] for row in cursor.fetchall()]
+
+    try:
+        with metrics.timer("mistake_log_seconds"):
+            written = await db_transaction("log_translation_mistake", write_mistakes)
+    except Exception as e:
+        print(f"❌ Ошибка при записи в БД: {e}")
+        logging.error(f"❌ Ошибка при записи в БД: {e}")
+        return
+
+    if written and written[0] is None:
+        logging.warning(f"⚠️ sentence_id не найдено для предложения '{original_text}'")
+
+    # ✅ Логирование успешного завершения обработки
+    print(f"✅ Записано ошибок: {len(written)} ({', '.join(f'{c} - {s}' for c, s in valid_combinations)})")
+
+
+# Параллельная проверка переводов: все предложения одной отправки проверяются одновременно,
+# а результат каждого уходит в чат сразу после готовности. Ограничения — на пользователя и на весь бот,
+# чтобы не упереться в лимиты OpenAI и Telegram.
+GRADING_FANOUT_ENABLED = os.getenv("GRADING_FANOUT_ENABLED", "true").lower() in ("1", "true", "yes")
+GRADING_PER_USER_CONCURRENCY = int(os.getenv("GRADING_PER_USER_CONCURRENCY", "3"))
+GRADING_GLOBAL_CONCURRENCY = int(os.getenv("GRADING_GLOBAL_CONCURRENCY", "8"))
+
+_grading_global_semaphore = None
+_grading_user_semaphores = {}  # user_id -> [семафор, сколько проверок держат или ждут его]
+
+
+@asynccontextmanager
+async def grading_slot(user_id):
+    """
+    Слот проверки: сначала слот пользователя, потом глобальный — один пользователь не держит глобальные
+    слоты в очереди. Семафоры создаются лениво внутри event loop; семафор пользователя удаляется,
+    когда у него не остаётся проверок (как замки в UserLocks), чтобы словарь не рос всё время работы бота.
+    """
+    global _grading_global_semaphore
+    if _grading_global_semaphore is None:
+        _grading_global_semaphore = asyncio.Semaphore(GRADING_GLOBAL_CONCURRENCY)
+    entry = _grading_user_semaphores.get(user_id)
+    if entry is None:
+        entry = _grading_user_semaphores[user_id] = [asyncio.Semaphore(GRADING_PER_USER_CONCURRENCY), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            async with _grading_global_semaphore:
+                yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _grading_user_semaphores[user_id]
+
+
+async def grade_submitted_translation(update: Update, context: CallbackContext, user_id, username, allowed_sentences, number_str, user_translation):
+    """
+    Проверяет один перевод из отправки пользователя и сохраняет результат в БД.
+    Возвращает строку с результатом (для логов / итогового списка).
+    """
+    sentence_number = int(number_str)
+
+    # Проверяем, принадлежит ли это предложение пользователю
+    if sentence_number not in allowed_sentences:
+        return f"❌ Ошибка: Предложение {sentence_number} вам не принадлежит!"
+
+    def load_sentence(cursor):
+        # Получаем оригинальный текст предложения
+        cursor.execute("""
+            SELECT id, sentence, session_id, id_for_mistake_table FROM bt_3_daily_sentences
+            WHERE date = CURRENT_DATE AND unique_id = %s AND user_id = %s;
+        """, (sentence_number, user_id))
+
+        row = cursor.fetchone()
+        if not row:
+            return None, False
 
-    # Добавляем объяснения грамматики
-    for k in grammar_explanation_pattern:
-        result_list.append(f"🟡*{k[0]}*:")  # Добавляем заголовок
-        grammar_parts = k[1].split("\n")  # Разбиваем текст по строкам
-        for part in grammar_parts:
-            clean_part = part.strip()
-            if clean_part and clean_part not in ["-", ":"]:
-                result_list.append(f"🔥{clean_part}")
-    #result_list.append("\n")    
+        # Проверяем, отправлял ли этот пользователь перевод этого предложения
+        cursor.execute(TRANSLATION_SAVED_TODAY_SQL, (user_id, row[0]))
+        return row, cursor.fetchone() is not None
 
-    # Добавляем альтернативные варианты
-    for a in altern_sentence_pattern:
-        result_list.append(f"\n🔵*{a[0]}*:\n {a[1].strip()}\n")  # Убираем лишние пробелы
+    with metrics.timer("grading_stage_seconds", stage="db"):
+        row, already_translated = await db_transaction("check_load_sentence", load_sentence)
 
-    # Добавляем синонимы
-    if synonyms_pattern:
-        result_list.append("➡️ *Synonyms*:")
-        #count = 0
-        for s in synonyms_pattern:
-            synonym_parts = s.split("\n")
-            for part in synonym_parts:
-                clean_part = part.strip()
-                if not clean_part:
-                    continue
-                # if count > 0 and count % 2 == 0:
-                #     result_list.append(f"{'-'*33}")
-                result_list.append(f"🔄 {clean_part}")
-                #count += 1
+    if not row:
+        return f"❌ Ошибка: Предложение {sentence_number} не найдено."
 
-    # результат
-    result_line_for_output = "\n".join(result_list)
+    sentence_id, original_text, session_id, id_for_mistake_table  = row
 
-    return result_line_for_output
+    if already_translated:
+        return f"⚠️ Вы уже переводили предложение {sentence_number}. Только первый перевод учитывается!"
 
+    logging.info(f"📌 Проверяем перевод №{sentence_number}: {user_translation}")
 
+    # Проверяем перевод через GPT
+    MAX_FEEDBACK_LENGTH = 1000  # Ограничим длину комментария GPT
+    categories, subcategories, score, correct_translation, mistake_pairs = [], [], None, None, []
 
-async def log_translation_mistake(user_id, original_text, user_translation, categories, subcategories, score, correct_translation):
-    global VALID_CATEGORIES, VALID_SUBCATEGORIES, VALID_CATEGORIES_lower, VALID_SUBCATEGORIES_lower
-    #client = anthropic.Client(api_key=CLAUDE_API_KEY)
+    try:
+        with metrics.timer("translation_check_seconds"):
+            feedback, categories, subcategories, score, correct_translation, mistake_pairs = await check_translation(original_text, user_translation, update, context, sentence_number)
 
-    # ✅ Логируем нормализованные значения
-    if categories:
-        print(f"🔎 LIST OF CATEGORIES FROM log_translation_function: {', '.join(categories)}")
+    except CircuitOpenError:
+        # ⚠️ Модель недоступна и в кэше оценки нет — не сохраняем перевод с выдуманной оценкой,
+        # чтобы пользователь мог отправить его повторно
+        unavailable = f"⚠️ Сервис проверки временно недоступен. Отправьте перевод предложения {sentence_number} позже."
+        await context.bot.send_message(chat_id=update.message.chat_id, text=unavailable)
+        return unavailable
 
-    if subcategories:
-        print(f"🔎 LIST OF SUBCATEGORIES log_translation_function: {', '.join(subcategories)}")
+    except Exception as e:
+        print(f"⚠️ Ошибка при проверке перевода №{sentence_number}: {e}")
+        logging.error(f"⚠️ Ошибка при проверке перевода №{sentence_number}: {e}", exc_info=True)
+        feedback = "⚠️ Ошибка: не удалось проверить перевод."
+
+    score = int(score) if score else 50
+
+    # Обрезаем, если слишком длинный
+    if len(feedback) > MAX_FEEDBACK_LENGTH:
+        feedback = feedback[:MAX_FEEDBACK_LENGTH] + "...\n⚠️ Ответ GPT был сокращён."
+
+    def save_translation(cursor):
+        """
+        Сохраняет перевод и обновляет таблицы успехов/попыток.
+        Возвращает None, если перевод уже был сохранён параллельной проверкой, иначе — нужно ли записать ошибки.
+        """
+        # 📌 Блокируем строку предложения до конца транзакции: две параллельные проверки одного
+        # предложения (повторная отправка, двойной клик) сохраняются строго по очереди
+        cursor.execute("SELECT id FROM bt_3_daily_sentences WHERE id = %s FOR UPDATE;", (sentence_id,))
+        cursor.execute(TRANSLATION_SAVED_TODAY_SQL, (user_id, sentence_id))
+        if cursor.fetchone() is not None:
+            return None
 
+        # ✅ Сохраняем перевод в базу данных с защитой от ошибок
+        cursor.execute("""
+            INSERT INTO bt_3_translations (user_id, id_for_mistake_table, session_id, username, sentence_id, user_translation, score, feedback)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+        """, (user_id, id_for_mistake_table, session_id, username, sentence_id, user_translation, score, feedback))
+        rollups.add_translation(cursor, user_id, username, score)
 
-    # ✅ Перебираем все сочетания категорий и подкатегорий
-    valid_combinations = []
-    for cat in categories:
-        cat_lower =cat.lower() # Приводим к нижнему регистру для соответствия VALID_SUBCATEGORIES
-        for subcat in subcategories:
-            subcat_lower = subcat.lower() # Приводим к нижнему регистру для соответствия VALID_SUBCATEGORIES
-            if cat_lower in VALID_SUBCATEGORIES_lower and subcat_lower in VALID_SUBCATEGORIES_lower[cat_lower]:
-                # ✅ Добавляем НОРМАЛИЗОВАННЫЕ значения для последующей обработки
-                valid_combinations.append((cat_lower, subcat_lower))
+        # Проверяем: реально ли это предложение есть в базе ошибок?
+        cursor.execute("""
+            SELECT COUNT(*) FROM bt_3_detailed_mistakes
+            WHERE sentence_id = %s AND user_id = %s;
+        """, (id_for_mistake_table, user_id))
 
+        was_in_mistakes = cursor.fetchone()[0] > 0
 
-    # ✅ Если есть хотя бы одно совпадение → логируем ВСЕ совпадения
-    if valid_combinations:
-        print(f"✅ Найдены следующие валидные комбинации ошибок выведенные в формате lower:")
-        for main_category_lower, sub_category_lower in valid_combinations:
-            print(f"➡️ {main_category_lower} - {sub_category_lower}")
+        # === КЛЮЧЕВАЯ ЛОГИКА ===
 
-    else:
-        # ❗ Если не удалось классифицировать → помечаем как неклассифицированную ошибку
-        print(f"⚠️ Ошибка классификации — помечаем как неклассифицированную.")
-        valid_combinations.append(("Other mistake", "Unclassified mistake"))
+        if was_in_mistakes:
+            if score >= 85:
+                # Получаем текущую максимальную попытку
+                cursor.execute("""
+                    SELECT attempt
+                    FROM bt_3_attempts
+                    WHERE id_for_mistake_table = %s AND user_id = %s;
+                """, (id_for_mistake_table, user_id))
 
+                result = cursor.fetchone()
+                total_attempts = ((result[0] if result else 0) or 0) + 1 # +1 — текущая попытка, если успешная
 
-    # ✅ Извлекаем уровень серьёзности ошибки (по умолчанию ставим 3)
-    #severity = int(severity) if severity else 3
+                # Переносим в успешные
+                cursor.execute("""
+                    INSERT INTO bt_3_successful_translations (user_id, sentence_id, score, attempt, date)
+                    VALUES (%s, %s, %s, %s, NOW());
+                """, (user_id, id_for_mistake_table, score, total_attempts))
 
-    # ✅ Проверка на идеальный перевод
-    score = int(score) if score else 0
+                # Удаляем из ошибок
+                cursor.execute("""
+                    DELETE FROM bt_3_detailed_mistakes
+                    WHERE sentence_id = %s AND user_id = %s;
+                """, (id_for_mistake_table, user_id))
 
+                cursor.execute("""
+                    DELETE FROM bt_3_attempts
+                    WHERE id_for_mistake_table = %s AND user_id= %s;
+                """,(id_for_mistake_table, user_id))
 
-    # ✅ Если нет ошибок — не записываем в базу
-    if len(valid_combinations) == 0:
-        print(f"✅ Нет categories and subcategories соответствующих названию ошибок в базе данных — пропускаем запись в базу.")
-        return
+                logging.info(f"✅ Перевод №{sentence_number} перемещён в успешные и удалён из ошибок.")
+            else:
+                logging.info(f"⚠️ Перевод №{sentence_number} пока не набрал 85, остаётся в ошибках.")
 
-    # ✅ Убираем дубли из valid_combinations (чтобы не логировать одно и то же)
-    valid_combinations = list(set(valid_combinations))
+                # Если мы не набрали 85 Баллов то необходимо увел attempt
+                cursor.execute("""
+                    INSERT INTO bt_3_attempts (user_id, id_for_mistake_table, timestamp)
+                    VALUES (%s, %s, NOW())
+                    ON CONFLICT (user_id, id_for_mistake_table)
+                    DO UPDATE SET
+                        attempt = bt_3_attempts.attempt + 1,
+                        timestamp= NOW();
+                """, (user_id, id_for_mistake_table))
+            return False  # не идём дальше
+
+        # Новый перевод (не был в ошибках)
+        if score >= 80:
+            cursor.execute("""
+                INSERT INTO bt_3_successful_translations (user_id, sentence_id, score, attempt, date)
+                VALUES(%s, %s, %s, %s, NOW());
+            """, (user_id, id_for_mistake_table, score, 1))
+            logging.info(f"✅ Новый успешный перевод №{sentence_number}, {score}/100")
+            return False
 
+        # Если перевод не набрал 80 С первого раза Мы должны увеличить счётчик attempt С 0 До 1 (по умолчанию стоит 1 Если мы вносим в таблицу предложения)
+        cursor.execute("""
+            INSERT INTO bt_3_attempts (user_id, id_for_mistake_table)
+            VALUES (%s, %s)
+            ON CONFLICT (user_id, id_for_mistake_table)
+            DO UPDATE SET attempt = bt_3_attempts.attempt + 1;
+        """, (user_id, id_for_mistake_table))
+        logging.info(f"✅ Записана попытка в bt_3_attempts: id_for_mistake_table={id_for_mistake_table}, score={score}")
+        return True
 
-    # ✅ Логирование финальных данных для каждой комбинации
-    for main_category, sub_category in valid_combinations:
-        # ✅ Восстанавливаем оригинальные значения перед записью в базу данных
-        main_category = next((cat for cat in VALID_CATEGORIES if cat.lower() == main_category), main_category)
-        sub_category = next((subcat for subcat in VALID_SUBCATEGORIES.get(main_category, []) if subcat.lower() == sub_category), sub_category)
-        
-        if main_category == "Other mistake" and sub_category == "Unclassified mistake":
-            print(f"⚠️ Ошибка '{main_category} - {sub_category}' добавлена в базу как неклассифицированная.")
-        else:
-            print(f"✅ Классифицировано: '{main_category} - {sub_category}'")
+    try:
+        with metrics.timer("grading_stage_seconds", stage="db"):
+            needs_mistake_log = await db_transaction("check_save_translation", save_translation)
+    except psycopg2.errors.UniqueViolation:
+        # uq_bt_3_translations_user_sentence: перевод уже сохранён параллельной проверкой
+        needs_mistake_log = None
 
-        print(f"🔍 Перед записью в БД: main_category = {main_category} | sub_category = {sub_category}")
+    if needs_mistake_log is None:
+        return f"⚠️ Вы уже переводили предложение {sentence_number}. Только первый перевод учитывается!"
 
-        if not isinstance(user_id, int):
-            print(f"❌ Ошибка типа данных: user_id = {type(user_id)}")
-            return
+    if needs_mistake_log:
+        # Добавляем в ошибки
+        try:
+            await log_translation_mistake(
+                user_id, original_text, user_translation,
+                categories, subcategories, score, correct_translation,
+                mistake_pairs=mistake_pairs, sentence_id=id_for_mistake_table
+            )
+            logging.info(f"🟥 Добавлен в ошибки: №{sentence_number}, score={score}")
 
-        if not isinstance(main_category, str) or not isinstance(sub_category, str):
-            print(f"❌ Ошибка типа данных: main_category = {type(main_category)}, sub_category = {type(sub_category)}")
-            return
+        except Exception as e:
+            logging.error(f"❌ Ошибка при записи ошибки: {e}")
 
+    # ✅ Результат для последующей отправки
+    return f"📜 **Предложение {sentence_number}**\n🎯 Оценка: {feedback}"
 
-        # ✅ Запись в базу данных
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                try:
-                    # ✅ Получаем id_for_mistake_table
-                    cursor.execute("""
-                    SELECT id_for_mistake_table 
-                    FROM bt_3_daily_sentences
-                    WHERE sentence=%s
-                    LIMIT 1;
-                """, (original_text, )
-                    )
-                    #sentence_id В нашем случае это идентификатор id_for_mistake_table Из таблицы bt_3_daily_sentences (для одинаковых предложений он одинаков) Для разных он разный.
-                    # это нужно чтобы правильно Помечать предложения особенно одинаковые предложения и потом их правильно удалять из базы данных на основании этого идентификатора
-                    result = cursor.fetchone()
-                    sentence_id = result[0] if result else None
-
-                    if sentence_id:
-                        logging.info(f"✅ sentence_id для предложения '{original_text}': {sentence_id}")
-                    else:
-                        logging.warning(f"⚠️ sentence_id не найдено для предложения '{original_text}'")
-                    
-                    # ✅ Вставляем в таблицу ошибок с использованием общего идентификатора
-                    #score = EXCLUDED.score означает:
-                    # "Обновить поле score в существующей строке, установив его в то значение score, которое мы только что пытались вставить in VALUES".
-                    cursor.execute("""
-                        INSERT INTO bt_3_detailed_mistakes (
-                            user_id, sentence, added_data, main_category, sub_category, mistake_count, sentence_id, correct_translation, score
-                        ) VALUES (%s, %s, NOW(), %s, %s, 1, %s, %s, %s)
-                        ON CONFLICT (user_id, sentence, main_category, sub_category)
-                        DO UPDATE SET
-                            mistake_count = bt_3_detailed_mistakes.mistake_count + 1,
-                            attempt = bt_3_detailed_mistakes.attempt + 1,
-                            last_seen = NOW(),
-                            score = EXCLUDED.score;
-                    """, (user_id, original_text, main_category, sub_category, sentence_id, correct_translation, score) # получить его из таблицы bt_daily_sentences Выше уже мы к этой таблице обращаемся и получаем из неё что-то добавить ещё session_id
-                    )
-                    
-                    conn.commit()
-                    print(f"✅ Ошибка '{main_category} - {sub_category}' успешно записана в базу.")
-                
-                except Exception as e:
-                    print(f"❌ Ошибка при записи в БД: {e}")
-                    logging.error(f"❌ Ошибка при записи в БД: {e}")
 
-    # ✅ Логирование успешного завершения обработки
-    print(f"✅ Все ошибки успешно обработаны!")
+async def grade_submitted_translation_safe(update: Update, context: CallbackContext, user_id, username, allowed_sentences, number_str, user_translation):
+    """Обёртка для параллельного режима: ограничивает конкурентность и не даёт одной ошибке отменить остальные проверки."""
+    try:
+        async with grading_slot(user_id):
+            return await grade_submitted_translation(update, context, user_id, username, allowed_sentences, number_str, user_translation)
+    except Exception as e:
+        logging.error(f"❌ Ошибка обработки предложения {number_str}: {e}")
+        return f"❌ Ошибка обработки предложения {number_str}"
 
 
+# Без session_action: проверку вызывают только обработчики текста и /translate, а они уже идут в очереди
+# пользователя — параллельной проверки от того же пользователя не бывает; повторную отправку того же
+# предложения отсекают already_translated и uq_bt_3_translations_user_sentence
 async def check_user_translation(update: Update, context: CallbackContext, translation_text=None):
-    
+
     if update.message is None or update.message.text is None:
         logging.warning("⚠️ update.message отсутствует в check_user_translation().")
         return
-    
+
     if "pending_translations" in context.user_data and context.user_data["pending_translations"]:
         translation_text = "\n".join(context.user_data["pending_translations"])
         #context.user_data["pending_translations"] = []
-    
+
     # Убираем команду "/translate", оставляя только переводы
     # message_text = update.message.text.strip()
     # translation_text = message_text.replace("/translate", "").strip()
@@ -1912,7 +1854,7 @@ async def check_user_translation(update: Update, context: CallbackContext, trans
     # Разбираем входной текст на номера предложений и переводы
     pattern = re.compile(r"(\d+)\.\s*([^\d\n]+(?:\n[^\d\n]+)*)", re.MULTILINE)
     translations = pattern.findall(translation_text)
-    
+
     print(f"✅ Извлечено {len(translations)} переводов: {translations}")
 
     if not translations:
@@ -1924,246 +1866,112 @@ async def check_user_translation(update: Update, context: CallbackContext, trans
     user_id = update.message.from_user.id
     username = update.message.from_user.first_name
 
-    # Подключаемся к базе данных
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Получаем разрешённые номера предложений
-    cursor.execute("""
-        SELECT unique_id FROM bt_3_daily_sentences WHERE date = CURRENT_DATE AND user_id = %s
-    """, (user_id,))
-    
-    allowed_sentences = {row[0] for row in cursor.fetchall()}  # Собираем в set() для быстрого поиска
+    # Получаем разрешённые номера предложений и их сессии
+    allowed_rows = await db_fetchall("check_allowed_sentences", SENTENCES_TODAY_SQL, (user_id,))
 
-    # Проверяем каждое предложение
-    results = []  # Храним результаты для Telegram
+    allowed_sentences = {row[0]: row[1] for row in allowed_rows}  # unique_id -> session_id, быстрый поиск по номеру
 
+    # Если один номер встречается в отправке дважды — учитываем только первый перевод
+    unique_translations = {}
     for number_str, user_translation in translations:
-        try:
-            sentence_number = int(number_str)
-
-            # Проверяем, принадлежит ли это предложение пользователю
-            if sentence_number not in allowed_sentences:
-                results.append(f"❌ Ошибка: Предложение {sentence_number} вам не принадлежит!")
-                continue
-
-            # Получаем оригинальный текст предложения
-            cursor.execute("""
-                SELECT id, sentence, session_id, id_for_mistake_table FROM bt_3_daily_sentences 
-                WHERE date = CURRENT_DATE AND unique_id = %s AND user_id = %s;
-            """, (sentence_number, user_id))
+        unique_translations.setdefault(int(number_str), (number_str, user_translation))
 
-            row = cursor.fetchone()
-
-            if not row:
-                results.append(f"❌ Ошибка: Предложение {sentence_number} не найдено.")
-                continue
-
-            sentence_id, original_text, session_id, id_for_mistake_table  = row
-
-            # Проверяем, отправлял ли этот пользователь перевод этого предложения
-            cursor.execute("""
-                SELECT id FROM bt_3_translations 
-                WHERE user_id = %s AND sentence_id = %s AND timestamp::date = CURRENT_DATE;
-            """, (user_id, sentence_id))
-
-            existing_translation = cursor.fetchone()
-            if existing_translation:
-                results.append(f"⚠️ Вы уже переводили предложение {sentence_number}. Только первый перевод учитывается!")
-                continue
-
-            logging.info(f"📌 Проверяем перевод №{sentence_number}: {user_translation}")
-
-            # Проверяем перевод через GPT
-            MAX_FEEDBACK_LENGTH = 1000  # Ограничим длину комментария GPT
+    # ✅ Отмечаем проверки как начатые, чтобы done() дождался именно их, а не опрашивал БД
+    for sentence_number in unique_translations:
+        session_tracker.begin(allowed_sentences.get(sentence_number))
 
+    async def grade_and_signal(number_str, user_translation, grade):
+        try:
+            return await grade(update, context, user_id, username, allowed_sentences, number_str, user_translation)
+        finally:
+            await session_tracker.finish(allowed_sentences.get(int(number_str)))
+
+    if GRADING_FANOUT_ENABLED:
+        # Все проверки запускаются сразу; каждая сама отправляет результат в чат, как только готова
+        results = await asyncio.gather(*(
+            grade_and_signal(number_str, user_translation, grade_submitted_translation_safe)
+            for number_str, user_translation in unique_translations.values()
+        ))
+    else:
+        results = []  # Храним результаты для Telegram
+        for number_str, user_translation in unique_translations.values():
             try:
-                feedback, categories, subcategories, score, correct_translation = await check_translation(original_text, user_translation, update, context, sentence_number)
-
+                results.append(await grade_and_signal(number_str, user_translation, grade_submitted_translation))
             except Exception as e:
-                print(f"⚠️ Ошибка при проверке перевода №{sentence_number}: {e}")
-                logging.error(f"⚠️ Ошибка при проверке перевода №{sentence_number}: {e}", exc_info=True)
-                feedback = "⚠️ Ошибка: не удалось проверить перевод."
-
-            score = int(score) if score else 50
-
-            # Обрезаем, если слишком длинный
-            if len(feedback) > MAX_FEEDBACK_LENGTH:
-                feedback = feedback[:MAX_FEEDBACK_LENGTH] + "...\n⚠️ Ответ GPT был сокращён."
-            
-            # ✅ Добавляем результат для последующей отправки    
-            results.append(f"📜 **Предложение {sentence_number}**\n🎯 Оценка: {feedback}")
-
-            # ✅ Сохраняем перевод в базу данных с защитой от ошибок
-            cursor.execute("""
-                INSERT INTO bt_3_translations (user_id, id_for_mistake_table, session_id, username, sentence_id, user_translation, score, feedback)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-            """, (user_id, id_for_mistake_table, session_id, username, sentence_id, user_translation, score, feedback))
-
-            conn.commit()
-
-            # Проверяем: реально ли это предложение есть в базе ошибок?
-            cursor.execute("""
-                SELECT COUNT(*) FROM bt_3_detailed_mistakes
-                WHERE sentence_id = %s AND user_id = %s;
-            """, (id_for_mistake_table, user_id))
-
-            was_in_mistakes = cursor.fetchone()[0] > 0
-
-            # === КЛЮЧЕВАЯ ЛОГИКА ===
-
-            if was_in_mistakes:
-                if score >= 85:
-                    # Получаем текущую максимальную попытку
-                    cursor.execute("""
-                        SELECT attempt 
-                        FROM bt_3_attempts
-                        WHERE id_for_mistake_table = %s AND user_id = %s;
-                    """, (id_for_mistake_table, user_id))
-                    
-                    result = cursor.fetchone()
-                    total_attempts = (result[0] or 0) + 1 # +1 — текущая попытка, если успешная
-
-                    # Переносим в успешные
-                    cursor.execute("""
-                        INSERT INTO bt_3_successful_translations (user_id, sentence_id, score, attempt, date)
-                        VALUES (%s, %s, %s, %s, NOW());
-                    """, (user_id, id_for_mistake_table, score, total_attempts))
-
-                    # Удаляем из ошибок
-                    cursor.execute("""
-                        DELETE FROM bt_3_detailed_mistakes
-                        WHERE sentence_id = %s AND user_id = %s;
-                    """, (id_for_mistake_table, user_id))
-
-                    cursor.execute("""
-                        DELETE FROM bt_3_attempts
-                        WHERE id_for_mistake_table = %s AND user_id= %s;
-                    """,(id_for_mistake_table, user_id))
-
-                    conn.commit()
-                    logging.info(f"✅ Перевод №{sentence_number} перемещён в успешные и удалён из ошибок.")
-                else:
-                    logging.info(f"⚠️ Перевод №{sentence_number} пока не набрал 85, остаётся в ошибках.")
-
-                    # Если мы не набрали 85 Баллов то необходимо увел attempt 
-                    cursor.execute("""
-                        INSERT INTO bt_3_attempts (user_id, id_for_mistake_table, timestamp)
-                        VALUES (%s, %s, NOW())
-                        ON CONFLICT (user_id, id_for_mistake_table)
-                        DO UPDATE SET 
-                            attempt = bt_3_attempts.attempt + 1,
-                            timestamp= NOW();
-                    """, (user_id, id_for_mistake_table))
-                    
-                    conn.commit()
-
-                continue  # не идём дальше
-
-            # Новый перевод (не был в ошибках)
-            if not was_in_mistakes:
-                if score >= 80:
-                    cursor.execute("""
-                        INSERT INTO bt_3_successful_translations (user_id, sentence_id, score, attempt, date)
-                        VALUES(%s, %s, %s, %s, NOW());
-                    """, (user_id, id_for_mistake_table, score, 1))
-                    conn.commit()
-                    logging.info(f"✅ Новый успешный перевод №{sentence_number}, {score}/100")
-                    continue
-                else:
-                    # Добавляем в ошибки
-                    try:
-                        # Если перевод не набрал 80 С первого раза Мы должны увеличить счётчик attempt С 0 До 1 (по умолчанию стоит 1 Если мы вносим в таблицу предложения)
-                        cursor.execute("""
-                            INSERT INTO bt_3_attempts (user_id, id_for_mistake_table)
-                            VALUES (%s, %s)
-                            ON CONFLICT (user_id, id_for_mistake_table)
-                            DO UPDATE SET attempt = bt_3_attempts.attempt + 1;
-                        """, (user_id, id_for_mistake_table))
-                        conn.commit()
-                        logging.info(f"✅ Записана попытка в bt_3_attempts: id_for_mistake_table={id_for_mistake_table}, score={score}")
-
-                        await log_translation_mistake(
-                            user_id, original_text, user_translation,
-                            categories, subcategories, score, correct_translation
-                        )
-                        logging.info(f"🟥 Добавлен в ошибки: №{sentence_number}, score={score}")
+                logging.error(f"❌ Ошибка обработки предложения {number_str}: {e}")
 
-                    except Exception as e:
-                        logging.error(f"❌ Ошибка при записи ошибки: {e}")
-
-        except Exception as e:
-            logging.error(f"❌ Ошибка обработки предложения {number_str}: {e}")
-            
-    cursor.close()
-    conn.close()
+    logging.info(f"✅ Проверено {len(results)} переводов пользователя {user_id}")
 
 
 
 async def get_original_sentences(user_id, context: CallbackContext):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    try:
-    
+    def load_known_sentences(cursor):
         # Выполняем SQL-запрос: выбираем 1 случайных предложений из базы данных в которую мы предварительно поместили предложение
         cursor.execute("SELECT sentence FROM bt_3_sentences ORDER BY RANDOM() LIMIT 1;")
         rows = [row[0] for row in cursor.fetchall()]   # Возвращаем список предложений
-        print(f"📌 Найдено в базе данных: {rows}") # ✅ Логируем результат
 
-        # ✅ Загружаем все предложения из базы ошибок
+        # ✅ Загружаем предложения из базы ошибок: группируем по sentence_id (индекс user_id, sentence_id)
+        # и берём не больше 5 — раньше сюда приходили все строки ошибок пользователя
         cursor.execute("""
-            SELECT sentence, sentence_id
-            FROM bt_3_detailed_mistakes
-            WHERE user_id = %s
-            ORDER BY mistake_count DESC, last_seen ASC; 
+            SELECT COALESCE(d.sentence, m.sentence), m.sentence_id
+            FROM (
+                SELECT sentence_id, MIN(sentence) AS sentence,
+                       MAX(mistake_count) AS mistake_count, MIN(last_seen) AS last_seen
+                FROM bt_3_detailed_mistakes
+                WHERE user_id = %s AND sentence_id IS NOT NULL
+                GROUP BY sentence_id
+                ORDER BY mistake_count DESC, last_seen ASC
+                LIMIT 5
+            ) m
+            LEFT JOIN bt_3_sentence_dictionary d ON d.id = m.sentence_id
+            ORDER BY m.mistake_count DESC, m.last_seen ASC;
         """, (user_id, ))
-        
-        # ✅ Используем set() для удаления дубликатов по sentence_id
-        already_given_sentence_ids = set()
-        unique_sentences = set()
-        mistake_sentences = []
+        return rows, cursor.fetchall()
 
-        for sentence, sentence_id in cursor.fetchall():
-            if sentence_id and sentence_id not in already_given_sentence_ids:
-                if sentence_id not in unique_sentences:
-                    unique_sentences.add(sentence_id)
-                    mistake_sentences.append(sentence)
-                    already_given_sentence_ids.add(sentence_id)
+    rows, mistake_rows = await db_transaction("original_sentences", load_known_sentences)
+    print(f"📌 Найдено в базе данных: {rows}") # ✅ Логируем результат
 
-                    # ✅ Ограничиваем до нужного количества предложений (например, 5)
-                    if len(mistake_sentences) == 5:
-                        break
+    # ✅ Используем set() для удаления дубликатов по sentence_id
+    already_given_sentence_ids = set()
+    unique_sentences = set()
+    mistake_sentences = []
 
+    for sentence, sentence_id in mistake_rows:
+        if sentence_id and sentence_id not in already_given_sentence_ids:
+            if sentence_id not in unique_sentences:
+                unique_sentences.add(sentence_id)
+                mistake_sentences.append(sentence)
+                already_given_sentence_ids.add(sentence_id)
 
-        print(f"✅ Уникальные предложения из базы ошибок: {len(mistake_sentences)} / 5")
+                # ✅ Ограничиваем до нужного количества предложений (например, 5)
+                if len(mistake_sentences) == 5:
+                    break
 
-        # 🔹 3. Определяем, сколько предложений не хватает до 7
-        num_sentences = 7 - len(rows) - len(mistake_sentences)
 
-        print(f"📌 Найдено: {len(rows)} в базе данных + {len(mistake_sentences)} повторение ошибок. Генерируем ещё {num_sentences} предложений.")
-        gpt_sentences = []
-        
-        # 📌 3. Остальные предложений генерируем через GPT
-        if num_sentences > 0:
-            print("⚠️ Генерируем дополнительные предложения через GPT-4...")
-            gpt_sentences = await generate_sentences(user_id, num_sentences, context)
-            #print(f"🚀 Сгенерированные GPT предложения: {gpt_sentences}") # ✅ Логируем результат
-            
-        
-        # ✅ Проверяем финальный список предложений
-        final_sentences = rows + mistake_sentences + gpt_sentences
-        print(f"✅ Финальный список предложений: {final_sentences}")
-        
-        if not final_sentences:
-            print("❌ Ошибка: Не удалось получить предложения!")
-            return []  # Вернём пустой список в случае ошибки
+    print(f"✅ Уникальные предложения из базы ошибок: {len(mistake_sentences)} / 5")
+
+    # 🔹 3. Определяем, сколько предложений не хватает до 7
+    num_sentences = 7 - len(rows) - len(mistake_sentences)
+
+    print(f"📌 Найдено: {len(rows)} в базе данных + {len(mistake_sentences)} повторение ошибок. Генерируем ещё {num_sentences} предложений.")
+    gpt_sentences = []
+    
+    # 📌 3. Остальные предложений генерируем через GPT
+    if num_sentences > 0:
+        print("⚠️ Генерируем дополнительные предложения через GPT-4...")
+        gpt_sentences = await generate_sentences(user_id, num_sentences, context)
+        #print(f"🚀 Сгенерированные GPT предложения: {gpt_sentences}") # ✅ Логируем результат
         
-        return final_sentences
     
-    finally: # Закрываем курсор и соединение **в конце**, независимо от того, какая ветка выполнялась
-        cursor.close()
-        conn.close()
+    # ✅ Проверяем финальный список предложений
+    final_sentences = rows + mistake_sentences + gpt_sentences
+    print(f"✅ Финальный список предложений: {final_sentences}")
+    
+    if not final_sentences:
+        print("❌ Ошибка: Не удалось получить предложения!")
+        return []  # Вернём пустой список в случае ошибки
+    
+    return final_sentences
 
 
 
@@ -2279,80 +2087,27 @@ def search_youtube_videous(topic, max_results=5):
 
 #📌 this function will filter and rate mistakes
 async def rate_mistakes(user_id):
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            
-            # we calculate amount of translated sentences of the user in a week 
-            cursor.execute("""
-                SELECT COUNT(sentence_id) 
-                FROM bt_3_translations 
-                WHERE user_id = %s AND timestamp >= NOW() - INTERVAL '6 days'; 
-            """, (user_id,))
-            total_sentences = cursor.fetchone()
-            total_sentences = total_sentences[0] if isinstance(total_sentences, tuple) else total_sentences or 0
-
-            # ✅ 2. Select and calculate all mistakes KPI within a week
-            cursor.execute("""
-                WITH user_mistakes AS (
-                    SELECT COUNT(*) AS mistakes_week
-                    FROM bt_3_detailed_mistakes
-                    WHERE user_id = %s
-                    AND added_data >= NOW() - INTERVAL '6 days'
-                ),
-                top_category AS (
-                    SELECT main_category
-                    FROM bt_3_detailed_mistakes
-                    WHERE user_id = %s
-                    AND added_data >= NOW() - INTERVAL '6 days'
-                    GROUP BY main_category
-                    ORDER BY COUNT(*) DESC
-                    LIMIT 1
-                ),
-                number_of_topcategory_mist AS (
-                    SELECT main_category, COUNT(*) AS number_of_top_category_mistakes
-                    FROM bt_3_detailed_mistakes
-                    WHERE user_id = %s
-                    AND added_data >= NOW() - INTERVAL '6 days'
-                    AND main_category = (SELECT main_category FROM top_category)
-                    GROUP BY main_category
-                    ORDER BY COUNT(*) DESC
-                    LIMIT 1
-                ),
-                top_two_subcategories AS (
-                    SELECT sub_category, 
-                        COUNT(*) AS count,
-                        ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) AS subcategory_rank
-                    FROM bt_3_detailed_mistakes 
-                    WHERE user_id = %s
-                    AND added_data >= NOW() - INTERVAL '6 days'
-                    AND main_category = (SELECT main_category FROM top_category)
-                    GROUP BY sub_category
-                    ORDER BY COUNT(*) DESC
-                    LIMIT 2
-                )
-                -- ✅ FINAL QUERY WITH LEFT JOIN TO AVOID EMPTY RESULTS
-                SELECT 
-                    COALESCE((SELECT mistakes_week FROM user_mistakes), 0) AS mistakes_week,
-                    COALESCE(ntc.main_category, 'неизвестно') AS top_mistake_category,
-                    COALESCE(ntc.number_of_top_category_mistakes, 0) AS number_of_top_category_mistakes,
-                    COALESCE(MAX(CASE WHEN tts.subcategory_rank = 1 THEN tts.sub_category END), 'неизвестно') AS top_subcategory_1,
-                    COALESCE(MAX(CASE WHEN tts.subcategory_rank = 2 THEN tts.sub_category END), 'неизвестно') AS top_subcategory_2
-                FROM number_of_topcategory_mist ntc
-                LEFT JOIN top_two_subcategories tts ON TRUE
-                GROUP BY ntc.main_category, ntc.number_of_top_category_mistakes;
-            """, (user_id, user_id, user_id, user_id))
-
-            # ✅ ОБРАБАТЫВАЕМ СЛУЧАЙ, КОГДА ВОЗВРАЩАЕТСЯ МЕНЬШЕ ДАННЫХ
-            result = cursor.fetchone()
-            if result is not None:
-                # Распаковываем все значения с защитой от отсутствия данных
-                mistakes_week, top_mistake_category, number_of_top_category_mistakes, top_mistake_subcategory_1, top_mistake_subcategory_2 = result
-            else:
-                # Если нет данных — возвращаем пустые значения
-                mistakes_week, top_mistake_category, number_of_top_category_mistakes, top_mistake_subcategory_1, top_mistake_subcategory_2 = 0, 'неизвестно', 0, 'неизвестно', 'неизвестно'
+    def load_kpis(cursor):
+        
+        # we calculate amount of translated sentences of the user in a week 
+        cursor.execute(WEEK_TRANSLATIONS_COUNT_SQL, (user_id,))
+        total_sentences = cursor.fetchone()
+        total_sentences = total_sentences[0] if isinstance(total_sentences, tuple) else total_sentences or 0
+
+        # ✅ 2. Select and calculate all mistakes KPI within a week
+        cursor.execute(WEEK_MISTAKES_KPI_SQL, (user_id, user_id, user_id, user_id))
 
+        # ✅ ОБРАБАТЫВАЕМ СЛУЧАЙ, КОГДА ВОЗВРАЩАЕТСЯ МЕНЬШЕ ДАННЫХ
+        result = cursor.fetchone()
+        if result is not None:
+            # Распаковываем все значения с защитой от отсутствия данных
+            mistakes_week, top_mistake_category, number_of_top_category_mistakes, top_mistake_subcategory_1, top_mistake_subcategory_2 = result
+        else:
+            # Если нет данных — возвращаем пустые значения
+            mistakes_week, top_mistake_category, number_of_top_category_mistakes, top_mistake_subcategory_1, top_mistake_subcategory_2 = 0, 'неизвестно', 0, 'неизвестно', 'неизвестно'
+        return total_sentences, mistakes_week, top_mistake_category, number_of_top_category_mistakes, top_mistake_subcategory_1, top_mistake_subcategory_2
 
-    return total_sentences, mistakes_week, top_mistake_category, number_of_top_category_mistakes, top_mistake_subcategory_1, top_mistake_subcategory_2
+    return await db_transaction("rate_mistakes", load_kpis)
 
 
 # ✅ Функция для проверки статуса ссылки
@@ -2408,16 +2163,11 @@ async def send_me_analytics_and_recommend_me(context: CallbackContext):
     #client = openai.AsyncOpenAI(api_key=openai.api_key)
     task_name = f"send_me_analytics_and_recommend_me"
     system_instruction_key = f"send_me_analytics_and_recommend_me"
-    assistant_id, _ = await get_or_create_openai_resources(system_instruction_key, task_name)
-            
 
     #get all user_id's from _DB to itterate over them and send them recommendations
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-            SELECT DISTINCT user_id FROM bt_3_detailed_mistakes;
-            """)
-            user_ids = cursor.fetchall()
+    user_ids = await db_fetchall("analytics_user_ids", """
+        SELECT DISTINCT user_id FROM bt_3_detailed_mistakes;
+    """)
     if not user_ids:
         print("❌ Нет пользователей с ошибками за последнюю неделю.")
         return
@@ -2425,18 +2175,10 @@ async def send_me_analytics_and_recommend_me(context: CallbackContext):
     for user_id, in user_ids:
         total_sentences, mistakes_week, top_mistake_category, number_of_top_category_mistakes, top_mistake_subcategory_1, top_mistake_subcategory_2 = await rate_mistakes(user_id)
         if total_sentences:
-            with get_db_connection() as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("""
-                        SELECT DISTINCT username FROM bt_3_translations WHERE user_id = %s;""",
-                        (user_id, ))
-
-                    result = cursor.fetchone()
-                    username = result[0] if result else "Unknown User"
-
-                # ✅ Создаём новый thread каждый раз
-                thread = await client.beta.threads.create()
-                thread_id = thread.id
+            result = await db_fetchone("analytics_username", """
+                SELECT DISTINCT username FROM bt_3_translations WHERE user_id = %s;""",
+                (user_id, ))
+            username = result[0] if result else "Unknown User"
 
             # ✅ Запрашиваем тему у OpenAI
             user_message = f"""
@@ -2445,52 +2187,24 @@ async def send_me_analytics_and_recommend_me(context: CallbackContext):
             - **Вторая подкатегория:** {top_mistake_subcategory_2}  
             """
 
-            for attempt in range(5):
-                try:
-                    await client.beta.threads.messages.create(
-                    thread_id=thread_id,
-                    role="user",
-                    content=user_message
-                )
+            # Запасной вариант, если модель недоступна: ищем видео прямо по подкатегории ошибок
+            topic = top_mistake_subcategory_1 or top_mistake_category
+            # Повторы при 429 и сетевых ошибках делает openai_guard — здесь один вызов
+            try:
+                topic = await run_assistant_task(system_instruction_key, user_message, task_name) or topic
 
-                    run = await client.beta.threads.runs.create(
-                        thread_id=thread_id,
-                        assistant_id=assistant_id
-                    )
-                    while True:
-                        run_status = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                        if run_status.status == "completed":
-                            break
-                        await asyncio.sleep(1)  # подожди чуть-чуть
-
-                    # Получаем сообщения после завершения run
-                    messages = await client.beta.threads.messages.list(thread_id=thread_id)
-                    last_message = messages.data[0]  # обычно последнее — ответ
-                    topic = last_message.content[0].text.value
-
-                    # response = await client.chat.completions.create(
-                    # model="gpt-4-turbo",
-                    # messages=[{"role": "user", "content": prompt}]
-                    # )
-                    # topic = response.choices[0].message.content.strip()
-                    
-                    try:
-                        await client.beta.threads.delete(thread_id=thread_id)
-                        logging.info(f"🗑️ Thread удалён: {thread_id}")
+                # response = await client.chat.completions.create(
+                # model="gpt-4-turbo",
+                # messages=[{"role": "user", "content": prompt}]
+                # )
+                # topic = response.choices[0].message.content.strip()
 
-                    except Exception as e:
-                        logging.warning(f"Не удалось удалить thread: {e}")
+                print(f"📌 Определена тема: {topic}")
+            except CircuitOpenError:
+                logging.warning(f"🔌 OpenAI недоступен (circuit open), тема по подкатегории: {topic}")
+            except Exception as e:
+                print(f"⚠️ Ошибка OpenAI: {e}, тема по подкатегории: {topic}")
 
-                    print(f"📌 Определена тема: {topic}")
-                    break
-                except openai.RateLimitError:
-                    wait_time = (attempt + 1 )*5
-                    print(f"⚠️ OpenAI API перегружен. Ждём {wait_time} сек...")
-                    await asyncio.sleep(wait_time)
-                except Exception as e:
-                    print(f"⚠️ Ошибка OpenAI: {e}")
-                    continue
-                
             # ✅ Ищем видео на YouTube только по конкретным каналам
             video_data = search_youtube_videous(topic)
 
@@ -2537,25 +2251,21 @@ async def send_me_analytics_and_recommend_me(context: CallbackContext):
             print("DEBUG: ", recommendations)
 
 
-            # ✅ Отправляем сообщение пользователю
-            await context.bot.send_message(
-                chat_id=BOT_GROUP_CHAT_ID_Deutsch, 
+            # ✅ Ставим сообщение в очередь отправки — лимиты Telegram соблюдает send_queue, без sleep
+            enqueue_send(
+                context.bot, BOT_GROUP_CHAT_ID_Deutsch,
                 text=recommendations,
                 parse_mode = "HTML"
                 )
-            await asyncio.sleep(5)
 
         else:
-            with get_db_connection() as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("""
-                        SELECT DISTINCT username FROM bt_3_translations WHERE user_id = %s;
-                    """, (user_id, ))
-                    result = cursor.fetchone()
-                    username = result[0] if result else f"User {user_id}"
+            result = await db_fetchone("analytics_username", """
+                SELECT DISTINCT username FROM bt_3_translations WHERE user_id = %s;
+            """, (user_id, ))
+            username = result[0] if result else f"User {user_id}"
             
-            await context.bot.send_message(
-                chat_id=BOT_GROUP_CHAT_ID_Deutsch,
+            enqueue_send(
+                context.bot, BOT_GROUP_CHAT_ID_Deutsch,
                 text=escape_html_with_bold(f"⚠️ Пользователь {username} не перевёл ни одного предложения на этой неделе."),
                 parse_mode="HTML"
             )
@@ -2563,18 +2273,7 @@ async def send_me_analytics_and_recommend_me(context: CallbackContext):
 
 async def force_finalize_sessions(context: CallbackContext = None):
     """Завершает ВСЕ незавершённые сессии только за сегодняшний день в 23:59."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        UPDATE bt_3_user_progress 
-        SET end_time = NOW(), completed = TRUE
-        WHERE completed = FALSE AND start_time::date = CURRENT_DATE;
-    """)
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+    await db_transaction("force_finalize_sessions", rollups.close_sessions, TODAY_SESSIONS_WHERE)
 
     msg = await context.bot.send_message(chat_id=BOT_GROUP_CHAT_ID_Deutsch, text="🔔 Все незавершённые сессии за сегодня автоматически закрыты!")
     #add_service_msg_id(context, msg.message_id)
@@ -2584,49 +2283,9 @@ async def force_finalize_sessions(context: CallbackContext = None):
 #SQL Запрос проверено
 async def send_weekly_summary(context: CallbackContext):
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 🔹 Собираем статистику за неделю
-    cursor.execute("""
-        SELECT 
-        t.username, 
-        COUNT(DISTINCT t.sentence_id) AS всего_переводов,
-        COALESCE(AVG(t.score), 0) AS средняя_оценка,
-        COALESCE(p.avg_time, 0) AS среднее_время_сессии_в_минутах, -- ✅ Среднее время сессии
-        COALESCE(p.total_time, 0) AS общее_время_в_минутах, -- ✅ Теперь есть и общее время
-        (SELECT COUNT(*) 
-        FROM bt_3_daily_sentences 
-        WHERE date >= CURRENT_DATE - INTERVAL '6 days' 
-        AND user_id = t.user_id) 
-        - COUNT(DISTINCT t.sentence_id) AS пропущено_за_неделю,
-        COALESCE(AVG(t.score), 0) 
-            - (COALESCE(p.avg_time, 0) * 1) -- ✅ Среднее время в штрафе
-            - ((SELECT COUNT(*) 
-                FROM bt_3_daily_sentences 
-                WHERE date >= CURRENT_DATE - INTERVAL '6 days' 
-                AND user_id = t.user_id) 
-            - COUNT(DISTINCT t.sentence_id)) * 20
-            AS итоговый_балл
-    FROM bt_3_translations t
-    LEFT JOIN (
-        SELECT user_id, 
-            AVG(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS avg_time, -- ✅ Среднее время сессии
-            SUM(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS total_time -- ✅ Общее время
-        FROM bt_3_user_progress 
-        WHERE completed = TRUE 
-        AND start_time >= CURRENT_DATE - INTERVAL '6 days'
-        GROUP BY user_id
-    ) p ON t.user_id = p.user_id
-    WHERE t.timestamp >= CURRENT_DATE - INTERVAL '6 days'
-    GROUP BY t.username, t.user_id, p.avg_time, p.total_time
-    ORDER BY итоговый_балл DESC;
-
-    """)
-    rows = cursor.fetchall()
-
-    cursor.close()
-    conn.close()
+    # Обновляем недельную таблицу лидеров перед итогами, чтобы учесть переводы последних минут
+    await refresh_leaderboards(periods=["week"])
+    rows = await db_transaction("weekly_summary", load_leaderboard, "week")
 
     if not rows:
         await context.bot.send_message(chat_id=BOT_GROUP_CHAT_ID_Deutsch, text="📊 Неделя прошла, но никто не перевел ни одного предложения!")
@@ -2635,7 +2294,7 @@ async def send_weekly_summary(context: CallbackContext):
     summary = "🏆 Итоги недели:\n\n"
 
     medals = ["🥇", "🥈", "🥉"]
-    for i, (username, count, avg_score, avg_minutes, total_minutes, missed, final_score) in enumerate(rows):
+    for i, (user_id, username, count, avg_score, avg_minutes, total_minutes, missed, final_score, place) in enumerate(rows):
         medal = medals[i] if i < len(medals) else "💩"
         summary += (
             f"{medal} {username}\n"
@@ -2655,79 +2314,21 @@ async def user_stats(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     username = update.message.from_user.first_name
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 📌 Статистика за сегодняшний день (обновлено для среднего времени) Если за семь дней считать то нужно так: WHERE date BETWEEN CURRENT_DATE - INTERVAL '7 days' AND CURRENT_DATE - INTERVAL '1 day'
-    cursor.execute("""
-        SELECT 
-            COUNT(DISTINCT t.sentence_id) AS переведено,  
-            COALESCE(AVG(t.score), 0) AS средняя_оценка,
-            COALESCE((
-                SELECT AVG(EXTRACT(EPOCH FROM (p.end_time - p.start_time)) / 60)  -- ✅ Используем AVG вместо SUM
-                FROM bt_3_user_progress p
-                WHERE p.user_id = t.user_id 
-                    AND p.start_time::date = CURRENT_DATE
-                    AND p.completed = TRUE
-            ), 0) AS среднее_время_сессии_в_минутах,  -- ✅ Обновили название, чтобы было понятно
-            GREATEST(0, (SELECT COUNT(*) FROM bt_3_daily_sentences 
-                        WHERE date = CURRENT_DATE AND user_id = t.user_id) - COUNT(DISTINCT t.sentence_id)) AS пропущено,
-            COALESCE(AVG(t.score), 0) 
-                - (COALESCE((
-                    SELECT AVG(EXTRACT(EPOCH FROM (p.end_time - p.start_time)) / 60)  -- ✅ Здесь тоже AVG
-                    FROM bt_3_user_progress p
-                    WHERE p.user_id = t.user_id 
-                        AND p.start_time::date = CURRENT_DATE
-                        AND p.completed = TRUE
-                ), 0) * 1) 
-                - (GREATEST(0, (SELECT COUNT(*) FROM bt_3_daily_sentences
-                                WHERE date = CURRENT_DATE AND user_id = t.user_id) - COUNT(DISTINCT t.sentence_id)) * 20) AS итоговый_балл
-        FROM bt_3_translations t
-        WHERE t.user_id = %s AND t.timestamp::date = CURRENT_DATE
-        GROUP BY t.user_id;
-    """, (user_id,))
-
-    today_stats = cursor.fetchone()
-
-    # 📌 Недельная статистика (обновлено для среднего времени)
-    cursor.execute("""
-        SELECT 
-            t.user_id,
-            COUNT(DISTINCT t.sentence_id) AS всего_переводов,
-            COALESCE(AVG(t.score), 0) AS средняя_оценка,
-            COALESCE(p.avg_session_time, 0) AS среднее_время_сессии_в_минутах,  
-            COALESCE(p.total_time, 0) AS общее_время_за_неделю,  
-            GREATEST(0, COALESCE(ds.total_sentences, 0) - COUNT(DISTINCT t.sentence_id)) AS пропущено_за_неделю,
-            COALESCE(AVG(t.score), 0) 
-                - (COALESCE(p.avg_session_time, 0) * 1)  
-                - (GREATEST(0, COALESCE(ds.total_sentences, 0) - COUNT(DISTINCT t.sentence_id)) * 20) AS итоговый_балл
-        FROM bt_3_translations t
-        LEFT JOIN (
-            -- ✅ Отдельный подзапрос для корректного расчёта времени по каждому пользователю
-            SELECT 
-                user_id, 
-                AVG(EXTRACT(EPOCH FROM (end_time - start_time)) / 60) AS avg_session_time, 
-                SUM(EXTRACT(EPOCH FROM (end_time - start_time)) / 60) AS total_time 
-            FROM bt_3_user_progress
-            WHERE completed = TRUE 
-                AND start_time >= CURRENT_DATE - INTERVAL '6 days'
-            GROUP BY user_id
-        ) p ON t.user_id = p.user_id
-        LEFT JOIN (
-            SELECT user_id, COUNT(*) AS total_sentences
-            FROM bt_3_daily_sentences
-            WHERE date >= CURRENT_DATE - INTERVAL '6 days'
-            GROUP BY user_id
-        ) ds ON t.user_id = ds.user_id
-        WHERE t.timestamp >= CURRENT_DATE - INTERVAL '6 days' 
-            AND t.user_id = %s  -- ✅ Фильтр по конкретному пользователю
-        GROUP BY t.user_id, p.avg_session_time, p.total_time, ds.total_sentences;
-    """, (user_id,))
-
-    weekly_stats = cursor.fetchone()
-
-    cursor.close()
-    conn.close()
+    def load_user_stats(cursor):
+
+        # 📌 Статистика за сегодняшний день — одна строка дневного агрегата (backend/rollups.py)
+        cursor.execute(USER_STATS_TODAY_SQL, (user_id,))
+        row = cursor.fetchone()
+        # Порядок столбцов ответа: переведено, средняя оценка, среднее время сессии, пропущено, итоговый балл
+        today_stats = (row[0], row[1], row[2], row[4], row[5]) if row else None
+
+        # 📌 Недельная статистика — строка пользователя в таблице лидеров за неделю
+        rows = load_leaderboard(cursor, "week", user_id)
+        # Порядок столбцов ответа: user_id, переведено, средняя оценка, среднее время, общее время, пропущено, итоговый балл
+        weekly_stats = (rows[0][0], *rows[0][2:8]) if rows else None
+        return today_stats, weekly_stats
+
+    today_stats, weekly_stats = await db_transaction("user_stats", load_user_stats)
 
     # 📌 Формирование ответа
     if today_stats:
@@ -2759,61 +2360,46 @@ async def user_stats(update: Update, context: CallbackContext):
 
 
 
-async def send_daily_summary(context: CallbackContext):
+def load_daily_rollups(cursor):
+    """
+    Сегодняшние агрегаты всех пользователей, которым выданы предложения, лучшие — первыми:
+    (user_id, всего предложений, переведено, пропущено, среднее время, общее время, средняя оценка, итоговый балл).
+    """
+    cursor.execute(f"""
+        SELECT user_id, sentences_total, translated, missed, avg_minutes, total_minutes, avg_score, final_score
+        FROM (
+            SELECT user_id, sentences_total, translated, {rollups.REPORT_COLUMNS_SQL}
+            FROM bt_3_daily_rollups
+            WHERE day = CURRENT_DATE AND sentences_total > 0
+        ) r
+        ORDER BY final_score DESC;
+    """)
+    return cursor.fetchall()
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
-    # 🔹 Собираем активных пользователей (кто перевёл хотя бы одно предложение)
-    cursor.execute("""
-        SELECT DISTINCT user_id, username 
-        FROM bt_3_translations
-        WHERE timestamp::date = CURRENT_DATE;
-    """)
-    active_users = {row[0]: row[1] for row in cursor.fetchall()}
+async def send_daily_summary(context: CallbackContext):
+    # Сначала сохраняем буфер активности, чтобы отчёт видел последние сообщения в чате
+    await flush_activity()
 
-    # 🔹 Собираем всех, кто хоть что-то писал в чат
-    cursor.execute("""
-        SELECT DISTINCT user_id, username
-        FROM bt_3_messages
-        WHERE timestamp >= date_trunc('month', CURRENT_DATE);
-    """)
-    all_users = {row[0]: row[1] for row in cursor.fetchall()}
-    for user_id, username in all_users.items():
-        print(f"User ID from rows: {user_id}, uswername: {username}")
-
-    # 🔹 Собираем статистику за день
-    cursor.execute("""
-       SELECT 
-            ds.user_id, 
-            COUNT(DISTINCT ds.id) AS total_sentences,
-            COUNT(DISTINCT t.id) AS translated,
-            (COUNT(DISTINCT ds.id) - COUNT(DISTINCT t.id)) AS missed,
-            COALESCE(p.avg_time, 0) AS avg_time_minutes, 
-            COALESCE(p.total_time, 0) AS total_time_minutes, 
-            COALESCE(AVG(t.score), 0) AS avg_score,
-            COALESCE(AVG(t.score), 0) 
-            - (COALESCE(p.avg_time, 0) * 1) 
-            - ((COUNT(DISTINCT ds.id) - COUNT(DISTINCT t.id)) * 20) AS final_score
-        FROM bt_3_daily_sentences ds
-        LEFT JOIN bt_3_translations t ON ds.user_id = t.user_id AND ds.id = t.sentence_id
-        LEFT JOIN (
-            SELECT user_id, 
-                AVG(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS avg_time, 
-                SUM(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS total_time
-            FROM bt_3_user_progress
-            WHERE completed = true
-        		AND start_time::date = CURRENT_DATE -- ✅ Теперь только за день
-            GROUP BY user_id
-        ) p ON ds.user_id = p.user_id
-        WHERE ds.date = CURRENT_DATE
-        GROUP BY ds.user_id, p.avg_time, p.total_time
-        ORDER BY final_score DESC;
-    """)
-    rows = cursor.fetchall()
+    def load_daily_summary(cursor):
 
-    cursor.close()
-    conn.close()
+        # 🔹 Собираем всех, кто хоть что-то писал в чат
+        cursor.execute("""
+            SELECT DISTINCT user_id, username
+            FROM bt_3_messages
+            WHERE timestamp >= date_trunc('month', CURRENT_DATE);
+        """)
+        all_users = {row[0]: row[1] for row in cursor.fetchall()}
+        for user_id, username in all_users.items():
+            print(f"User ID from rows: {user_id}, uswername: {username}")
+
+        # 🔹 Статистика за день — строки дневных агрегатов (backend/rollups.py)
+        rows = load_daily_rollups(cursor)
+        # Активные — кто перевёл хотя бы одно предложение
+        active_users = {row[0] for row in rows if row[2] > 0}
+        return active_users, all_users, rows
+
+    active_users, all_users, rows = await db_transaction("daily_summary", load_daily_summary)
 
     # 🔹 Формируем итоговый отчёт
     if not rows:
@@ -2849,55 +2435,25 @@ async def send_daily_summary(context: CallbackContext):
 
 
 async def send_progress_report(context: CallbackContext):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 🔹 Получаем всех пользователей, которые писали в чат **за месяц**
-    cursor.execute("""
-        SELECT DISTINCT user_id, username 
-        FROM bt_3_messages
-        WHERE timestamp >= date_trunc('month', CURRENT_DATE);
-    """)
-    all_users = {int(row[0]): row[1] for row in cursor.fetchall()}
+    # Сначала сохраняем буфер активности, чтобы отчёт видел последние сообщения в чате
+    await flush_activity()
+    def load_progress_report(cursor):
 
-    # 🔹 Получаем всех, кто перевёл хотя бы одно предложение **за сегодня**
-    cursor.execute("""
-        SELECT DISTINCT user_id FROM bt_3_translations WHERE timestamp::date = CURRENT_DATE;
-    """)
-    active_users = {row[0] for row in cursor.fetchall()}
-
-    # 🔹 Собираем статистику по пользователям **за сегодня**(checked)
-    cursor.execute("""
-        SELECT 
-        ds.user_id,
-        COUNT(DISTINCT ds.id) AS всего_предложений,
-        COUNT(DISTINCT t.id) AS переведено,
-        (COUNT(DISTINCT ds.id) - COUNT(DISTINCT t.id)) AS пропущено,
-        COALESCE(p.avg_time, 0) AS среднее_время_сессии_в_минутах, -- ✅ Среднее время за день
-        COALESCE(p.total_time, 0) AS общее_время_за_день, -- ✅ Общее время за день
-        COALESCE(AVG(t.score), 0) AS средняя_оценка,
-        COALESCE(AVG(t.score), 0) 
-            - (COALESCE(p.avg_time, 0) * 1) -- ✅ Используем среднее время в расчётах
-            - ((COUNT(DISTINCT ds.id) - COUNT(DISTINCT t.id)) * 20) AS итоговый_балл
-    FROM bt_3_daily_sentences ds
-    LEFT JOIN bt_3_translations t ON ds.user_id = t.user_id AND ds.id = t.sentence_id
-    LEFT JOIN (
-        SELECT user_id, 
-            AVG(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS avg_time, -- ✅ Среднее время сессии за день
-            SUM(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS total_time -- ✅ Общее время за день
-        FROM bt_3_user_progress
-        WHERE completed = TRUE 
-            AND start_time::date = CURRENT_DATE -- ✅ Теперь только за день
-        GROUP BY user_id
-    ) p ON ds.user_id = p.user_id
-    WHERE ds.date = CURRENT_DATE
-    GROUP BY ds.user_id, p.avg_time, p.total_time
-    ORDER BY итоговый_балл DESC;
-    """)
-    rows = cursor.fetchall()
+        # 🔹 Получаем всех пользователей, которые писали в чат **за месяц**
+        cursor.execute("""
+            SELECT DISTINCT user_id, username 
+            FROM bt_3_messages
+            WHERE timestamp >= date_trunc('month', CURRENT_DATE);
+        """)
+        all_users = {int(row[0]): row[1] for row in cursor.fetchall()}
 
-    cursor.close()
-    conn.close()
+        # 🔹 Статистика по пользователям **за сегодня** — строки дневных агрегатов (backend/rollups.py)
+        rows = load_daily_rollups(cursor)
+        # 🔹 Активные — кто перевёл хотя бы одно предложение **за сегодня**
+        active_users = {row[0] for row in rows if row[2] > 0}
+        return all_users, active_users, rows
+
+    all_users, active_users, rows = await db_transaction("progress_report", load_progress_report)
 
     # 🔹 Формируем отчёт
     if not rows:
@@ -2927,6 +2483,79 @@ async def send_progress_report(context: CallbackContext):
     await context.bot.send_message(chat_id=BOT_GROUP_CHAT_ID_Deutsch, text=progress_report)
 
 
+async def log_performance_metrics(context: CallbackContext = None):
+    """Периодически пишет в лог статистику пула соединений и гистограммы задержек."""
+    stats = get_pool_stats()
+    if stats:
+        logging.info(
+            f"📊 DB pool: in_use={stats['in_use']}/{stats['max_size']}, idle={stats['idle']}, "
+            f"max_in_use={stats['max_in_use']}, acquired={stats['acquired']}, timeouts={stats['timeouts']}, "
+            f"healthcheck_failures={stats['healthcheck_failures']}, avg_wait={stats['avg_wait_time']*1000:.1f} ms"
+        )
+    for kind in ("grading", "explanation"):
+        rate = grading_cache_hit_rate(kind)
+        if rate is not None:
+            logging.info(f"♻️ Кэш '{kind}': hit rate {rate:.0%}")
+    depth = send_queue_depth()
+    if depth:
+        logging.info(f"📤 Очередь отправки Telegram: {depth} сообщений")
+    report = metrics.format_report()
+    if report:
+        logging.info(f"📊 Метрики:\n{report}")
+
+
+# ✅ Таблица кнопок главного меню: текст кнопки -> (имя маршрута для метрик, обработчик)
+MENU_ROUTES = {
+    "📌 Выбрать тему": ("choose_topic", choose_topic),
+    "🚀 Начать перевод": ("letsgo", letsgo),
+    "✅ Завершить перевод": ("done", done),
+    "🟡 Посмотреть свою статистику": ("user_stats", user_stats),
+    "📜 Проверить перевод": ("check_translation", check_translation_from_text),
+    "🎙 Начать урок": ("lesson_link", send_lesson_link),
+}
+
+
+def classify_text_message(text: str):
+    """Определяет маршрут сообщения один раз: (route, handler, translations)."""
+    menu_route = MENU_ROUTES.get(text)
+    if menu_route is not None:
+        return menu_route[0], menu_route[1], None
+    translations = TRANSLATION_LINE_PATTERN.findall(text)
+    if translations:
+        return "translation", store_pending_translations, translations
+    return "free_text", None, None
+
+
+async def route_text_message(update: Update, context: CallbackContext):
+    """
+    Единственный обработчик текстовых сообщений (group=1): кнопка меню, перевод с номером или свободный текст.
+    Каждое сообщение разбирается один раз и уходит ровно в одну корутину.
+    Пишет метрики router_dispatch_total{route} и router_dispatch_seconds{route}.
+    """
+    if update.message is None or update.message.text is None:
+        logging.warning("⚠️ update.message отсутствует или пустое.")
+        return
+
+    text = update.message.text.strip()
+    route, handler, translations = classify_text_message(text)
+    metrics.inc("router_dispatch_total", route=route)
+
+    if route != "translation":
+        # Кнопки и свободный текст удаляем из чата вместе с сервисными сообщениями
+        add_service_msg_id(context, update.message.message_id)
+
+    if handler is None:
+        logging.info(f"📥 Сообщение без маршрута от {update.message.from_user.id}: {text[:50]!r}")
+        return
+
+    logging.info(f"📥 Маршрут '{route}' для пользователя {update.message.from_user.id}")
+    with metrics.timer("router_dispatch_seconds", route=route):
+        if translations is not None:
+            await handler(update, context, translations)
+        else:
+            await handler(update, context)
+
+
 async def error_handler(update, context):
     logging.error(f"❌ Ошибка в обработчике Telegram: {context.error}")
 
@@ -3023,91 +2652,89 @@ async def mistakes_to_voice(username, sentence_pairs):
 
 async def get_yesterdays_mistakes_for_audio_message(context: CallbackContext):
     
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
+    # take all users who made at least one mistake from bt_3_detailed_mistakes table
+    user_rows = await db_fetchall("audio_user_ids", """
+        SELECT DISTINCT user_id FROM bt_3_detailed_mistakes
+        WHERE added_data >= NOW() - INTERVAL '6 days';
+    """)
+    user_ids = [i[0] for i in user_rows if i[0] is not None]
+    print(user_ids)
 
-            # take all users who made at least one mistake from bt_3_detailed_mistakes table
-            cursor.execute("""
-                SELECT DISTINCT user_id FROM bt_3_detailed_mistakes
-                WHERE added_data >= NOW() - INTERVAL '6 days';
-            """)
-            user_ids = [i[0] for i in cursor.fetchall() if i[0] is not None]
-            print(user_ids)
-            for user_id in user_ids:
-                original_by_id = {}
+    def load_user_mistakes(cursor, user_id):
+        cursor.execute("""
+        SELECT username FROM bt_3_user_progress
+        WHERE user_id = %s;
+        """, (user_id,))
+        row = cursor.fetchone()
+        username = row[0] if row and row[0] else f"useer_{user_id}"
 
-                cursor.execute("""
-                SELECT username FROM bt_3_user_progress
-                WHERE user_id = %s;
-                """, (user_id,))
-                row = cursor.fetchone()
-                username = row[0] if row and row[0] else f"useer_{user_id}"
-
-                ## Шаг 1 — Собираем оригинальные предложения по user_id
-                # ✅ Загружаем все предложения из базы ошибок
-                cursor.execute("""
-                    SELECT sentence, correct_translation
-                    FROM bt_3_detailed_mistakes
-                    WHERE user_id = %s
-                    ORDER BY mistake_count DESC, last_seen ASC; 
-                """, (user_id, ))
-                
-                # ✅ Используем set() для удаления дубликатов по sentence_id
-                already_given_sentence_translation = set()
-                unique_sentences = set()
-                mistake_sentences = []
-                result_for_audio = []
-                
-                rows = cursor.fetchall()
-                max_to_collect = min(len(rows), 5)
-
-                for sentence, correct_translation in rows:
-                    if sentence and correct_translation and correct_translation not in already_given_sentence_translation and sentence not in mistake_sentences:
-                        if correct_translation not in unique_sentences:
-                            unique_sentences.add(correct_translation)
-                            mistake_sentences.append(sentence)
-                            already_given_sentence_translation.add(correct_translation)
-                            original_by_id[correct_translation] = sentence
-
-                            # ✅ Ограничиваем до нужного количества предложений (например, 5)
-                            
-                            if len(mistake_sentences) == max_to_collect:
-                                break
-
-                sentence_pairs = [(origin_sentence, correct_transl) for correct_transl, origin_sentence in original_by_id.items()]
-                try:
-                    await mistakes_to_voice(username, sentence_pairs)
-                except Exception as e:
-                    print(f"❌ Ошибка синтеза речи для {username}: {e}")
-                    continue
-                audio_path = Path(f"{username}.mp3")
-                print(f"📦 Размер файла: {audio_path.stat().st_size / 1024 / 1024:.2f} MB ")
-
-                if audio_path.exists():
-                    try:
-                        start = asyncio.get_running_loop().time()
-                        with audio_path.open("rb") as audio_file:
-                            await context.bot.send_audio(
-                                chat_id=BOT_GROUP_CHAT_ID_Deutsch, 
-                                audio=audio_file,
-                                caption=f"🎧 Ошибки пользователя @{username} за вчерашний день."
-                            )
-                        print(f"⏱ Отправка заняла {asyncio.get_running_loop().time() - start:.2f} секунд")
-                        await asyncio.sleep(5)
-                    except Exception as e:
-                        print(f"❌ Ошибка при отправке аудиофайла для @{username}: {e}")
-
-                    try:    
-                        audio_path.unlink()
-                    except FileNotFoundError:
-                        print(f"⚠️ Файл уже был удалён: {audio_path}")
-                
-                else:
-                    await context.bot.send_message(
-                        chat_id=BOT_GROUP_CHAT_ID_Deutsch,
-                        text=f"❌ Для пользователя @{username} не найден аудиофайл."
-                    )
-                    await asyncio.sleep(5)
+        ## Шаг 1 — Собираем оригинальные предложения по user_id
+        # ✅ Загружаем все предложения из базы ошибок
+        cursor.execute("""
+            SELECT sentence, correct_translation
+            FROM bt_3_detailed_mistakes
+            WHERE user_id = %s
+            ORDER BY mistake_count DESC, last_seen ASC; 
+        """, (user_id, ))
+        return username, cursor.fetchall()
+
+    for user_id in user_ids:
+        original_by_id = {}
+        # Курсор не держим открытым во время синтеза речи и отправки аудио
+        username, rows = await db_transaction("audio_user_mistakes", load_user_mistakes, user_id)
+
+        # ✅ Используем set() для удаления дубликатов по sentence_id
+        already_given_sentence_translation = set()
+        unique_sentences = set()
+        mistake_sentences = []
+        result_for_audio = []
+        
+        max_to_collect = min(len(rows), 5)
+
+        for sentence, correct_translation in rows:
+            if sentence and correct_translation and correct_translation not in already_given_sentence_translation and sentence not in mistake_sentences:
+                if correct_translation not in unique_sentences:
+                    unique_sentences.add(correct_translation)
+                    mistake_sentences.append(sentence)
+                    already_given_sentence_translation.add(correct_translation)
+                    original_by_id[correct_translation] = sentence
+
+                    # ✅ Ограничиваем до нужного количества предложений (например, 5)
+                    
+                    if len(mistake_sentences) == max_to_collect:
+                        break
+
+        sentence_pairs = [(origin_sentence, correct_transl) for correct_transl, origin_sentence in original_by_id.items()]
+        try:
+            await mistakes_to_voice(username, sentence_pairs)
+        except Exception as e:
+            print(f"❌ Ошибка синтеза речи для {username}: {e}")
+            continue
+        audio_path = Path(f"{username}.mp3")
+        print(f"📦 Размер файла: {audio_path.stat().st_size / 1024 / 1024:.2f} MB ")
+
+        if audio_path.exists():
+            try:
+                # Файл читаем сразу: отправка из очереди может случиться позже, а файл удаляется ниже
+                enqueue_send(
+                    context.bot, BOT_GROUP_CHAT_ID_Deutsch, "send_audio",
+                    audio=audio_path.read_bytes(),
+                    filename=audio_path.name,
+                    caption=f"🎧 Ошибки пользователя @{username} за вчерашний день."
+                )
+            except Exception as e:
+                print(f"❌ Ошибка при отправке аудиофайла для @{username}: {e}")
+
+            try:    
+                audio_path.unlink()
+            except FileNotFoundError:
+                print(f"⚠️ Файл уже был удалён: {audio_path}")
+        
+        else:
+            enqueue_send(
+                context.bot, BOT_GROUP_CHAT_ID_Deutsch,
+                text=f"❌ Для пользователя @{username} не найден аудиофайл."
+            )
 
 
 # import atexit
@@ -3239,20 +2866,17 @@ async def send_user_analytics_bar_charts(context: CallbackContext, period="day")
     start_date, end_date = get_date_range(period)
 
     # Send one message before starting the process
-    await context.bot.send_message(chat_id=chat_id, text="🚀 Starting to prepare analytical reports for all active users...")
+    enqueue_send(context.bot, chat_id, text="🚀 Starting to prepare analytical reports for all active users...")
 
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as curr: # FIXED: added ()
-                # RECOMMENDATION: Get users who have actually translated something
-                curr.execute("""
-                    SELECT DISTINCT user_id, username
-                    FROM bt_3_translations;
-                """)
-                all_users = curr.fetchall()
+        # RECOMMENDATION: Get users who have actually translated something
+        all_users = await db_fetchall("analytics_chart_users", """
+            SELECT DISTINCT user_id, username
+            FROM bt_3_translations;
+        """)
         
         if not all_users:
-            await context.bot.send_message(chat_id=chat_id, text="No active users found for analysis today.")
+            enqueue_send(context.bot, chat_id, text="No active users found for analysis today.")
             return
 
         for user_id, username in all_users:
@@ -3267,21 +2891,22 @@ async def send_user_analytics_bar_charts(context: CallbackContext, period="day")
                     print(f"Data for {username} prepared. Drawing plots...")
                     image_path = await create_analytics_figure_async(daily_data, weekly_data, user_id)
                     
-                    # FIXED: send_photo method name
-                    await context.bot.send_photo(chat_id=chat_id, photo=open(image_path, 'rb'), caption=f"📊 Analytics for user: {username}")
+                    # Картинку читаем в память и сразу удаляем файл; отправкой занимается send_queue
+                    with open(image_path, 'rb') as image_file:
+                        photo = image_file.read()
                     os.remove(image_path)
+                    enqueue_send(context.bot, chat_id, "send_photo", photo=photo, caption=f"📊 Analytics for user: {username}")
                 else:
                     print(f"⚠️ No data found for analysis for user {username} ({user_id}).")
 
             except Exception as e:
                 logging.error(f"Error creating individual report for {username} ({user_id}): {e}")
                 # Report the error, but continue the loop for other users
-                await context.bot.send_message(chat_id=chat_id, text=f"❌ Failed to create a report for {username}.")
+                enqueue_send(context.bot, chat_id, text=f"❌ Failed to create a report for {username}.")
 
     except Exception as e:
         logging.error(f"Critical error during send_user_analytics_bar_charts execution: {e}")
-        # FIXED: added await
-        await context.bot.send_message(chat_id=chat_id, text="❌ A general error occurred while creating reports.")
+        enqueue_send(context.bot, chat_id, text="❌ A general error occurred while creating reports.")
 
 
 async def send_users_comparison_bar_chart(context: CallbackContext, period):
@@ -3306,31 +2931,58 @@ async def send_users_comparison_bar_chart(context: CallbackContext, period):
 
 
 
+# ✅ Режим получения обновлений: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Сколько обновлений обрабатывается одновременно (обновления одного пользователя — всё равно по очереди)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "32"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный https-адрес без пути, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # проверяется по заголовку X-Telegram-Bot-Api-Secret-Token
+# Сколько секунд при остановке ждём отправки сообщений, уже поставленных в send_queue
+SEND_QUEUE_DRAIN_TIMEOUT = float(os.getenv("SEND_QUEUE_DRAIN_TIMEOUT", "10"))
+
+
+async def drain_send_queue(application: Application):
+    """post_stop: бот ещё инициализирован — дожидаемся отправки сообщений из очереди, а не теряем их."""
+    if not await send_queue_drain(timeout=SEND_QUEUE_DRAIN_TIMEOUT):
+        logging.warning(f"⚠️ Очередь отправки не опустела за {SEND_QUEUE_DRAIN_TIMEOUT} сек, осталось {send_queue_depth()}")
+
+
 def main():
     global application
     
-    # Инициализация базы данных from database.py 
-    init_db()
+    # ✅ Схема БД: при старте только сверяем номер версии, недостающие миграции — backend/migrations.py
+    ensure_schema()
 
     #defaults = Defaults(timeout=60)  # увеличили таймаут до 60 секунд
-    application = Application.builder().token(TELEGRAM_Deutsch_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_Deutsch_BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES))
+        .post_stop(drain_send_queue)
+        .build()
+    )
     application.bot.request.timeout = 60
 
     # 🔹 Добавляем обработчики команд (исправленный порядок)
     application.add_handler(CommandHandler("start", start))
-    # 🔥 Логирование всех сообщений (группа -1, не блокирует цепочку)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, log_message, block=False), group=-1)
-
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_message, block=False), group=1)  # ✅ Сохраняем переводы
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_button_click, block=False), group=1)  # ✅ Обрабатываем кнопки 
+    # ✅ Обработчики текста — блокирующие (по умолчанию): с block=False PTB запускает их отдельными задачами,
+    # PerUserUpdateProcessor отпускает очередь пользователя сразу, и сообщения одного пользователя теряют порядок.
+    # Параллельность между пользователями даёт concurrent_updates.
+    # 🔥 Логирование всех сообщений (группа -1) — только отметка в памяти, быстрый
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, log_message), group=-1)
+
+    # ✅ Один маршрутизатор: кнопки меню, сохранение переводов и свободный текст
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, route_text_message), group=1)
     application.add_handler(CallbackQueryHandler(handle_explain_request, pattern=r"^explain:"))
 
     application.add_handler(CommandHandler("translate", check_user_translation))  # ✅ Проверка переводов
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_translation_from_text, block=False), group=1)  # ✅ Проверяем переводы
 
 
     application.add_handler(CallbackQueryHandler(topic_selected)) #Он ждет любые нажатия на inline-кнопки.
-    application.add_handler(MessageHandler(filters.TEXT, log_all_messages, block=False), group=2)  # 👈 Добавляем в main()
+    application.add_handler(MessageHandler(filters.TEXT, log_all_messages), group=2)  # 👈 Добавляем в main()
 
     application.add_error_handler(error_handler)
     
@@ -3436,9 +3088,35 @@ def main():
 
     scheduler.add_job(lambda: submit_async(send_users_comparison_bar_chart, CallbackContext(application=application), period="quarter"), "cron", day="last", month="12", hour= 23, minute=2)
     
+    scheduler.add_job(lambda: submit_async(log_performance_metrics), "interval", minutes=30)
+    scheduler.add_job(lambda: submit_async(flush_activity), "interval", seconds=ACTIVITY_FLUSH_INTERVAL)
+    scheduler.add_job(lambda: submit_async(purge_expired_user_state), "interval", hours=1)
+    scheduler.add_job(lambda: submit_async(refresh_leaderboards), "interval", minutes=LEADERBOARD_REFRESH_MINUTES)
+
+    # Пополнение запаса предложений по темам — вне часов пик
+    scheduler.add_job(lambda: submit_async(replenish_sentence_inventory), "cron", hour="3,13", minute=20)
+
     scheduler.start()
     print("🚀 Бот запущен! Ожидаем сообщения...")
-    application.run_polling()
+    try:
+        if BOT_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise ValueError("❌ BOT_MODE=webhook, но WEBHOOK_URL не задан.")
+            print(f"🌐 Webhook: {WEBHOOK_URL}/{WEBHOOK_PATH} (слушаем {WEBHOOK_LISTEN}:{WEBHOOK_PORT})")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        flush_activity_sync()
+        shutdown_db_executor()
+        close_pool()
 
 
 
@@ -0,0 +1,159 @@
+# leaderboard_benchmark.py
+# Сравнение старого запроса недельных итогов (GROUP BY по bt_3_translations с коррелированными
+# COUNT(*) по bt_3_daily_sentences) и чтения материализованной таблицы лидеров (backend/leaderboards.py)
+# на синтетических данных. Всё создаётся во временной схеме и удаляется в конце — рабочие таблицы не трогаются.
+#
+# Пример (DATABASE_URL_RAILWAY должен указывать на тестовую БД):
+#   python leaderboard_benchmark.py --users 300 --days 120 --sentences 7 --runs 20
+import os
+import time
+import argparse
+import logging
+import statistics
+
+import psycopg2
+
+from backend.rollups import CREATE_ROLLUPS_SQL, rebuild_rollups
+from backend.leaderboards import CREATE_LEADERBOARDS_SQL, refresh_leaderboards_sync, load_leaderboard
+
+logging.basicConfig(level=logging.INFO)
+
+SCHEMA = "bt_3_leaderboard_bench"
+
+# Старый запрос send_weekly_summary (до перехода на таблицы лидеров)
+OLD_WEEKLY_SQL = """
+    SELECT
+        t.username,
+        COUNT(DISTINCT t.sentence_id) AS всего_переводов,
+        COALESCE(AVG(t.score), 0) AS средняя_оценка,
+        COALESCE(p.avg_time, 0) AS среднее_время_сессии_в_минутах,
+        COALESCE(p.total_time, 0) AS общее_время_в_минутах,
+        (SELECT COUNT(*)
+        FROM bt_3_daily_sentences
+        WHERE date >= CURRENT_DATE - INTERVAL '6 days'
+        AND user_id = t.user_id)
+        - COUNT(DISTINCT t.sentence_id) AS пропущено_за_неделю,
+        COALESCE(AVG(t.score), 0)
+            - (COALESCE(p.avg_time, 0) * 1)
+            - ((SELECT COUNT(*)
+                FROM bt_3_daily_sentences
+                WHERE date >= CURRENT_DATE - INTERVAL '6 days'
+                AND user_id = t.user_id)
+            - COUNT(DISTINCT t.sentence_id)) * 20
+            AS итоговый_балл
+    FROM bt_3_translations t
+    LEFT JOIN (
+        SELECT user_id,
+            AVG(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS avg_time,
+            SUM(EXTRACT(EPOCH FROM (end_time - start_time))/60) AS total_time
+        FROM bt_3_user_progress
+        WHERE completed = TRUE
+        AND start_time >= CURRENT_DATE - INTERVAL '6 days'
+        GROUP BY user_id
+    ) p ON t.user_id = p.user_id
+    WHERE t.timestamp >= CURRENT_DATE - INTERVAL '6 days'
+    GROUP BY t.username, t.user_id, p.avg_time, p.total_time
+    ORDER BY итоговый_балл DESC;
+"""
+
+# Рабочие таблицы в минимальном виде (только столбцы, которые читают отчёты)
+SOURCE_TABLES_SQL = """
+    CREATE TABLE bt_3_daily_sentences (
+        id SERIAL PRIMARY KEY, date DATE NOT NULL, sentence TEXT NOT NULL, unique_id INT NOT NULL,
+        user_id BIGINT, session_id BIGINT, id_for_mistake_table INT
+    );
+    CREATE TABLE bt_3_translations (
+        id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, session_id BIGINT, username TEXT,
+        sentence_id INT NOT NULL, score INT, timestamp TIMESTAMP
+    );
+    CREATE TABLE bt_3_user_progress (
+        session_id BIGINT PRIMARY KEY, user_id BIGINT, username TEXT,
+        start_time TIMESTAMP, end_time TIMESTAMP, completed BOOLEAN DEFAULT FALSE
+    );
+"""
+
+
+def populate(cursor, users, days, sentences):
+    """Одна сессия в день на пользователя, sentences предложений, ~85% переведено."""
+    cursor.execute("""
+        INSERT INTO bt_3_user_progress (session_id, user_id, username, start_time, end_time, completed)
+        SELECT u * 100000 + d, u, 'user_' || u,
+               CURRENT_DATE - d + INTERVAL '18 hours',
+               CURRENT_DATE - d + INTERVAL '18 hours' + (10 + random() * 40) * INTERVAL '1 minute',
+               TRUE
+        FROM generate_series(1, %s) u, generate_series(0, %s - 1) d;
+    """, (users, days))
+    cursor.execute("""
+        INSERT INTO bt_3_daily_sentences (date, sentence, unique_id, user_id, session_id, id_for_mistake_table)
+        SELECT CURRENT_DATE - d, 'Satz ' || n, n, u, u * 100000 + d, n
+        FROM generate_series(1, %s) u, generate_series(0, %s - 1) d, generate_series(1, %s) n;
+    """, (users, days, sentences))
+    cursor.execute("""
+        INSERT INTO bt_3_translations (user_id, session_id, username, sentence_id, score, timestamp)
+        SELECT user_id, session_id, 'user_' || user_id, id, (40 + random() * 60)::int,
+               date + INTERVAL '18 hours' + random() * INTERVAL '40 minutes'
+        FROM bt_3_daily_sentences
+        WHERE random() < 0.85;
+    """)
+    # Индексы, которые есть в рабочей БД
+    cursor.execute("""
+        CREATE INDEX ON bt_3_translations (user_id);
+        CREATE INDEX ON bt_3_translations (timestamp);
+        CREATE INDEX ON bt_3_daily_sentences (date, user_id);
+        ANALYZE;
+    """)
+
+
+def measure(runs, fn):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк недельной таблицы лидеров")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--sentences", type=int, default=7, help="Предложений на сессию")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.getenv("DATABASE_URL_RAILWAY"), sslmode=os.getenv("PGSSLMODE", "require"))
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};")
+        cursor.execute(f"SET search_path TO {SCHEMA};")
+
+        started = time.perf_counter()
+        cursor.execute(SOURCE_TABLES_SQL)
+        populate(cursor, args.users, args.days, args.sentences)
+        cursor.execute("SELECT COUNT(*) FROM bt_3_translations;")
+        translations = cursor.fetchone()[0]
+        logging.info(f"📦 Данные: {args.users} пользователей × {args.days} дней, {translations} переводов "
+                     f"({time.perf_counter() - started:.1f} сек)")
+
+        started = time.perf_counter()
+        cursor.execute(CREATE_ROLLUPS_SQL)
+        rebuild_rollups(cursor)
+        cursor.execute(CREATE_LEADERBOARDS_SQL)
+        logging.info(f"📦 Агрегаты и таблицы лидеров построены за {time.perf_counter() - started:.1f} сек")
+
+        old_median, old_max = measure(args.runs, lambda: (cursor.execute(OLD_WEEKLY_SQL), cursor.fetchall()))
+        new_median, new_max = measure(args.runs, lambda: load_leaderboard(cursor, "week"))
+        refresh_median, refresh_max = measure(max(1, args.runs // 4), lambda: refresh_leaderboards_sync(cursor))
+
+        logging.info(f"⏱ Старый запрос недельных итогов: median {old_median:.1f} ms, max {old_max:.1f} ms")
+        logging.info(f"⏱ Чтение таблицы лидеров:          median {new_median:.1f} ms, max {new_max:.1f} ms "
+                     f"(×{old_median / max(new_median, 0.001):.0f})")
+        logging.info(f"⏱ REFRESH CONCURRENTLY (неделя+месяц): median {refresh_median:.1f} ms, max {refresh_max:.1f} ms")
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
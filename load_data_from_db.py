@@ -4,6 +4,11 @@ import psycopg2
 import pandas as pd
 import asyncio
 
+from backend.hot_queries import (
+    ANALYTICS_ATTEMPTS_SQL, ANALYTICS_PROGRESS_SQL, ANALYTICS_TRANSLATIONS_SQL,
+    ANALYTICS_SUCCESS_SQL, ANALYTICS_MISTAKES_SQL, ANALYTICS_SENTENCES_SQL,
+)
+
 # === Подключение к базе данных PostgreSQL ===
 DATABASE_URL = os.getenv("DATABASE_URL_RAILWAY")
 
@@ -15,68 +20,39 @@ else:
 def get_db_connection():
     return psycopg2.connect(DATABASE_URL, sslmode='require')
 
-# Проверка подключения
-conn = get_db_connection()
-cursor = conn.cursor()
-cursor.execute("SELECT version();")
-db_version = cursor.fetchone()
-
-print(f"✅ База данных подключена! Версия: {db_version}")
-
-cursor.close()
-conn.close()
-
 def load_data_for_analytics(user_id: int, start_date, end_date, period: str = 'week') -> pd.DataFrame:
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT user_id, id_for_mistake_table, attempt FROM bt_3_attempts
-                WHERE user_id = %s AND timestamp::date BETWEEN %s AND %s;
-            """,(user_id, start_date, end_date))
+            cursor.execute(ANALYTICS_ATTEMPTS_SQL, (user_id, start_date, end_date))
 
             result_from_bt_3_attempts = cursor.fetchall()
             columns_bt_3_attempts = [desc[0] for desc in cursor.description]
             df_not_succeded_attempts = pd.DataFrame(result_from_bt_3_attempts, columns=columns_bt_3_attempts)
 
-            cursor.execute("""
-                SELECT session_id, username, start_time, end_time FROM bt_3_user_progress
-                WHERE user_id = %s AND end_time::date BETWEEN %s AND %s;
-            """, (user_id, start_date, end_date))
+            cursor.execute(ANALYTICS_PROGRESS_SQL, (user_id, start_date, end_date))
             
             result_from_user_progress_deepseek = cursor.fetchall()
 
             columns_user_progress_deepseek = [desc[0] for desc in cursor.description]
             df_progress = pd.DataFrame(result_from_user_progress_deepseek, columns=columns_user_progress_deepseek)
 
-            cursor.execute("""
-                SELECT session_id, username, sentence_id, score, timestamp FROM bt_3_translations
-                WHERE user_id = %s AND timestamp::date BETWEEN %s AND %s;
-            """, (user_id, start_date, end_date ))
+            cursor.execute(ANALYTICS_TRANSLATIONS_SQL, (user_id, start_date, end_date ))
             result_translations_deepseek = cursor.fetchall()          
             columns_translations_deepseek = [desc[0] for desc in cursor.description]
             df_translations = pd.DataFrame(result_translations_deepseek, columns=columns_translations_deepseek)
 
-            cursor.execute("""
-                SELECT sentence_id, score, attempt, date FROM bt_3_successful_translations
-                WHERE user_id = %s AND date::date BETWEEN %s AND %s;
-            """, (user_id, start_date, end_date))
+            cursor.execute(ANALYTICS_SUCCESS_SQL, (user_id, start_date, end_date))
             result_success_translations = cursor.fetchall()          
             columns_success = [desc[0] for desc in cursor.description]
             df_success = pd.DataFrame(result_success_translations, columns=columns_success)
 
-            cursor.execute("""
-                SELECT sentence_id, score FROM bt_3_detailed_mistakes
-                WHERE user_id = %s AND added_data::date BETWEEN %s AND %s;
-            """, (user_id, start_date, end_date ))
+            cursor.execute(ANALYTICS_MISTAKES_SQL, (user_id, start_date, end_date ))
             
             result_mistakes = cursor.fetchall()          
             columns_mistakes = [desc[0] for desc in cursor.description]
             df_mistakes = pd.DataFrame(result_mistakes, columns=columns_mistakes)
 
-            cursor.execute("""
-                SELECT date, id, session_id, user_id, id_for_mistake_table FROM bt_3_daily_sentences
-                WHERE user_id = %s AND date::date BETWEEN %s AND %s;
-            """, (user_id, start_date, end_date))
+            cursor.execute(ANALYTICS_SENTENCES_SQL, (user_id, start_date, end_date))
 
             result_sentences = cursor.fetchall()
             column_sentences = [desc[0] for desc in cursor.description]
@@ -0,0 +1,99 @@
+# webhook_load_test.py
+# Локальный генератор нагрузки для webhook-режима бота (BOT_MODE=webhook).
+# Отправляет синтетические обновления Telegram на адрес вебхука и считает пропускную способность
+# и задержку ответа сервера. Запускать против тестового бота/БД: обновления проходят весь конвейер
+# (log_message, route_text_message), а ответы бота в несуществующие чаты Telegram отклонит.
+#
+# Пример:
+#   python webhook_load_test.py --url http://localhost:8443/telegram --users 50 --updates 20 --concurrency 100
+import os
+import time
+import random
+import asyncio
+import argparse
+import logging
+
+import aiohttp
+
+logging.basicConfig(level=logging.INFO)
+
+# По умолчанию — свободный текст: маршрутизатор его не обрабатывает, нагрузка только на приём и логирование
+DEFAULT_TEXTS = ["Hallo zusammen", "Guten Morgen", "Wie geht's?"]
+
+
+def make_update(update_id, user_id, chat_id, text):
+    """Минимальное обновление message в формате Bot API."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "load-test"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"load_{user_id}", "username": f"load_{user_id}"},
+            "text": text,
+        },
+    }
+
+
+async def send_updates(session, url, secret, updates, concurrency, latencies, errors):
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async def post(update):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors.append(response.status)
+            except aiohttp.ClientError as e:
+                errors.append(type(e).__name__)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(post(update) for update in updates))
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест webhook-режима бота")
+    parser.add_argument("--url", default=os.getenv("WEBHOOK_LOAD_URL", "http://localhost:8443/telegram"))
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET"))
+    parser.add_argument("--users", type=int, default=20, help="Сколько разных пользователей")
+    parser.add_argument("--updates", type=int, default=10, help="Обновлений на пользователя")
+    parser.add_argument("--concurrency", type=int, default=50, help="Одновременных HTTP-запросов")
+    parser.add_argument("--chat-id", type=int, default=-1000000000001)
+    parser.add_argument("--text", action="append", help="Текст сообщения (можно несколько раз)")
+    args = parser.parse_args()
+
+    texts = args.text or DEFAULT_TEXTS
+    base_update_id = random.randint(10 ** 8, 10 ** 9)
+    updates = []
+    for i in range(args.updates):
+        for user in range(args.users):
+            update_id = base_update_id + len(updates)
+            updates.append(make_update(update_id, 10 ** 9 + user, args.chat_id, random.choice(texts)))
+
+    latencies, errors = [], []
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await send_updates(session, args.url, args.secret, updates, args.concurrency, latencies, errors)
+    elapsed = time.perf_counter() - started
+
+    logging.info(f"📊 Отправлено {len(updates)} обновлений за {elapsed:.2f} сек — {len(updates) / elapsed:.1f} upd/s")
+    logging.info(
+        f"⏱ Ответ вебхука: p50={percentile(latencies, 0.5) * 1000:.1f} ms, "
+        f"p95={percentile(latencies, 0.95) * 1000:.1f} ms, max={max(latencies) * 1000:.1f} ms"
+    )
+    if errors:
+        logging.warning(f"⚠️ Ошибок: {len(errors)} (примеры: {errors[:5]})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())